@@ -0,0 +1,178 @@
+import argparse, json, os, statistics, sys, time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+
+import similarity
+from hamming import NATIVE_POPCOUNT
+from similarity import (
+    HAMMING_THRESHOLD,
+    sliding_window_score,
+    sliding_window_score_np,
+    total_limit,
+    window_search,
+)
+
+# Popcounts avoided and time per pair of the bounded scorers against full
+# alignment (about 40% fewer popcounts on hour-long interval sequences, half
+# for the python engine), on candidate sets shaped like what blocking hands
+# the scorer: count mode compares 32-frame fingerprints of videos of about the
+# same length, interval mode (HASH_INTERVAL=2) whole-video sequences up to
+# SIM_DURATION_TOL apart, for clips of 2-30 minutes and for 30-60 minute videos
+SETS = {
+    "count": {"frames": (32, 33), "extra": (0, 2)},
+    "interval": {"frames": (60, 900), "extra": (0, 30)},
+    "interval_long": {"frames": (900, 1800), "extra": (0, 30)},
+}
+
+
+def video(rng, n):
+    # a few scenes of near-constant pHashes plus a few bits of per-frame noise
+    scenes = int(rng.integers(1, max(n // 8, 2)))
+    cuts = np.sort(rng.choice(np.arange(1, n), min(scenes, n) - 1, replace=False))
+    bases = rng.integers(0, 2**64, len(cuts) + 1, dtype=np.uint64)
+    frames = np.repeat(bases, np.diff(np.r_[0, cuts, n]))
+    return frames ^ noise(rng, n, 3)
+
+
+def noise(rng, n, bits):
+    out = np.zeros(n, dtype=np.uint64)
+    for _ in range(bits):
+        out |= np.uint64(1) << rng.integers(0, 64, n).astype(np.uint64)
+    return out
+
+
+def candidates(rng, shape, n, duplicates):
+    # n (shorter, longer) pairs; a `duplicates` share are a trimmed, re-encoded
+    # copy of the longer video, the rest unrelated videos
+    pairs = []
+    for _ in range(n):
+        la = int(rng.integers(*shape["frames"]))
+        lb = la + int(rng.integers(*shape["extra"]))
+        b = video(rng, lb)
+        if rng.random() < duplicates:
+            start = int(rng.integers(0, lb - la + 1))
+            a = b[start : start + la] ^ noise(rng, la, 4)
+        else:
+            a = video(rng, la)
+        pairs.append((a, b))
+    return pairs
+
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        times.append(time.perf_counter() - t0)
+    return 1000 * statistics.median(times), out
+
+
+def python_popcounts(pairs, cutoff):
+    # the reference engine calls similarity.hamming64 once per popcount
+    calls = 0
+    plain = similarity.hamming64
+
+    def counting(a, b):
+        nonlocal calls
+        calls += 1
+        return plain(a, b)
+
+    similarity.hamming64 = counting
+    try:
+        for a, b in pairs:
+            sliding_window_score(a, b, cutoff)
+    finally:
+        similarity.hamming64 = plain
+    return calls
+
+
+def measure(pairs, repeat, python_pairs):
+    exhaustive = sum((b.size - a.size + 1) * a.size for a, b in pairs)
+    done = sum(
+        window_search(a, b, total_limit(HAMMING_THRESHOLD, a.size))[1] for a, b in pairs
+    )
+    # the engine without a cutoff scores every frame at every offset, as
+    # scoring worked before cutoffs
+    full_ms, full = timed(
+        lambda: [sliding_window_score_np(a, b) for a, b in pairs], repeat
+    )
+    bounded_ms, bounded = timed(
+        lambda: [sliding_window_score_np(a, b, HAMMING_THRESHOLD) for a, b in pairs],
+        repeat,
+    )
+    # the scores that get stored must not change
+    for f, g in zip(full, bounded):
+        assert g == (f if f <= HAMMING_THRESHOLD else float("inf"))
+    some = [([int(h) for h in a], [int(h) for h in b]) for a, b in pairs[:python_pairs]]
+    py_exhaustive = sum((len(b) - len(a) + 1) * len(a) for a, b in some)
+    py_done = python_popcounts(some, HAMMING_THRESHOLD)
+    py_full_ms, _ = timed(lambda: [sliding_window_score(a, b) for a, b in some], 1)
+    py_bounded_ms, _ = timed(
+        lambda: [sliding_window_score(a, b, HAMMING_THRESHOLD) for a, b in some], 1
+    )
+    return {
+        "pairs": len(pairs),
+        "matches": sum(s <= HAMMING_THRESHOLD for s in full),
+        "popcounts_exhaustive": exhaustive,
+        "popcounts_bounded": done,
+        "popcounts_avoided_pct": 100.0 * (1 - done / exhaustive),
+        "numpy_us_per_pair": {
+            "exhaustive": 1000 * full_ms / len(pairs),
+            "bounded": 1000 * bounded_ms / len(pairs),
+        },
+        "python_pairs": len(some),
+        "python_popcounts_exhaustive": py_exhaustive,
+        "python_popcounts_bounded": py_done,
+        "python_popcounts_avoided_pct": 100.0 * (1 - py_done / py_exhaustive),
+        "python_us_per_pair": {
+            "exhaustive": 1000 * py_full_ms / len(some),
+            "bounded": 1000 * py_bounded_ms / len(some),
+        },
+    }
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description="popcounts and time the cutoff-bounded sliding-window "
+        "scorer saves on synthetic candidate sets"
+    )
+    p.add_argument("--pairs", type=int, default=5000)
+    p.add_argument("--python-pairs", type=int, default=200)
+    p.add_argument("--duplicates", type=float, default=0.05)
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--json", help="write the results to this file")
+    args = p.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    popcount = "numpy" if NATIVE_POPCOUNT else "table"
+    print(f"popcount: {popcount}, split above {similarity.BOUND_MIN_WORK} per block")
+    results = {}
+    for name, shape in SETS.items():
+        pairs = candidates(rng, shape, args.pairs, args.duplicates)
+        r = results[name] = measure(pairs, args.repeat, args.python_pairs)
+        print(
+            f"{name:>8}: {r['pairs']} pairs ({r['matches']} within threshold), "
+            f"popcounts {r['popcounts_exhaustive']} -> {r['popcounts_bounded']} "
+            f"({r['popcounts_avoided_pct']:.1f}% avoided), "
+            f"{r['numpy_us_per_pair']['exhaustive']:.1f} -> "
+            f"{r['numpy_us_per_pair']['bounded']:.1f} us/pair\n"
+            f"{'':>10}python engine on {r['python_pairs']} pairs: "
+            f"{r['python_popcounts_avoided_pct']:.1f}% popcounts avoided, "
+            f"{r['python_us_per_pair']['exhaustive']:.1f} -> "
+            f"{r['python_us_per_pair']['bounded']:.1f} us/pair"
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {"duplicates": args.duplicates, "popcount": popcount, **results},
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
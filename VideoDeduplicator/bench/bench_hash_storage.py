@@ -0,0 +1,134 @@
+import argparse, json, os, random, statistics, sys, time, uuid
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+
+import hash_store
+from db import connect
+from hash_store import convert_hash_storage, load_hashes, load_video_hashes, to_db_int
+from migrations import migrate
+
+SCHEMA = os.path.join(HERE, "..", "schema.sql")
+
+# File size and load times of the two HASH_STORAGE layouts on one synthetic
+# database, converted between them in place (50k videos of 32 frames: 151 MiB
+# as rows, 23 MiB as blobs; full load 2.5 s and 0.12 s).
+
+
+def build(path, n, frames=32, seed=0):
+    # n videos of `frames` random pHashes each, in the original row layout
+    rng = np.random.default_rng(seed)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    conn = connect(path)
+    conn.executescript(open(SCHEMA).read())
+    migrate(conn)
+    vids = [uuid.uuid5(uuid.NAMESPACE_URL, f"/videos/{i}.mp4").hex for i in range(n)]
+    conn.executemany(
+        "INSERT INTO videos VALUES (?, ?, ?, ?, ?)",
+        ((vid, f"/videos/{i}.mp4", 10**8, 0.0, 0.0) for i, vid in enumerate(vids)),
+    )
+    for i in range(0, n, 10_000):
+        batch = vids[i : i + 10_000]
+        hashes = rng.integers(0, 2**64, size=(len(batch), frames), dtype=np.uint64)
+        conn.executemany(
+            "INSERT INTO video_hashes VALUES (?, ?, ?)",
+            (
+                (vid, k, to_db_int(int(ph)))
+                for vid, row in zip(batch, hashes)
+                for k, ph in enumerate(row)
+            ),
+        )
+    conn.commit()
+    conn.close()
+    return vids
+
+
+def file_size(path):
+    return sum(
+        os.path.getsize(path + suffix)
+        for suffix in ("", "-wal")
+        if os.path.exists(path + suffix)
+    )
+
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        times.append(time.perf_counter() - t0)
+    return 1000 * statistics.median(times), out
+
+
+def measure(conn, storage, vids, repeat, seed=0):
+    hash_store.HASH_STORAGE = storage
+    rng = random.Random(seed)
+    cur = conn.cursor()
+    full_ms, store = timed(lambda: load_hashes(cur), repeat)
+    subset = rng.sample(vids, min(len(vids), 5000))
+    subset_ms, _ = timed(lambda: load_hashes(cur, subset), repeat)
+    one = [rng.choice(vids) for _ in range(1000)]
+    one_ms, _ = timed(lambda: [load_video_hashes(cur, vid) for vid in one], 3)
+    return {
+        "full_load_ms": full_ms,
+        "subset_load_ms": subset_ms,
+        "subset_videos": len(subset),
+        "per_video_us": one_ms,  # 1000 lookups, so ms == us per lookup
+        "frames": int(store.flat.size),
+        "checksum": int(np.bitwise_xor.reduce(store.flat)) if store.flat.size else 0,
+    }
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description="size and read speed of the per-frame row layout against "
+        "the per-video blob layout of the pHash sequences"
+    )
+    p.add_argument("--db", default="/tmp/bench_hash_storage.db")
+    p.add_argument("--videos", type=int, default=100_000)
+    p.add_argument("--frames", type=int, default=32)
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--json", help="write the results to this file")
+    args = p.parse_args()
+
+    t0 = time.perf_counter()
+    vids = build(args.db, args.videos, args.frames)
+    print(f"built {args.videos} videos in {time.perf_counter() - t0:.1f}s")
+
+    results = {}
+    conn = connect(args.db)
+    for storage in ("rows", "blob"):
+        if storage == "blob":
+            t0 = time.perf_counter()
+            convert_hash_storage(conn, "blob")
+            convert_s = time.perf_counter() - t0
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        res = measure(conn, storage, vids, args.repeat)
+        res["file_mb"] = file_size(args.db) / 2**20
+        if storage == "blob":
+            res["convert_s"] = convert_s
+        results[storage] = res
+    conn.close()
+
+    assert results["rows"]["checksum"] == results["blob"]["checksum"]
+    for storage, r in results.items():
+        print(
+            f"{storage:>5}: {r['file_mb']:8.1f} MiB, "
+            f"full load {r['full_load_ms']:8.1f} ms, "
+            f"{r['subset_videos']} videos by id {r['subset_load_ms']:7.1f} ms, "
+            f"one video {r['per_video_us']:6.1f} us"
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {"videos": args.videos, "frames": args.frames, **results}, f, indent=2
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import argparse, json, os, random, statistics, sys, time, uuid
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+
+from api_app import cluster_list_query
+from db import connect
+from migrations import migrate, schema_version
+
+SCHEMA = os.path.join(HERE, "..", "schema.sql")
+
+# EXPLAIN QUERY PLAN and latency of each query below on a synthetic database,
+# before and after the migration adding the secondary and covering indexes.
+# The API's queries (the cluster list built by api_app itself), plus the
+# pipeline lookups the new indexes target. Params are drawn per run from ids
+# that exist in the database.
+QUERIES = {
+    "list_clusters": (
+        cluster_list_query(min_size=2)[0],
+        lambda rng, ids: cluster_list_query(min_size=2)[1],
+    ),
+    "list_clusters.search": (
+        cluster_list_query(min_size=2, q="/videos/42/")[0],
+        lambda rng, ids: cluster_list_query(min_size=2, q="/videos/42/")[1],
+    ),
+    "cluster_detail.canonical": (
+        "SELECT cv.canonical_video_id FROM canonical_videos cv WHERE cv.cluster_id = ?",
+        lambda rng, ids: (rng.choice(ids["clusters"]),),
+    ),
+    "cluster_detail.members": (
+        """
+        SELECT dc.video_id, df.is_duplicate, v.path,
+               m.width, m.height, m.bitrate, m.codec, m.duration
+        FROM duplicate_clusters dc
+        JOIN videos v ON dc.video_id = v.video_id
+        JOIN video_metadata m ON v.video_id = m.video_id
+        LEFT JOIN duplicate_flags df ON dc.video_id = df.video_id
+        WHERE dc.cluster_id = ?
+    """,
+        lambda rng, ids: (rng.choice(ids["clusters"]),),
+    ),
+    "video_detail": (
+        """
+        SELECT v.video_id, v.path, m.*
+        FROM videos v
+        JOIN video_metadata m ON v.video_id = m.video_id
+        WHERE v.video_id = ?
+    """,
+        lambda rng, ids: (rng.choice(ids["videos"]),),
+    ),
+    "proposals": (
+        """
+        SELECT df.video_id, df.canonical_of,
+               v.path AS dup_path, vc.path AS canonical_path
+        FROM duplicate_flags df
+        JOIN videos v ON df.video_id = v.video_id
+        JOIN videos vc ON df.canonical_of = vc.video_id
+        WHERE df.is_duplicate = 1
+        ORDER BY df.canonical_of
+    """,
+        lambda rng, ids: (),
+    ),
+    "adhoc.cluster_of_video": (
+        "SELECT cluster_id FROM duplicate_clusters WHERE video_id = ?",
+        lambda rng, ids: (rng.choice(ids["clustered"]),),
+    ),
+    "similarity.pairs_of_video": (
+        """
+        SELECT video_id_a, video_id_b FROM video_similarity
+        WHERE video_id_a = ? OR video_id_b = ?
+    """,
+        lambda rng, ids: (rng.choice(ids["clustered"]),) * 2,
+    ),
+    "cluster.build_graph": (
+        """
+        SELECT video_id_a, video_id_b FROM video_similarity
+        WHERE avg_hamming <= ?
+    """,
+        lambda rng, ids: (12.0,),
+    ),
+}
+
+
+def build(path, n, seed=0):
+    # n videos; about a third of them in clusters of 2-4 copies joined by
+    # near-duplicate edges, plus n / 2 edges above the clustering threshold
+    rng = random.Random(seed)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    conn = connect(path)
+    conn.executescript(open(SCHEMA).read())
+    # ids as scan_folders makes them, so rowid order is random in key order
+    paths = [f"/videos/{i % 997}/{i}.mp4" for i in range(n)]
+    vids = [uuid.uuid5(uuid.NAMESPACE_URL, path).hex for path in paths]
+    conn.executemany(
+        "INSERT INTO videos VALUES (?, ?, ?, ?, ?)",
+        ((vid, path, 10**8, 0.0, 0.0) for vid, path in zip(vids, paths)),
+    )
+    conn.executemany(
+        "INSERT INTO video_metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            (
+                vid,
+                rng.uniform(30, 7200),
+                0,
+                1920,
+                rng.choice([480, 720, 1080, 2160]),
+                rng.choice(["h264", "hevc", "vp9"]),
+                rng.randint(1, 20) * 10**6,
+                "mp4",
+                30.0,
+            )
+            for vid in vids
+        ),
+    )
+
+    clusters, flags, canon, edges = [], [], [], []
+    i, cid = 0, 1
+    while i < n // 3:
+        members = vids[i : i + rng.randint(2, 4)]
+        i += len(members)
+        clusters += [(cid, vid) for vid in members]
+        canon.append((cid, members[0]))
+        flags += [(vid, int(vid != members[0]), members[0]) for vid in members]
+        edges += [
+            (a, b, rng.uniform(0, 12))
+            for k, a in enumerate(members)
+            for b in members[k + 1 :]
+        ]
+        cid += 1
+    edges += [
+        (vids[a], vids[b], rng.uniform(12.5, 16))
+        for a, b in ((rng.randrange(n), rng.randrange(n)) for _ in range(n // 2))
+        if a < b
+    ]
+    conn.executemany("INSERT INTO duplicate_clusters VALUES (?, ?)", clusters)
+    conn.executemany("INSERT INTO canonical_videos VALUES (?, ?)", canon)
+    conn.executemany("INSERT INTO duplicate_flags VALUES (?, ?, ?)", flags)
+    conn.executemany("INSERT OR IGNORE INTO video_similarity VALUES (?, ?, ?)", edges)
+    conn.commit()
+    conn.close()
+
+
+def sample_ids(conn, rng, k=1000):
+    def pick(sql):
+        rows = [r[0] for r in conn.execute(sql)]
+        return rng.sample(rows, min(k, len(rows)))
+
+    return {
+        "videos": pick("SELECT video_id FROM videos"),
+        "clusters": pick("SELECT cluster_id FROM canonical_videos"),
+        "clustered": pick("SELECT video_id FROM duplicate_clusters"),
+    }
+
+
+def measure(conn, ids, repeat, seed=0):
+    rng = random.Random(seed)
+    out = {}
+    for name, (sql, params) in QUERIES.items():
+        plan = [
+            row[3]
+            for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params(rng, ids))
+        ]
+        times, rows = [], 0
+        for _ in range(repeat):
+            args = params(rng, ids)
+            t0 = time.perf_counter()
+            rows = len(conn.execute(sql, args).fetchall())
+            times.append(time.perf_counter() - t0)
+        out[name] = {
+            "plan": plan,
+            "median_ms": 1000 * statistics.median(times),
+            "max_ms": 1000 * max(times),
+            "rows": rows,
+        }
+    return out
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description="EXPLAIN QUERY PLAN and latency of the API queries, "
+        "before and after the schema migrations"
+    )
+    p.add_argument("--db", default="/tmp/bench_indexes.db")
+    p.add_argument("--videos", type=int, default=1_000_000)
+    p.add_argument("--repeat", type=int, default=20)
+    p.add_argument("--reuse", action="store_true", help="keep an existing --db")
+    p.add_argument("--json", help="write the results to this file")
+    args = p.parse_args()
+
+    if not (args.reuse and os.path.exists(args.db)):
+        t0 = time.perf_counter()
+        build(args.db, args.videos)
+        print(f"built {args.videos} videos in {time.perf_counter() - t0:.1f}s")
+
+    conn = connect(args.db)
+    ids = sample_ids(conn, random.Random(1))
+    results = {}
+    # a reused database may already be migrated; "before" is then skipped
+    if schema_version(conn) == 0:
+        results["before"] = measure(conn, ids, args.repeat)
+    migrate(conn)
+    results["after"] = measure(conn, ids, args.repeat)
+    conn.close()
+
+    for name in QUERIES:
+        print(f"\n{name}")
+        for phase, res in results.items():
+            r = res[name]
+            print(
+                f"  {phase:>6}: {r['median_ms']:9.2f} ms median, "
+                f"{r['max_ms']:9.2f} ms max, {r['rows']} rows"
+            )
+            for line in r["plan"]:
+                print(f"          {line}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"videos": args.videos, **results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
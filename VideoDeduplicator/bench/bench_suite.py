@@ -0,0 +1,332 @@
+import argparse, contextlib, io, json, os, platform, random, shutil, sqlite3
+import subprocess, sys, time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, "..", "src")
+sys.path.insert(0, SRC)
+
+from canonical import main as canon_main
+from cluster import main as cluster_main
+from compute_hashes import main as hash_main
+from db import reader
+from extract_metadata import main as meta_main
+from hash_corpus import corpus_path, refresh_corpus
+from hash_store import HASH_STORAGE
+from prehash import main as prehash_main
+from scan_folders import main as scan_main
+from similarity import main as sim_main
+from synth import create_db, make_clips, make_library, size_arg
+
+# Times every pipeline stage and the API's read endpoints on synthetic inputs
+# and writes one JSON file per run, so runs on two commits can be compared
+# with --compare. Tiers:
+#   clips:   ffmpeg-made clips and copies (synth.make_clips), every stage from
+#            an empty database, plus how many true duplicate pairs ended up in
+#            one cluster
+#   <size>:  a synthetic library of that many videos (synth.make_library)
+#            taking in --new unscored videos: corpus build, incremental sim,
+#            cluster and canon. Libraries are kept in --workdir and reused.
+# The API's read endpoints are then timed through FastAPI's test client. The
+# results file records the commit, the host and the SETTINGS below.
+SUITE_VERSION = 1
+# environment knobs that change what gets measured
+SETTINGS = [
+    "HASH_STORAGE",
+    "HASH_MODE",
+    "HASH_INTERVAL",
+    "HASH_BACKEND",
+    "HASH_SAMPLER",
+    "HASH_WORKERS",
+    "META_WORKERS",
+    "PREHASH_WORKERS",
+    "SIM_ENGINE",
+    "SIM_WORKERS",
+    "SIM_USE_INDEX",
+    "SIM_SIGNATURE",
+    "SIM_DURATION_TOL",
+    "SIM_FRAMECOUNT_TOL",
+    "DB_CACHE_MB",
+    "DB_MMAP_MB",
+]
+API = [
+    ("clusters", "/clusters"),
+    ("clusters.search", "/clusters?q=1"),
+    ("cluster", "/clusters/{cluster}"),
+    ("video", "/videos/{video}"),
+    ("proposals.json", "/proposals.json"),
+    ("dashboard", "/"),
+    ("cluster_page", "/cluster/{cluster}"),
+    ("proposals", "/proposals"),
+]
+
+
+def timed(fn, verbose=False):
+    # seconds fn took; its progress prints are dropped unless verbose
+    out = sys.stdout if verbose else io.StringIO()
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(out):
+        fn()
+    return time.perf_counter() - t0
+
+
+def git_state():
+    def git(*args):
+        return subprocess.run(
+            ["git", *args], cwd=HERE, capture_output=True, text=True
+        ).stdout.strip()
+
+    try:
+        commit = git("rev-parse", "HEAD") or None
+        return commit, commit and bool(
+            git("status", "--porcelain", "--untracked-files=no")
+        )
+    except OSError:
+        return None, None
+
+
+def time_api(db_path, repeat, seed=0):
+    # {endpoint: {median_ms, p95_ms, status}} over `repeat` requests each,
+    # through FastAPI's test client (no server or network in the loop)
+    os.environ.setdefault("DB_PATH", db_path)
+    try:
+        from fastapi.testclient import TestClient
+
+        import api_app
+    except ImportError as e:
+        return {"skipped": f"{e.name} not installed"}
+    api_app.DB_PATH = db_path
+    with reader(db_path) as conn:
+        clusters = [
+            r[0] for r in conn.execute("SELECT cluster_id FROM canonical_videos")
+        ]
+        videos = [r[0] for r in conn.execute("SELECT video_id FROM video_metadata")]
+    rng = random.Random(seed)
+    results = {}
+    cwd = os.getcwd()
+    os.chdir(SRC)  # templates/ is looked up from the working directory
+    try:
+        # a failing endpoint is reported by its status, not raised
+        client = TestClient(api_app.app, raise_server_exceptions=False)
+        for name, url in API:
+            if "{cluster}" in url and not clusters:
+                continue
+            times, status = [], None
+            for _ in range(repeat):
+                path = url.format(
+                    cluster=rng.choice(clusters) if clusters else None,
+                    video=rng.choice(videos) if videos else None,
+                )
+                t0 = time.perf_counter()
+                status = client.get(path).status_code
+                times.append(1000 * (time.perf_counter() - t0))
+            times.sort()
+            results[name] = {
+                "median_ms": times[len(times) // 2],
+                "p95_ms": times[int(0.95 * (len(times) - 1))],
+                "status": status,
+            }
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+def clip_quality(db_path, root, manifest):
+    # pairs of files made from one source that share a cluster, and pairs of
+    # files from different sources that wrongly do
+    with reader(db_path) as conn:
+        paths = dict(conn.execute("SELECT video_id, path FROM videos"))
+        cluster = {
+            paths[vid]: cid
+            for cid, vid in conn.execute(
+                "SELECT cluster_id, video_id FROM duplicate_clusters"
+            )
+        }
+    files = sorted(manifest)
+    expected = found = false = 0
+    for k, a in enumerate(files):
+        ca = cluster.get(os.path.join(root, a))
+        for b in files[k + 1 :]:
+            together = ca is not None and ca == cluster.get(os.path.join(root, b))
+            if manifest[a] == manifest[b]:
+                expected += 1
+                found += together
+            else:
+                false += together
+    return {"expected_pairs": expected, "found_pairs": found, "false_pairs": false}
+
+
+def run_clips(workdir, args):
+    if shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None:
+        return {"skipped": "ffmpeg/ffprobe not found"}
+    root = os.path.join(workdir, "clips")
+    t0 = time.perf_counter()
+    manifest = make_clips(root, args.sources, args.seconds, args.seed)
+    generate_s = time.perf_counter() - t0
+    db_path = os.path.join(workdir, "clips.db")
+    timed(lambda: create_db(db_path), args.verbose)
+    stages = {}
+    for name, fn in [
+        ("scan", lambda: scan_main(db_path, [root])),
+        ("prehash", lambda: prehash_main(db_path)),
+        ("meta", lambda: meta_main(db_path)),
+        ("hash", lambda: hash_main(db_path)),
+        ("sim", lambda: sim_main(db_path)),
+        ("cluster", lambda: cluster_main(db_path)),
+        ("canon", lambda: canon_main(db_path)),
+    ]:
+        stages[name] = timed(fn, args.verbose)
+    return {
+        "videos": len(manifest),
+        "generate_s": generate_s,
+        "stages": stages,
+        "quality": clip_quality(db_path, root, manifest),
+        "api": time_api(db_path, args.api_repeat, args.seed),
+    }
+
+
+def run_library(workdir, n, args):
+    name = f"library-{n}-{args.new}-{args.seed}-{HASH_STORAGE}"
+    pristine = os.path.join(workdir, name + ".db")
+    # written last, so a library whose generation was cut short is not reused
+    marker = os.path.join(workdir, name + ".json")
+    if args.regenerate or not os.path.exists(marker):
+        if os.path.exists(marker):
+            os.remove(marker)
+        info = {}
+        timed(
+            lambda: info.update(make_library(pristine, n, args.new, seed=args.seed)),
+            args.verbose,
+        )
+        with open(marker, "w") as f:
+            json.dump(info, f)
+    with open(marker) as f:
+        info = json.load(f)
+
+    # every run starts from a copy of the library, without a hash corpus
+    db_path = os.path.join(workdir, f"run-{n}.db")
+    for suffix in ("", "-wal", "-shm", ".hashes.bin"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    src, dst = sqlite3.connect(pristine), sqlite3.connect(db_path)
+    src.backup(dst)
+    src.close()
+    dst.close()
+
+    def build_corpus():
+        with reader(db_path) as conn:
+            refresh_corpus(conn.cursor(), corpus_path(db_path))
+
+    stages = {}
+    for stage, fn in [
+        ("corpus", build_corpus),
+        ("sim", lambda: sim_main(db_path, incremental=True)),
+        ("cluster", lambda: cluster_main(db_path)),
+        ("canon", lambda: canon_main(db_path)),
+    ]:
+        stages[stage] = timed(fn, args.verbose)
+    return {
+        "videos": n,
+        "new": info["new"],
+        "library_pairs": info["pairs"],
+        "generate_s": info["seconds"],
+        "stages": stages,
+        "api": time_api(db_path, args.api_repeat, args.seed),
+    }
+
+
+def summary(name, tier):
+    if "skipped" in tier:
+        return f"{name}: skipped, {tier['skipped']}"
+    stages = ", ".join(f"{k} {v:.2f}s" for k, v in tier["stages"].items())
+    api = tier["api"]
+    if "skipped" not in api:
+        api = {k: round(v["median_ms"], 1) for k, v in api.items()}
+    return f"{name}: {tier['videos']} videos; {stages}; api median ms {api}"
+
+
+def timings(results, prefix=""):
+    # {"tiers.1k.stages.sim": seconds, ...}: the numbers worth comparing
+    out = {}
+    for key, value in results.items():
+        path = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            out.update(timings(value, path))
+        elif (
+            ".stages." in path or path.endswith(("_ms", "generate_s"))
+        ) and isinstance(value, (int, float)):
+            out[path] = value
+    return out
+
+
+def compare(old, new):
+    before, after = timings(old["tiers"]), timings(new["tiers"])
+    print(f"compared with {old.get('commit') or '?'} ({old.get('date')})")
+    for key in sorted(before.keys() & after.keys()):
+        a, b = before[key], after[key]
+        ratio = f"x{b / a:.2f}" if a else ""
+        print(f"  {key:<45} {a:10.4f} -> {b:10.4f} {ratio}")
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description="time every pipeline stage and the API on synthetic clips "
+        "and libraries, and write the results as JSON"
+    )
+    p.add_argument("--workdir", default="/tmp/vdd-bench")
+    p.add_argument(
+        "--sizes",
+        default="1k,100k",
+        help="library sizes, e.g. 1k,100k,1M; empty for none",
+    )
+    p.add_argument("--new", type=size_arg, default=1000)
+    p.add_argument("--sources", type=int, default=4, help="clip sources; 0: none")
+    p.add_argument("--seconds", type=int, default=8)
+    p.add_argument("--api-repeat", type=int, default=20)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--regenerate", action="store_true")
+    p.add_argument("--verbose", action="store_true")
+    p.add_argument("--json", help="results file (default: <workdir>/<commit>.json)")
+    p.add_argument("--compare", help="results file of an earlier run")
+    args = p.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    commit, dirty = git_state()
+    results = {
+        "suite_version": SUITE_VERSION,
+        "commit": commit,
+        "dirty": dirty,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "sqlite": sqlite3.sqlite_version,
+            "cpus": os.cpu_count(),
+        },
+        "settings": {key: os.environ.get(key) for key in SETTINGS},
+        "args": vars(args),
+        "tiers": {},
+    }
+    tiers = results["tiers"]
+    if args.sources > 0:
+        tiers["clips"] = run_clips(args.workdir, args)
+        print(summary("clips", tiers["clips"]))
+        if "quality" in tiers["clips"]:
+            print(f"clips: {tiers['clips']['quality']}")
+    for size in filter(None, args.sizes.split(",")):
+        tiers[size] = run_library(args.workdir, size_arg(size), args)
+        print(summary(size, tiers[size]))
+
+    out = args.json or os.path.join(args.workdir, f"{(commit or 'results')[:12]}.json")
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {out}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
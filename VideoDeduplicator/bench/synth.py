@@ -0,0 +1,235 @@
+import argparse, json, os, shutil, subprocess, sys, time, uuid
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+
+from canonical import main as canon_main
+from cluster import main as cluster_main
+from db import connect, writer
+from hash_store import HASH_STORAGE, store_hashes
+from migrations import migrate
+from similarity import HAMMING_THRESHOLD, record_scored, sliding_window_score_np
+
+SCHEMA = os.path.join(HERE, "..", "schema.sql")
+
+# Synthetic libraries for the benchmarks:
+#   clips:   tiny ffmpeg-made sources plus controlled copies of each (byte copy,
+#            re-encode, downscale, crop, trim, remux), with a manifest naming
+#            the source of every file
+#   library: a database of videos, metadata and 32-frame pHash sequences
+#            (no files), about a third of them near-duplicates of another,
+#            settled as if the pipeline had run except for the `new` videos
+
+# lavfi sources; {seed} varies the content between sources of the same kind
+SOURCES = [
+    "testsrc2=s=320x240:r=15",
+    "mandelbrot=s=320x240:r=15",
+    "life=s=320x240:r=15:seed={seed}:mold=10:ratio=0.2",
+    "cellauto=s=320x240:r=15:seed={seed}:rule=30",
+]
+ENCODE = ["-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p"]
+# name -> (extension, ffmpeg arguments between input and output); None: byte copy
+VARIANTS = {
+    "copy": (".mp4", None),
+    "reencode": (".mp4", ENCODE + ["-crf", "38"]),
+    "scale": (".mp4", ["-vf", "scale=160:120"] + ENCODE),
+    "crop": (".mp4", ["-vf", "crop=iw*0.9:ih*0.9,scale=320:240"] + ENCODE),
+    "trim": (".mp4", ["-ss", "1"] + ENCODE),
+    "remux": (".mkv", ["-c", "copy"]),
+}
+
+
+def ffmpeg(*args):
+    subprocess.run(
+        ["ffmpeg", "-v", "error", "-nostdin", "-y", *args],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def make_clips(root, sources=4, seconds=8, seed=0):
+    # -> manifest {path relative to root: source name}, also saved as
+    # root/manifest.json; every source and its variants share a folder
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    manifest = {}
+    for k in range(sources):
+        name = f"src{k:03d}"
+        os.makedirs(os.path.join(root, name))
+        lavfi = SOURCES[k % len(SOURCES)].format(seed=seed + k)
+        original = os.path.join(name, "original.mp4")
+        ffmpeg(
+            "-f",
+            "lavfi",
+            "-i",
+            lavfi,
+            "-t",
+            str(seconds),
+            *ENCODE,
+            "-crf",
+            "23",
+            os.path.join(root, original),
+        )
+        manifest[original] = name
+        for variant, (ext, args) in VARIANTS.items():
+            out = os.path.join(name, variant + ext)
+            if args is None:
+                shutil.copyfile(os.path.join(root, original), os.path.join(root, out))
+            else:
+                ffmpeg(
+                    "-i", os.path.join(root, original), *args, os.path.join(root, out)
+                )
+            manifest[out] = name
+    with open(os.path.join(root, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def create_db(path):
+    for suffix in ("", "-wal", "-shm", ".hashes.bin"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    conn = connect(path)
+    conn.executescript(open(SCHEMA).read())
+    migrate(conn)
+    conn.close()
+
+
+def scene_hashes(rng, n, frames):
+    # n pHash sequences of a few scenes each: a scene keeps its hash, give or
+    # take a few bits of noise per frame
+    cuts = rng.random((n, frames)) < 0.1
+    cuts[:, 0] = False
+    scene = np.cumsum(cuts, axis=1)
+    bases = rng.integers(0, 2**64, size=(n, frames), dtype=np.uint64)
+    return np.take_along_axis(bases, scene, axis=1) ^ flips(rng, (n, frames), 3)
+
+
+def flips(rng, shape, bits):
+    out = np.zeros(shape, dtype=np.uint64)
+    for _ in range(bits):
+        out |= np.uint64(1) << rng.integers(0, 64, shape).astype(np.uint64)
+    return out
+
+
+def make_library(path, n, new=1000, frames=32, dup_share=0.3, seed=0, batch=50_000):
+    # -> {"videos", "new", "pairs", "seconds"}
+    t0 = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    create_db(path)
+    new_ids = set(rng.choice(n, min(new, n), replace=False).tolist())
+
+    # video i is either an original or a near-duplicate of an earlier original
+    copy_of = np.full(n, -1)
+    is_copy = rng.random(n) < dup_share
+    is_copy[0] = False
+    originals = np.flatnonzero(~is_copy)
+    copies = np.flatnonzero(is_copy)
+    earlier = np.searchsorted(originals, copies)
+    copy_of[copies] = originals[(rng.random(len(copies)) * earlier).astype(int)]
+    duration = rng.uniform(30, 5400, n)
+    height = rng.choice([480, 720, 1080, 2160], n)
+    duration[copies] = duration[copy_of[copies]] + rng.uniform(-0.5, 0.5, len(copies))
+    height[copies] = height[copy_of[copies]]
+    codec = rng.choice(["h264", "hevc", "vp9"], n)
+    bitrate = rng.integers(1, 20, n) * 10**6
+
+    paths = [f"/library/{i % 997}/{i}.mp4" for i in range(n)]
+    vids = [uuid.uuid5(uuid.NAMESPACE_URL, p).hex for p in paths]
+    hashes = np.zeros((n, frames), dtype=np.uint64)
+    groups = {}
+    for lo in range(0, n, batch):
+        hi = min(lo + batch, n)
+        with writer(path) as conn:
+            cur = conn.cursor()
+            hashes[lo:hi] = scene_hashes(rng, hi - lo, frames)
+            copies = np.flatnonzero(is_copy[lo:hi]) + lo
+            hashes[copies] = hashes[copy_of[copies]] ^ flips(
+                rng, (len(copies), frames), 2
+            )
+            cur.executemany(
+                "INSERT INTO videos VALUES (?, ?, ?, ?, ?)",
+                ((vids[i], paths[i], 10**8 + i, 0.0, 0.0) for i in range(lo, hi)),
+            )
+            cur.executemany(
+                "INSERT INTO video_metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        vids[i],
+                        float(duration[i]),
+                        int(round(duration[i] * 30)),
+                        int(height[i]) * 16 // 9,
+                        int(height[i]),
+                        str(codec[i]),
+                        int(bitrate[i]),
+                        "mp4",
+                        30.0,
+                    )
+                    for i in range(lo, hi)
+                ),
+            )
+            for i in range(lo, hi):
+                store_hashes(cur, vids[i], list(enumerate(hashes[i].tolist())))
+            # the library outside `new` is scored: its pairs and state are in
+            scored = [i for i in range(lo, hi) if i not in new_ids]
+            record_scored(cur, {vids[i]: (10**8 + i, 0.0, frames) for i in scored})
+            for i in scored:
+                root = copy_of[i] if copy_of[i] >= 0 else i
+                groups.setdefault(root, []).append(i)
+
+    pairs = []
+    for members in groups.values():
+        for k, a in enumerate(members):
+            for b in members[k + 1 :]:
+                score = sliding_window_score_np(hashes[a], hashes[b], HAMMING_THRESHOLD)
+                if score <= HAMMING_THRESHOLD:
+                    pairs.append((vids[a], vids[b], score))
+    with writer(path) as conn:
+        conn.executemany("INSERT INTO video_similarity VALUES (?, ?, ?)", pairs)
+    cluster_main(path)
+    canon_main(path)
+    return {
+        "videos": n,
+        "new": len(new_ids),
+        "pairs": len(pairs),
+        "seconds": time.perf_counter() - t0,
+    }
+
+
+def size_arg(text):
+    # 1000, 1k, 100k, 1M
+    text = text.strip()
+    scale = {"k": 10**3, "K": 10**3, "m": 10**6, "M": 10**6}.get(text[-1:], 1)
+    return int(float(text[:-1] if scale > 1 else text) * scale)
+
+
+def main():
+    p = argparse.ArgumentParser(description="generate synthetic benchmark inputs")
+    sub = p.add_subparsers(dest="kind", required=True)
+    c = sub.add_parser("clips", help="ffmpeg test clips and controlled copies")
+    c.add_argument("root")
+    c.add_argument("--sources", type=int, default=4)
+    c.add_argument("--seconds", type=int, default=8)
+    c.add_argument("--seed", type=int, default=0)
+    lib = sub.add_parser("library", help="database of synthetic hashes and metadata")
+    lib.add_argument("db")
+    lib.add_argument("--videos", type=size_arg, default=1000)
+    lib.add_argument("--new", type=size_arg, default=1000)
+    lib.add_argument("--seed", type=int, default=0)
+    args = p.parse_args()
+
+    if args.kind == "clips":
+        manifest = make_clips(args.root, args.sources, args.seconds, args.seed)
+        print(f"{len(manifest)} clips in {args.root}")
+    else:
+        info = make_library(args.db, args.videos, args.new, seed=args.seed)
+        print(
+            f"{info['videos']} videos ({info['new']} unscored, {info['pairs']} "
+            f"pairs, {HASH_STORAGE} hashes) in {args.db}, {info['seconds']:.1f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -62,4 +62,4 @@ CREATE TABLE IF NOT EXISTS duplicate_flags (
     canonical_of TEXT,
     FOREIGN KEY(video_id) REFERENCES videos(video_id),
     FOREIGN KEY(canonical_of) REFERENCES videos(video_id)
-);
\ No newline at end of file
+);
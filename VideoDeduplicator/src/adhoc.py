@@ -1,9 +1,29 @@
-import os, uuid, sqlite3
-from extract_metadata import probe
-from compute_hashes import compute_video_hashes
-from similarity import passes_blocking, sliding_window_score, HAMMING_THRESHOLD
+import os, uuid, sqlite3, threading, time
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from extract_metadata import probe, parse_probe, record_probe, store_metadata
+from compute_hashes import hash_video, store_samples
+from similarity import (
+    passes_blocking,
+    get_scorer,
+    as_scorer_input,
+    record_scored,
+    HAMMING_THRESHOLD,
+    SIM_SIGNATURE,
+    SIM_USE_INDEX,
+)
+from hamming import bit_count_bound, bit_counts
+from hash_index import index_path, load_index
+from hash_corpus import corpus_hashes
+from hash_store import load_video_hashes, store_hashes
+from prehash import find_copy
 from cluster import main as cluster_main
 from canonical import main as canon_main
+from db import prepare, reader, writer
+
+WORKERS = int(os.environ.get("ADHOC_WORKERS", 2))  # ad-hoc videos run at once
+KEEP = int(os.environ.get("ADHOC_KEEP", 1000))  # finished jobs kept for polling
 
 
 def ensure_video_record(conn, path):
@@ -25,145 +45,160 @@ def ensure_video_record(conn, path):
     return vid
 
 
-def process_single_video(db_path, path):
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    vid = ensure_video_record(conn, path)
-    cur = conn.cursor()
+def process_single_video(db_path, path, engine=None, use_index=None):
+    # a write path like the stages: the schema has to be current first
+    prepare(db_path)
+    scorer = get_scorer(engine)
+    use_index = SIM_USE_INDEX if use_index is None else use_index
+    # the write lock is only taken for the writes themselves, never around
+    # ffprobe, decoding or scoring
+    with writer(db_path) as conn:
+        vid = ensure_video_record(conn, path)
+        size_bytes, mtime = conn.execute(
+            "SELECT size_bytes, mtime FROM videos WHERE video_id = ?", (vid,)
+        ).fetchone()
 
-    meta = probe(path)
-    vstream = next(s for s in meta["streams"] if s["codec_type"] == "video")
-    duration = float(meta["format"].get("duration", 0.0))
-    width = int(vstream.get("width", 0))
-    height = int(vstream.get("height", 0))
-    codec = vstream.get("codec_name")
-    bitrate = int(meta["format"].get("bit_rate", 0) or 0)
-    fps_str = vstream.get("r_frame_rate", "0/1")
-    num, den = map(int, fps_str.split("/"))
-    fps = num / den if den else 0
-    frame_count = int(vstream.get("nb_frames") or 0)
+    # a byte-identical copy of a scored video takes over its metadata, hashes
+    # and pairs, and skips ffprobe, decoding and scoring
+    if vid in find_copy(db_path, vid, path, size_bytes, mtime)["pairs"]:
+        cluster_main(db_path)
+        canon_main(db_path)
+        return cluster_result(db_path, vid)
 
-    cur.execute(
-        """
-        INSERT OR REPLACE INTO video_metadata
-        (video_id, duration, frame_count, width, height, codec, bitrate, container, fps)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """,
-        (
-            vid,
-            duration,
-            frame_count,
-            width,
-            height,
-            codec,
-            bitrate,
-            meta["format"].get("format_name"),
-            fps,
-        ),
-    )
-    conn.commit()
+    fields = parse_probe(probe(path))
+    duration, frame_count, _, height = fields[:4]
+    with writer(db_path) as conn:
+        cur = conn.cursor()
+        store_metadata(cur, vid, fields)
+        record_probe(cur, vid, size_bytes, mtime)
 
-    _, hashes = compute_video_hashes((vid, path))
-    cur.executemany(
-        """
-        INSERT OR REPLACE INTO video_hashes(video_id, frame_index, phash)
-        VALUES (?, ?, ?)
-    """,
-        [(vid, idx, ph) for idx, ph in hashes],
-    )
-    conn.commit()
+    _, hashes, stats = hash_video((vid, path))
+    if hashes is None:
+        raise RuntimeError(stats)
+    if use_index:
+        # synced before this video's rows land, so it is only added once below
+        with reader(db_path) as conn:
+            index = load_index(conn.cursor(), index_path(db_path))
+    with writer(db_path) as conn:
+        store_hashes(conn.cursor(), vid, hashes)
+        if stats is not None:
+            store_samples(conn.cursor(), vid, stats)
 
-    cur.execute(
-        """
-        SELECT video_id, duration, frame_count, height
-        FROM video_metadata
-        WHERE video_id != ?
-    """,
-        (vid,),
-    )
-    others = cur.fetchall()
+    with reader(db_path, sqlite3.Row) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT video_id, duration, frame_count, height
+            FROM video_metadata
+            WHERE video_id != ?
+        """,
+            (vid,),
+        )
+        others = cur.fetchall()
+
+        this_hashes = load_video_hashes(cur, vid)
+
+        if use_index:
+            # the index is shared by every ad-hoc thread of the process
+            with index.lock:
+                index.remove([vid])
+                index.add([(vid, this_hashes)])
+                index.save(index_path(db_path))
+                matches = index.query(this_hashes)
+            others = [row for row in others if row["video_id"] in matches]
 
-    cur.execute(
-        """
-        SELECT frame_index, phash FROM video_hashes
-        WHERE video_id = ? ORDER BY frame_index
-    """,
-        (vid,),
-    )
-    this_hashes = [r[1] for r in cur.fetchall()]
-
-    for row in others:
-        other_id = row["video_id"]
-        meta_other = {
-            "duration": row["duration"],
-            "frame_count": row["frame_count"],
-            "height": row["height"],
-        }
         meta_this = {
             "duration": duration,
             "frame_count": frame_count,
             "height": height,
         }
-        if not passes_blocking(meta_this, meta_other):
-            continue
+        blocked = [
+            row["video_id"]
+            for row in others
+            if passes_blocking(
+                meta_this,
+                {
+                    "duration": row["duration"],
+                    "frame_count": row["frame_count"],
+                    "height": row["height"],
+                },
+            )
+        ]
 
-        cur.execute(
-            """
-            SELECT phash FROM video_hashes
-            WHERE video_id = ? ORDER BY frame_index
-        """,
-            (other_id,),
+        # candidates' hashes straight from the shared memory-mapped corpus,
+        # the few hashed since its last refresh from the database
+        candidates = corpus_hashes(cur, db_path, blocked)
+
+    others = list(candidates)
+    if SIM_SIGNATURE and others:
+        # the per-bit frame-count bound, as in the batch and stream scorers
+        bound = bit_count_bound(
+            bit_counts(this_hashes),
+            len(this_hashes),
+            np.array([candidates[other][1] for other in others]),
+            np.array([len(candidates[other][0]) for other in others]),
         )
-        other_hashes = [r[0] for r in cur.fetchall()]
-        score = sliding_window_score(this_hashes, other_hashes)
+        others = [other for other, b in zip(others, bound) if b <= HAMMING_THRESHOLD]
+    this_input = as_scorer_input(scorer, this_hashes)
+    rows = []
+    for other_id in others:
+        other = as_scorer_input(scorer, candidates[other_id][0])
+        score = scorer(this_input, other, HAMMING_THRESHOLD)
         if score <= HAMMING_THRESHOLD:
-            cur.execute(
-                """
-                INSERT OR REPLACE INTO video_similarity(video_id_a, video_id_b, avg_hamming)
-                VALUES (?, ?, ?)
-            """,
-                (vid, other_id, score),
-            )
+            rows.append((vid, other_id, score))
 
-    conn.commit()
+    with writer(db_path) as conn:
+        cur = conn.cursor()
+        cur.executemany(
+            """
+            INSERT OR REPLACE INTO video_similarity(video_id_a, video_id_b, avg_hamming)
+            VALUES (?, ?, ?)
+        """,
+            rows,
+        )
+        # this video is now scored against everything, so incremental runs skip it
+        record_scored(cur, {vid: (size_bytes, mtime, len(this_hashes))})
 
     cluster_main(db_path)
     canon_main(db_path)
+    return cluster_result(db_path, vid)
 
-    cur.execute(
-        """
-        SELECT cluster_id FROM duplicate_clusters WHERE video_id = ?
-    """,
-        (vid,),
-    )
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        return {"video_id": vid, "cluster": None}
 
-    cid = row["cluster_id"]
-    cur.execute(
-        """
-        SELECT canonical_video_id FROM canonical_videos WHERE cluster_id = ?
-    """,
-        (cid,),
-    )
-    canonical = cur.fetchone()["canonical_video_id"]
+def cluster_result(db_path, vid):
+    with reader(db_path, sqlite3.Row) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT cluster_id FROM duplicate_clusters WHERE video_id = ?
+        """,
+            (vid,),
+        )
+        row = cur.fetchone()
+        if not row:
+            return {"video_id": vid, "cluster": None}
 
-    cur.execute(
-        """
-        SELECT dc.video_id, df.is_duplicate, v.path,
-               m.width, m.height, m.bitrate, m.codec, m.duration
-        FROM duplicate_clusters dc
-        JOIN videos v ON dc.video_id = v.video_id
-        JOIN video_metadata m ON v.video_id = m.video_id
-        LEFT JOIN duplicate_flags df ON dc.video_id = df.video_id
-        WHERE dc.cluster_id = ?
-    """,
-        (cid,),
-    )
-    members = [dict(r) for r in cur.fetchall()]
-    conn.close()
+        cid = row["cluster_id"]
+        cur.execute(
+            """
+            SELECT canonical_video_id FROM canonical_videos WHERE cluster_id = ?
+        """,
+            (cid,),
+        )
+        canonical = cur.fetchone()["canonical_video_id"]
+
+        cur.execute(
+            """
+            SELECT dc.video_id, df.is_duplicate, v.path,
+                   m.width, m.height, m.bitrate, m.codec, m.duration
+            FROM duplicate_clusters dc
+            JOIN videos v ON dc.video_id = v.video_id
+            JOIN video_metadata m ON v.video_id = m.video_id
+            LEFT JOIN duplicate_flags df ON dc.video_id = df.video_id
+            WHERE dc.cluster_id = ?
+        """,
+            (cid,),
+        )
+        members = [dict(r) for r in cur.fetchall()]
 
     return {
         "video_id": vid,
@@ -171,3 +206,68 @@ def process_single_video(db_path, path):
         "canonical": canonical,
         "members": members,
     }
+
+
+class AdhocJobs:
+    # Ad-hoc requests as background jobs on a bounded thread pool, so a
+    # request only hands out a job id. Submitting a path that is already
+    # queued or running returns that job instead of starting a second one.
+    def __init__(self, db_path, workers=None, keep=None):
+        self.db_path = db_path
+        self.keep = keep or KEEP
+        self._pool = ThreadPoolExecutor(workers or WORKERS, thread_name_prefix="adhoc")
+        self._jobs = OrderedDict()  # job id -> job, oldest first
+        self._active = {}  # path -> id of its queued or running job
+        self._lock = threading.Lock()
+
+    def submit(self, path):
+        path = os.path.normpath(path)
+        with self._lock:
+            job_id = self._active.get(path)
+            if job_id is not None:
+                return dict(self._jobs[job_id], coalesced=True)
+            job = {
+                "job_id": uuid.uuid4().hex,
+                "path": path,
+                "status": "queued",
+                "submitted_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "result": None,
+                "error": None,
+            }
+            self._jobs[job["job_id"]] = job
+            self._active[path] = job["job_id"]
+            self._trim()
+            snapshot = dict(job, coalesced=False)
+        self._pool.submit(self._run, job)
+        return snapshot
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def _run(self, job):
+        with self._lock:
+            job["status"], job["started_at"] = "running", time.time()
+        result, error = None, None
+        try:
+            result = process_single_video(self.db_path, job["path"])
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        with self._lock:
+            job["status"] = "failed" if error else "done"
+            job["result"], job["error"] = result, error
+            job["finished_at"] = time.time()
+            self._active.pop(job["path"], None)
+
+    def _trim(self):
+        # forget the oldest finished jobs beyond `keep`
+        extra = len(self._jobs) - self.keep
+        for job_id in list(self._jobs):
+            if extra <= 0:
+                break
+            if self._jobs[job_id]["finished_at"] is not None:
+                del self._jobs[job_id]
+                extra -= 1
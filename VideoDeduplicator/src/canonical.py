@@ -1,4 +1,6 @@
-import sqlite3
+from collections import defaultdict
+
+from db import writer
 
 CODEC_SCORE = {
     "hevc": 3,
@@ -23,58 +25,78 @@ def score(meta):
 
 
 def main(db_path):
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
-
-    cur.execute("DELETE FROM canonical_videos")
-    cur.execute("DELETE FROM duplicate_flags")
+    # Picks a canonical for each cluster in canonical_dirty and empties it;
+    # -> number of clusters done. The first DELETE takes the write lock, so
+    # the dirty set can't grow between the statements below.
+    with writer(db_path) as conn:
+        cur = conn.cursor()
 
-    cur.execute("SELECT DISTINCT cluster_id FROM duplicate_clusters")
-    clusters = [r[0] for r in cur.fetchall()]
+        # flags of the old selection: the videos that pointed at the old
+        # canonicals (some may have left the cluster) and the current members
+        cur.execute("""
+            DELETE FROM duplicate_flags WHERE canonical_of IN (
+                SELECT canonical_video_id FROM canonical_videos
+                WHERE cluster_id IN (SELECT cluster_id FROM canonical_dirty)
+            )
+        """)
+        cur.execute("""
+            DELETE FROM duplicate_flags WHERE video_id IN (
+                SELECT c.video_id FROM canonical_dirty d
+                JOIN duplicate_clusters c ON c.cluster_id = d.cluster_id
+            )
+        """)
+        cur.execute("""
+            DELETE FROM canonical_videos
+            WHERE cluster_id IN (SELECT cluster_id FROM canonical_dirty)
+        """)
 
-    for cid in clusters:
-        cur.execute(
-            """
-            SELECT v.video_id, m.width, m.height, m.bitrate, m.codec, m.container
-            FROM duplicate_clusters c
+        # metadata of every member of every dirty cluster in one pass; a
+        # cluster that no longer exists has no rows and is just dropped
+        cur.execute("""
+            SELECT c.cluster_id, v.video_id, m.video_id,
+                   m.width, m.height, m.bitrate, m.codec, m.container
+            FROM canonical_dirty d
+            JOIN duplicate_clusters c ON c.cluster_id = d.cluster_id
             JOIN videos v ON c.video_id = v.video_id
-            JOIN video_metadata m ON v.video_id = m.video_id
-            WHERE c.cluster_id = ?
-        """,
-            (cid,),
-        )
-        rows = cur.fetchall()
-        best_vid, best_score = None, -1
-        metas = {}
-        for vid, w, h, br, codec, container in rows:
-            meta = {
-                "width": w,
-                "height": h,
-                "bitrate": br,
-                "codec": codec,
-                "container": container,
-            }
-            metas[vid] = meta
-            s = score(meta)
-            if s > best_score:
-                best_score, best_vid = s, vid
+            LEFT JOIN video_metadata m ON v.video_id = m.video_id
+            ORDER BY c.cluster_id, c.video_id
+        """)
+        best = {}  # cluster id -> (score, video id); None without metadata
+        members = defaultdict(list)
+        for cid, vid, probed, w, h, br, codec, container in cur.fetchall():
+            best.setdefault(cid, (-1, None))
+            if probed is None:
+                continue
+            members[cid].append(vid)
+            s = score(
+                {
+                    "width": w,
+                    "height": h,
+                    "bitrate": br,
+                    "codec": codec,
+                    "container": container,
+                }
+            )
+            if s > best[cid][0]:
+                best[cid] = (s, vid)
 
-        cur.execute(
+        cur.executemany(
             """
             INSERT OR REPLACE INTO canonical_videos(cluster_id, canonical_video_id)
             VALUES (?, ?)
         """,
-            (cid, best_vid),
+            [(cid, vid) for cid, (_, vid) in best.items()],
         )
-
-        for vid in metas.keys():
-            cur.execute(
-                """
-                INSERT OR REPLACE INTO duplicate_flags(video_id, is_duplicate, canonical_of)
-                VALUES (?, ?, ?)
-            """,
-                (vid, 0 if vid == best_vid else 1, best_vid),
-            )
-
-    conn.commit()
-    conn.close()
+        cur.executemany(
+            """
+            INSERT OR REPLACE INTO duplicate_flags(video_id, is_duplicate, canonical_of)
+            VALUES (?, ?, ?)
+        """,
+            [
+                (vid, 0 if vid == best[cid][1] else 1, best[cid][1])
+                for cid, vids in members.items()
+                for vid in vids
+            ],
+        )
+        cur.execute("DELETE FROM canonical_dirty")
+    return len(best)
@@ -1,50 +1,268 @@
-import sqlite3
-from collections import defaultdict, deque
+from collections import Counter, defaultdict
 
+from db import writer
+from hash_store import IN_BATCH
 
-def build_graph(cur, threshold):
-    graph = defaultdict(set)
-    cur.execute("SELECT video_id_a, video_id_b, avg_hamming FROM video_similarity")
-    for a, b, d in cur.fetchall():
-        if d <= threshold:
-            graph[a].add(b)
-            graph[b].add(a)
-    return graph
+# Clusters are the connected components of the pairs within `threshold`, kept
+# in a disjoint-set forest (cluster_nodes) between runs. A run reads the pairs
+# written since the last one from similarity_changes: a new pair is a union;
+# a deleted pair (or one rewritten above the threshold) can split a cluster,
+# so the clusters it touched are rebuilt from their current pairs. Only the
+# clusters that changed are rewritten, and a cluster keeps its id.
 
 
-def connected_components(graph):
-    visited = set()
-    for node in graph:
-        if node in visited:
-            continue
-        comp = []
-        q = deque([node])
-        visited.add(node)
-        while q:
-            v = q.popleft()
-            comp.append(v)
-            for nb in graph[v]:
-                if nb not in visited:
-                    visited.add(nb)
-                    q.append(nb)
-        yield comp
+class DisjointSet:
+    # Union by rank with path halving over video ids. With a cursor, nodes are
+    # read from cluster_nodes on first use, so a run only reads what it reaches.
+    def __init__(self, cur=None):
+        self.cur = cur
+        self.parent, self.rank, self.cluster = {}, {}, {}
+        self.touched = set()  # nodes whose row has to be written back
 
+    def _load(self, vid):
+        if vid in self.parent:
+            return
+        row = None
+        if self.cur is not None:
+            row = self.cur.execute(
+                "SELECT parent, rank, cluster_id FROM cluster_nodes WHERE video_id = ?",
+                (vid,),
+            ).fetchone()
+        self.parent[vid], self.rank[vid], self.cluster[vid] = row or (vid, 0, None)
 
-def main(db_path, threshold=12.0):
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
-    graph = build_graph(cur, threshold)
-    cluster_id = 1
-    cur.execute("DELETE FROM duplicate_clusters")
-    for comp in connected_components(graph):
-        for vid in comp:
+    def find(self, vid):
+        self._load(vid)
+        while self.parent[vid] != vid:
+            parent = self.parent[vid]
+            self._load(parent)
+            grandparent = self.parent[parent]
+            if grandparent != parent:
+                self.parent[vid] = grandparent
+                self.touched.add(vid)
+                self._load(grandparent)
+            vid = grandparent
+        return vid
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra == rb:
+            return ra
+        if self.rank[ra] < self.rank[rb]:
+            ra, rb = rb, ra
+        self.parent[rb] = ra
+        if self.rank[ra] == self.rank[rb]:
+            self.rank[ra] += 1
+        self.touched.update((ra, rb))
+        return ra
+
+    def reset(self, vid):
+        # back to a singleton, before its old cluster is rebuilt
+        self._load(vid)
+        self.parent[vid], self.rank[vid], self.cluster[vid] = vid, 0, None
+        self.touched.add(vid)
+
+
+def assign_ids(groups, old_cid, next_id):
+    # Largest groups first, each takes the old id most of its members had
+    # (lowest on ties) if no larger group took it already; the rest get new
+    # ids. Merges keep the id of the bigger side, splits the id of the bigger part.
+    ids, taken = {}, set()
+    for root, members in sorted(groups.items(), key=lambda g: (-len(g[1]), g[0])):
+        counts = Counter(old_cid[v] for v in members if old_cid.get(v) is not None)
+        ranked = sorted(counts.items(), key=lambda kv: (-kv[1], kv[0]))
+        cid = next((cid for cid, _ in ranked if cid not in taken), None)
+        if cid is None:
+            cid, next_id = next_id, next_id + 1
+        taken.add(cid)
+        ids[root] = cid
+    return ids, next_id
+
+
+def members_of(cur, cid):
+    cur.execute("SELECT video_id FROM duplicate_clusters WHERE cluster_id = ?", (cid,))
+    return [r[0] for r in cur.fetchall()]
+
+
+def edges_of(cur, vids, threshold):
+    # pairs within threshold with either side in vids
+    edges = []
+    vids = sorted(vids)
+    for column in ("video_id_a", "video_id_b"):
+        for i in range(0, len(vids), IN_BATCH):
+            batch = vids[i : i + IN_BATCH]
             cur.execute(
-                """
-                INSERT OR REPLACE INTO duplicate_clusters(cluster_id, video_id)
-                VALUES (?, ?)
+                f"""
+                SELECT video_id_a, video_id_b FROM video_similarity
+                WHERE {column} IN ({",".join("?" * len(batch))}) AND avg_hamming <= ?
             """,
-                (cluster_id, vid),
+                (*batch, threshold),
             )
-        cluster_id += 1
-    conn.commit()
-    conn.close()
+            edges += cur.fetchall()
+    return edges
+
+
+def write_clusters(cur, forest, groups, ids, nodes, changed):
+    # groups: root -> members of every cluster (two or more videos) the run
+    # touched; the `changed` roots get their duplicate_clusters rows, `nodes`
+    # their cluster_nodes rows, or leave the forest if they are alone now
+    cur.executemany(
+        "INSERT INTO duplicate_clusters(cluster_id, video_id) VALUES (?, ?)",
+        [(ids[root], vid) for root in changed for vid in groups[root]],
+    )
+    rows, gone = [], []
+    for vid in nodes:
+        root = forest.find(vid)
+        if root not in groups:
+            gone.append((vid,))
+            continue
+        cid = ids[root] if vid == root else None
+        rows.append((vid, forest.parent[vid], forest.rank[vid], cid))
+    cur.executemany(
+        """
+        INSERT OR REPLACE INTO cluster_nodes(video_id, parent, rank, cluster_id)
+        VALUES (?, ?, ?, ?)
+    """,
+        rows,
+    )
+    cur.executemany("DELETE FROM cluster_nodes WHERE video_id = ?", gone)
+
+
+def rebuild(cur, threshold, next_id):
+    # every cluster from scratch, keeping the ids duplicate_clusters had
+    forest = DisjointSet()
+    cur.execute(
+        "SELECT video_id_a, video_id_b FROM video_similarity WHERE avg_hamming <= ?",
+        (threshold,),
+    )
+    for a, b in cur.fetchall():
+        forest.union(a, b)
+    groups = defaultdict(list)
+    for vid in list(forest.parent):
+        groups[forest.find(vid)].append(vid)
+    groups = {root: members for root, members in groups.items() if len(members) > 1}
+
+    cur.execute("SELECT video_id, cluster_id FROM duplicate_clusters")
+    old_cid = dict(cur.fetchall())
+    next_id = max(next_id, max(old_cid.values(), default=0) + 1)
+    ids, next_id = assign_ids(groups, old_cid, next_id)
+    cur.execute("DELETE FROM duplicate_clusters")
+    cur.execute("DELETE FROM cluster_nodes")
+    write_clusters(cur, forest, groups, ids, list(forest.parent), groups)
+    return set(old_cid.values()) | set(ids.values()), next_id
+
+
+def update(cur, threshold, last, next_id):
+    # apply the logged pair changes up to seq `last` to the stored forest
+    cur.execute(
+        """
+        SELECT video_id_a, video_id_b, avg_hamming FROM similarity_changes
+        WHERE seq <= ? ORDER BY seq
+    """,
+        (last,),
+    )
+    latest, dirty = {}, set()
+    for a, b, score in cur.fetchall():
+        latest[a, b] = score
+        if score is None or score > threshold:
+            dirty.update((a, b))
+    # the pair's last logged score is its current one
+    added = [pair for pair, s in latest.items() if s is not None and s <= threshold]
+
+    forest = DisjointSet(cur)
+    old_cid = {vid: forest.cluster[forest.find(vid)] for vid in dirty}
+    # old id -> duplicate_clusters rows, for every cluster this run touches
+    # (a purged video is in its cluster's forest but no longer in its rows)
+    members = {}
+    split = {cid for cid in old_cid.values() if cid is not None}
+    for cid in split:
+        members[cid] = set(members_of(cur, cid))
+    rebuilt = set().union(*members.values()) | dirty
+    edges = edges_of(cur, rebuilt, threshold) + added
+
+    # clusters as they were, for everything the new edges reach
+    for vid in {v for pair in edges for v in pair} - old_cid.keys():
+        old_cid[vid] = forest.cluster[forest.find(vid)]
+    for cid in set(old_cid.values()) - members.keys() - {None}:
+        members[cid] = set(members_of(cur, cid))
+    for cid, vids in members.items():
+        for vid in vids:
+            old_cid.setdefault(vid, cid)
+
+    for vid in rebuilt:
+        forest.reset(vid)
+    for a, b in edges:
+        forest.union(a, b)
+
+    groups = defaultdict(set)
+    for vid in rebuilt:
+        groups[forest.find(vid)].add(vid)
+    for cid, vids in members.items():
+        if cid not in split:
+            # intact clusters moved as a whole; one find covers them
+            groups[forest.find(next(iter(vids)))].update(vids)
+    for vid, cid in old_cid.items():
+        if cid is None:
+            groups[forest.find(vid)].add(vid)
+    groups = {root: vids for root, vids in groups.items() if len(vids) > 1}
+    ids, next_id = assign_ids(groups, old_cid, next_id)
+
+    # a group that is exactly one old cluster under its old id stays as it is
+    unchanged = {
+        root
+        for root, vids in groups.items()
+        if ids[root] in members and vids == members[ids[root]]
+    }
+    stale = set(members) - {ids[root] for root in unchanged}
+    cur.executemany(
+        "DELETE FROM duplicate_clusters WHERE cluster_id = ?", [(c,) for c in stale]
+    )
+    changed = [root for root in groups if root not in unchanged]
+    # unchanged clusters can still have nodes to write (path halving, resets)
+    nodes = set(forest.touched)
+    while True:
+        for vid in list(nodes):
+            forest.find(vid)
+        if forest.touched <= nodes:
+            break
+        nodes |= forest.touched
+    write_clusters(cur, forest, groups, ids, nodes, changed)
+    # same rows, but a member was purged from them since the last run
+    shrunk = {
+        old_cid[vid]
+        for vid in dirty
+        if old_cid[vid] is not None and ids.get(forest.find(vid)) != old_cid[vid]
+    }
+    return stale | shrunk | {ids[root] for root in changed}, next_id
+
+
+def main(db_path, threshold=12.0):
+    # -> ids of the clusters that were created, changed or removed
+    with writer(db_path) as conn:
+        cur = conn.cursor()
+        state = cur.execute(
+            "SELECT threshold, next_cluster_id FROM cluster_state"
+        ).fetchone()
+        last = cur.execute("SELECT MAX(seq) FROM similarity_changes").fetchone()[0]
+        if state is not None and state[0] == threshold and last is None:
+            return set()
+        if state is None or state[0] != threshold:
+            # first run, or a new threshold: nothing to build on
+            changed, next_id = rebuild(cur, threshold, state[1] if state else 1)
+        else:
+            changed, next_id = update(cur, threshold, last, state[1])
+        if last is not None:
+            cur.execute("DELETE FROM similarity_changes WHERE seq <= ?", (last,))
+        # canonical.py picks these up
+        cur.executemany(
+            "INSERT OR IGNORE INTO canonical_dirty(cluster_id) VALUES (?)",
+            [(cid,) for cid in changed],
+        )
+        cur.execute(
+            """
+            INSERT OR REPLACE INTO cluster_state(id, threshold, next_cluster_id)
+            VALUES (1, ?, ?)
+        """,
+            (threshold, next_id),
+        )
+    print(f"cluster: {len(changed)} clusters changed")
+    return changed
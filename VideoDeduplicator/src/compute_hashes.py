@@ -1,62 +1,328 @@
-import cv2, sqlite3, imagehash, os
-from PIL import Image
+import cv2, os, subprocess, time
+import numpy as np
 from multiprocessing import Pool, cpu_count
 
+from db import reader, writer
+from hash_corpus import corpus_path, refresh_corpus
+from hash_store import hash_table, store_hashes
+from jobs import claim, enqueue, finish, unfinished
+from phash import IMG_SIZE, gray32, phash_pixels
+from prehash import copy_exact
+
 N_FRAMES = 32
+# count: N_FRAMES spread evenly over the video, whatever its length
+# interval: one frame every HASH_INTERVAL seconds of stream time, so a trimmed
+# or padded copy lines up with the original at a whole-sample offset
+HASH_MODE = os.environ.get("HASH_MODE", "count")
+HASH_INTERVAL = float(os.environ.get("HASH_INTERVAL", 2.0))
 WORKERS = int(os.environ.get("HASH_WORKERS", cpu_count()))
+SAMPLER = os.environ.get("HASH_SAMPLER", "auto")  # auto | seek | grab
+BACKEND = os.environ.get("HASH_BACKEND", "opencv")  # opencv | ffmpeg
+# videos claimed per pool process at a time; results are committed per claim
+CLAIM_PER_WORKER = int(os.environ.get("HASH_CLAIM_PER_WORKER", 4))
+
+# keyframe flags of the first packets of the video stream, to estimate the GOP
+GOP_PROBE = [
+    "ffprobe",
+    "-v",
+    "quiet",
+    "-select_streams",
+    "v:0",
+    "-show_entries",
+    "packet=flags",
+    "-read_intervals",
+    "%+#600",
+    "-of",
+    "csv=p=0",
+]
+
+
+def probe_gop(path):
+    try:
+        out = subprocess.check_output(GOP_PROBE + [path], text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    flags = [line for line in out.splitlines() if line]
+    keys = [i for i, f in enumerate(flags) if f.startswith("K")]
+    if not keys:
+        return None
+    if len(keys) == 1:
+        return float(len(flags))  # at least this long
+    return (keys[-1] - keys[0]) / (len(keys) - 1)
+
+
+def choose_sampler(path, step):
+    # A seek decodes from the previous keyframe, about gop / 2 frames per sample;
+    # reading straight through decodes `step` frames per sample.
+    if SAMPLER != "auto":
+        return SAMPLER, None
+    gop = probe_gop(path)
+    if gop is None:
+        return "seek", None
+    return ("grab" if step <= gop / 2 else "seek"), gop
 
 
-def compute_video_hashes(args):
+def sampling():
+    # (mode, interval, backend) recorded with a video's hashes; hashes are only
+    # comparable between videos sampled and decoded the same way (the ffmpeg
+    # backend's scaling and gray conversion differ from OpenCV's in a few bits)
+    return HASH_MODE, HASH_INTERVAL if HASH_MODE == "interval" else None, BACKEND
+
+
+def sample_positions(total, fps):
+    # frame numbers to hash, or None if interval mode has no frame rate to go on
+    if HASH_MODE != "interval":
+        return range(0, total, max(total // N_FRAMES, 1))
+    if fps <= 0:
+        return None
+    # nearest frame to each multiple of the interval, rounding like ffmpeg
+    step = HASH_INTERVAL * fps
+    return sorted({int(k * step + 0.5) for k in range(int((total - 1) / step) + 1)})
+
+
+def read_frames_seek(cap, positions):
+    for i in positions:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, i)
+        ok, frame = cap.read()
+        if ok:
+            yield i, frame
+
+
+def read_frames_grab(cap, positions):
+    # grab() every frame in order, retrieve() (colour conversion) only samples
+    wanted = set(positions)
+    for i in range(max(positions) + 1):
+        if not cap.grab():
+            break
+        if i in wanted:
+            ok, frame = cap.retrieve()
+            if ok:
+                yield i, frame
+
+
+SAMPLERS = {"seek": read_frames_seek, "grab": read_frames_grab}
+
+
+def ffmpeg_gray_frames(path, positions, step):
+    # One ffmpeg process decodes the video, keeps the sampled frame numbers and
+    # scales them down to 32x32 gray before they leave ffmpeg. Frame n is kept
+    # if it is the nearest frame to a multiple of `step` frames, which for an
+    # integer step is every step-th frame.
+    vf = (
+        f"select='eq(n\\,round(round(n/{step})*{step}))',"
+        f"scale={IMG_SIZE}:{IMG_SIZE}:flags=lanczos,format=gray"
+    )
+    cmd = [
+        "ffmpeg",
+        "-v",
+        "error",
+        "-nostdin",
+        "-i",
+        path,
+        "-map",
+        "0:v:0",
+        "-vf",
+        vf,
+        "-fps_mode",
+        "passthrough",
+        "-frames:v",
+        str(len(positions)),
+        "-f",
+        "rawvideo",
+        "pipe:1",
+    ]
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    n = len(out) // (IMG_SIZE * IMG_SIZE)
+    return np.frombuffer(out, dtype=np.uint8, count=n * IMG_SIZE * IMG_SIZE).reshape(
+        n, IMG_SIZE, IMG_SIZE
+    )
+
+
+def hash_video(args):
+    # -> (video_id, hashes, stats), or (video_id, None, error) if the video
+    # couldn't be read, so one bad file doesn't take its batch down with it
     video_id, path = args
+    try:
+        return hash_frames(video_id, path)
+    except Exception as e:
+        print(f"hash: failed for {path}: {e!r}")
+        return video_id, None, f"{type(e).__name__}: {e}"
+
+
+def hash_frames(video_id, path):
+    t0 = time.perf_counter()
     cap = cv2.VideoCapture(path)
     total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    if total <= 0:
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    positions = sample_positions(total, fps) if total > 0 else None
+    if not positions:
         cap.release()
-        return video_id, []
+        return video_id, [], None
 
-    step = max(total // N_FRAMES, 1)
-    hashes = []
-    frame_idx = 0
-    for i in range(0, total, step):
-        cap.set(cv2.CAP_PROP_POS_FRAMES, i)
-        ok, frame = cap.read()
-        if not ok:
-            continue
-        pil = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-        h = imagehash.phash(pil)
-        hashes.append((frame_idx, int(str(h), 16)))
-        frame_idx += 1
-    cap.release()
-    return video_id, hashes
+    step = positions.step if HASH_MODE != "interval" else HASH_INTERVAL * fps
+    if BACKEND == "ffmpeg":
+        cap.release()
+        sampler, gop = "ffmpeg", None
+        pixels = ffmpeg_gray_frames(path, positions, step)
+        indices = positions[: len(pixels)]
+    else:
+        sampler, gop = choose_sampler(path, step)
+        # frames are shrunk as they are read; only the 32x32 planes are kept
+        pixels, indices = [], []
+        for i, frame in SAMPLERS[sampler](cap, positions):
+            pixels.append(gray32(frame))
+            indices.append(i)
+        cap.release()
+    # one batched DCT for every sampled frame of the video
+    hashes = (
+        list(enumerate(int(h) for h in phash_pixels(pixels))) if len(pixels) else []
+    )
 
+    wall_time = time.perf_counter() - t0
+    mode, interval, backend = sampling()
+    stats = {
+        "mode": mode,
+        "interval": interval,
+        "backend": backend,
+        # stream time of every hashed frame, in seconds
+        "times": [i / fps for i in indices] if fps > 0 else None,
+        "sampler": sampler,
+        "gop": gop,
+        "frames": len(hashes),
+        "wall_time": wall_time,
+        "frames_per_sec": len(hashes) / wall_time if wall_time else 0.0,
+    }
+    return video_id, hashes, stats
 
-def main(db_path):
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
-    cur.execute("""
+
+def store_timing(cur, video_id, stats):
+    cur.execute(
+        """
+        INSERT OR REPLACE INTO hash_timings
+        (video_id, sampler, gop, frames, wall_time, frames_per_sec)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """,
+        (
+            video_id,
+            stats["sampler"],
+            stats["gop"],
+            stats["frames"],
+            stats["wall_time"],
+            stats["frames_per_sec"],
+        ),
+    )
+
+
+def store_samples(cur, video_id, stats):
+    times = stats["times"]
+    cur.execute(
+        """
+        INSERT OR REPLACE INTO hash_samples(video_id, mode, interval, backend, times)
+        VALUES (?, ?, ?, ?, ?)
+    """,
+        (
+            video_id,
+            stats["mode"],
+            stats["interval"],
+            stats["backend"],
+            None if times is None else np.asarray(times, dtype="<f8").tobytes(),
+        ),
+    )
+
+
+def drop_resampled(cur):
+    # Hashes sampled with another HASH_MODE / HASH_INTERVAL, or decoded by
+    # another HASH_BACKEND, don't line up with new ones: they go, with the
+    # video's pairs and similarity state, so the video is hashed and scored
+    # again. Videos hashed before hash_samples existed were sampled in count
+    # mode and decoded by OpenCV.
+    mode, interval, backend = sampling()
+    cur.execute(
+        f"""
+        SELECT v.video_id FROM videos v
+        LEFT JOIN hash_samples s ON s.video_id = v.video_id
+        WHERE EXISTS (SELECT 1 FROM {hash_table()} h WHERE h.video_id = v.video_id)
+          AND (COALESCE(s.mode, 'count') != ? OR s.interval IS NOT ?
+               OR COALESCE(s.backend, 'opencv') != ?)
+    """,
+        (mode, interval, backend),
+    )
+    rows = cur.fetchall()
+    for table in (hash_table(), "hash_samples", "hash_timings", "similarity_state"):
+        cur.executemany(f"DELETE FROM {table} WHERE video_id = ?", rows)
+    cur.executemany(
+        "DELETE FROM video_similarity WHERE video_id_a = ? OR video_id_b = ?",
+        [(vid, vid) for vid, in rows],
+    )
+    if rows:
+        print(f"hash: {len(rows)} videos sampled differently, hashing them again")
+
+
+def pending_hash_jobs(cur):
+    drop_resampled(cur)
+    cur.execute(f"""
         SELECT v.video_id, v.path
         FROM videos v
-        LEFT JOIN video_hashes h ON v.video_id = h.video_id
+        LEFT JOIN {hash_table()} h ON v.video_id = h.video_id
         WHERE h.video_id IS NULL
+          -- exact copies get their source's hashes (prehash.copy_exact)
+          AND v.video_id NOT IN (
+              SELECT video_id FROM content_hashes WHERE copy_of IS NOT NULL
+          )
     """)
-    jobs = cur.fetchall()
-    conn.close()
-
-    if not jobs:
-        return
-
-    with Pool(WORKERS) as pool:
-        for video_id, hashes in pool.imap_unordered(compute_video_hashes, jobs):
-            if not hashes:
-                continue
-            conn = sqlite3.connect(db_path)
-            cur = conn.cursor()
-            cur.executemany(
-                """
-                INSERT OR REPLACE INTO video_hashes(video_id, frame_index, phash)
-                VALUES (?, ?, ?)
-            """,
-                [(video_id, idx, ph) for idx, ph in hashes],
-            )
-            conn.commit()
-            conn.close()
+    return cur.fetchall()
+
+
+def main(db_path):
+    with writer(db_path) as conn:
+        cur = conn.cursor()
+        jobs = pending_hash_jobs(cur)
+        enqueue(cur, "hash", [vid for vid, _ in jobs])
+        # every job is in pipeline_jobs now; videos whose hashing failed for
+        # good are still in `jobs`, but there is nothing left to claim for them
+        idle = not unfinished(cur, "hash")
+
+    stored = set()
+    if not idle:
+        with Pool(WORKERS) as pool:
+            while True:
+                with writer(db_path) as conn:
+                    vids = claim(conn, "hash", WORKERS * CLAIM_PER_WORKER)
+                    marks = ",".join("?" * len(vids))
+                    batch = conn.execute(
+                        "SELECT video_id, path FROM videos"
+                        f" WHERE video_id IN ({marks})",
+                        vids,
+                    ).fetchall()
+                if not vids:
+                    break
+                # decoding runs without the write lock; results go in as one commit
+                hashed = list(pool.imap_unordered(hash_video, batch))
+
+                with writer(db_path) as conn:
+                    cur = conn.cursor()
+                    done = [
+                        (vid, "video gone", None)
+                        for vid in set(vids) - {v for v, _ in batch}
+                    ]
+                    for video_id, hashes, stats in hashed:
+                        if hashes is None:
+                            done.append((video_id, stats, None))
+                            continue
+                        if not hashes:
+                            done.append((video_id, "no frames decoded", None))
+                            continue
+                        store_hashes(cur, video_id, hashes)
+                        store_timing(cur, video_id, stats)
+                        store_samples(cur, video_id, stats)
+                        stored.add(video_id)
+                        done.append((video_id, None, stats["wall_time"]))
+                    finish(cur, "hash", done)
+
+    # exact copies of the videos hashed above (or earlier) take their hashes
+    with writer(db_path) as conn:
+        stored.update(copy_exact(conn.cursor())["hashes"])
+
+    # also picks up hashes stored by adhoc or stream since the last refresh
+    with reader(db_path) as conn:
+        refresh_corpus(conn.cursor(), corpus_path(db_path), stored)
@@ -0,0 +1,130 @@
+import os, queue, sqlite3, threading
+from contextlib import contextmanager
+
+from hash_store import convert_hash_storage
+from migrations import migrate
+
+BUSY_TIMEOUT = float(os.environ.get("DB_BUSY_TIMEOUT", 60))  # seconds
+CACHE_MB = int(os.environ.get("DB_CACHE_MB", 256))  # page cache per connection
+MMAP_MB = int(os.environ.get("DB_MMAP_MB", 2048))
+READERS = int(os.environ.get("DB_READERS", 4))  # pooled read connections
+
+
+def connect(db_path, readonly=False):
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    if not readonly:
+        # WAL sticks to the file: readers no longer block the writer (or the
+        # other way round), and a commit is an append instead of a journal copy
+        conn.execute("PRAGMA journal_mode = WAL")
+    # with WAL, NORMAL only syncs at checkpoints; a crash can lose the last
+    # commits but never corrupts the file
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {int(BUSY_TIMEOUT * 1000)}")
+    conn.execute(f"PRAGMA cache_size = {-CACHE_MB * 1024}")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_MB * 2**20}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    if readonly:
+        conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+class Database:
+    # One long-lived writer connection, used by one thread at a time, and a
+    # pool of query_only reader connections shared across threads.
+    def __init__(self, db_path, readers=None):
+        self.path = db_path
+        self.max_readers = readers or READERS
+        self._writer = None
+        self._prepared = False
+        self._write_lock = threading.RLock()
+        self._readers = queue.LifoQueue()
+        self._n_readers = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def writer(self):
+        # commits on exit, rolls back on error; re-entrant on the same thread,
+        # so a stage can call another stage's main while holding it
+        with self._write_lock:
+            self._open_writer()
+            try:
+                yield self._writer
+            except BaseException:
+                self._writer.rollback()
+                raise
+            self._writer.commit()
+
+    def _open_writer(self):
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = connect(self.path)
+
+    def prepare(self):
+        # brings the schema up to date and the hashes into the HASH_STORAGE
+        # layout, once per process. The pipeline's entry points call it before
+        # a stage runs; connections (the API's readers) never do, so a request
+        # can't end up running a migration.
+        with self._write_lock:
+            if not self._prepared:
+                self._open_writer()
+                migrate(self._writer)
+                convert_hash_storage(self._writer)
+                self._prepared = True
+
+    @contextmanager
+    def reader(self, row_factory=None):
+        conn = self._take_reader()
+        conn.row_factory = row_factory
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._readers.put(conn)
+
+    def _take_reader(self):
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._n_readers < self.max_readers:
+                self._n_readers += 1
+                return connect(self.path, readonly=True)
+        return self._readers.get()
+
+    def close(self):
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._n_readers = 0
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(db_path):
+    with _databases_lock:
+        if db_path not in _databases:
+            _databases[db_path] = Database(db_path)
+        return _databases[db_path]
+
+
+def writer(db_path):
+    return get_database(db_path).writer()
+
+
+def reader(db_path, row_factory=None):
+    return get_database(db_path).reader(row_factory)
+
+
+def prepare(db_path):
+    get_database(db_path).prepare()
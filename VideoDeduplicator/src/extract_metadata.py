@@ -1,4 +1,9 @@
-import json, subprocess, sqlite3
+import json, os, subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from db import writer
+from hash_store import IN_BATCH
+from jobs import claim, enqueue, finish
 
 FFPROBE = [
     "ffprobe",
@@ -9,6 +14,9 @@ FFPROBE = [
     "-show_format",
     "-show_streams",
 ]
+# ffprobe is latency-bound (NAS reads), not CPU-bound, so run many at once
+WORKERS = int(os.environ.get("META_WORKERS", 8))
+COMMIT_EVERY = int(os.environ.get("META_COMMIT_EVERY", 200))
 
 
 def probe(path):
@@ -16,46 +24,132 @@ def probe(path):
     return json.loads(out)
 
 
-def main(db_path):
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
+def parse_probe(meta):
+    # -> (duration, frame_count, width, height, codec, bitrate, container, fps)
+    vstream = next(s for s in meta["streams"] if s["codec_type"] == "video")
+    duration = float(meta["format"].get("duration", 0.0))
+    width = int(vstream.get("width", 0))
+    height = int(vstream.get("height", 0))
+    codec = vstream.get("codec_name")
+    bitrate = int(meta["format"].get("bit_rate", 0) or 0)
+    fps_str = vstream.get("r_frame_rate", "0/1")
+    num, den = map(int, fps_str.split("/"))
+    fps = num / den if den else 0
+    frame_count = int(vstream.get("nb_frames") or 0)
+    return (
+        duration,
+        frame_count,
+        width,
+        height,
+        codec,
+        bitrate,
+        meta["format"].get("format_name"),
+        fps,
+    )
+
+
+def store_metadata(cur, vid, fields):
+    cur.execute(
+        """
+        INSERT OR REPLACE INTO video_metadata
+        (video_id, duration, frame_count, width, height, codec, bitrate, container, fps)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """,
+        (vid, *fields),
+    )
+
+
+def record_probe(cur, vid, size_bytes, mtime):
+    cur.execute(
+        """
+        INSERT OR REPLACE INTO metadata_probes(video_id, size_bytes, mtime, probed_at)
+        VALUES (?, ?, ?, strftime('%s','now'))
+    """,
+        (vid, size_bytes, mtime),
+    )
+
+
+def probe_job(row):
+    vid, path, size_bytes, mtime = row
+    try:
+        return row, parse_probe(probe(path))
+    except (OSError, subprocess.CalledProcessError, ValueError, StopIteration) as e:
+        print(f"meta: ffprobe failed for {path}: {e!r}")
+        return row, None
+
+
+def pending_probes(cur):
+    # rows probed before probe records existed count as up to date
     cur.execute("""
-        SELECT v.video_id, v.path
+        INSERT OR IGNORE INTO metadata_probes(video_id, size_bytes, mtime, probed_at)
+        SELECT v.video_id, v.size_bytes, v.mtime, strftime('%s','now')
+        FROM videos v
+        JOIN video_metadata m ON v.video_id = m.video_id
+    """)
+
+    # never probed, or the file's size/mtime moved since the last probe
+    cur.execute("""
+        SELECT v.video_id, v.path, v.size_bytes, v.mtime
         FROM videos v
         LEFT JOIN video_metadata m ON v.video_id = m.video_id
-        WHERE m.video_id IS NULL
+        LEFT JOIN metadata_probes p ON v.video_id = p.video_id
+        WHERE (m.video_id IS NULL
+               OR p.size_bytes IS NOT v.size_bytes
+               OR p.mtime IS NOT v.mtime)
+          -- exact copies get their source's metadata (prehash.copy_exact)
+          AND v.video_id NOT IN (
+              SELECT video_id FROM content_hashes WHERE copy_of IS NOT NULL
+          )
     """)
-    rows = cur.fetchall()
-    for vid, path in rows:
-        meta = probe(path)
-        vstream = next(s for s in meta["streams"] if s["codec_type"] == "video")
-        duration = float(meta["format"].get("duration", 0.0))
-        width = int(vstream.get("width", 0))
-        height = int(vstream.get("height", 0))
-        codec = vstream.get("codec_name")
-        bitrate = int(meta["format"].get("bit_rate", 0) or 0)
-        fps_str = vstream.get("r_frame_rate", "0/1")
-        num, den = map(int, fps_str.split("/"))
-        fps = num / den if den else 0
-        frame_count = int(vstream.get("nb_frames") or 0)
+    return cur.fetchall()
 
+
+def load_rows(cur, vids):
+    rows = []
+    for i in range(0, len(vids), IN_BATCH):
+        batch = vids[i : i + IN_BATCH]
         cur.execute(
-            """
-            INSERT OR REPLACE INTO video_metadata
-            (video_id, duration, frame_count, width, height, codec, bitrate, container, fps)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            f"""
+            SELECT video_id, path, size_bytes, mtime FROM videos
+            WHERE video_id IN ({",".join("?" * len(batch))})
         """,
-            (
-                vid,
-                duration,
-                frame_count,
-                width,
-                height,
-                codec,
-                bitrate,
-                meta["format"].get("format_name"),
-                fps,
-            ),
+            batch,
+        )
+        rows += cur.fetchall()
+    return rows
+
+
+def main(db_path):
+    with writer(db_path) as conn:
+        enqueue(
+            conn.cursor(), "meta", [vid for vid, *_ in pending_probes(conn.cursor())]
         )
-    conn.commit()
-    conn.close()
+
+    # claim COMMIT_EVERY files at a time; each claim is committed with its
+    # results, so a restart picks up from the last finished batch. The write
+    # lock is not held while ffprobe runs.
+    with ThreadPoolExecutor(WORKERS) as pool:
+        while True:
+            with writer(db_path) as conn:
+                vids = claim(conn, "meta", COMMIT_EVERY)
+                rows = load_rows(conn.cursor(), vids)
+            if not vids:
+                break
+            probed = list(pool.map(probe_job, rows))
+
+            with writer(db_path) as conn:
+                cur = conn.cursor()
+                done = []
+                for (vid, path, size_bytes, mtime), fields in probed:
+                    if fields is None:
+                        done.append((vid, "ffprobe failed", None))
+                        continue
+                    store_metadata(cur, vid, fields)
+                    record_probe(cur, vid, size_bytes, mtime)
+                    done.append((vid, None, None))
+                # claimed rows whose video was purged in the meantime
+                done += [
+                    (vid, "video gone", None)
+                    for vid in set(vids) - {r[0] for r in rows}
+                ]
+                finish(cur, "meta", done)
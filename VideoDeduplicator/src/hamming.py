@@ -0,0 +1,69 @@
+import numpy as np
+
+# popcount of every byte value, used when np.bitwise_count (numpy >= 2.0) is missing
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+NATIVE_POPCOUNT = hasattr(np, "bitwise_count")
+SIGNATURE_FRAMES = 1 << 20  # frames unpacked at a time by bit_counts
+MAX_SIGNATURE_FRAMES = 0xFFFF  # counts are uint16; longer videos aren't bounded
+
+
+def to_hash_array(hashes):
+    return np.asarray(hashes, dtype=np.uint64)
+
+
+def popcount64(x):
+    if NATIVE_POPCOUNT:
+        return np.bitwise_count(x)
+    x = np.ascontiguousarray(x, dtype=np.uint64)
+    return _POPCOUNT8[x.view(np.uint8)].reshape(x.shape + (8,)).sum(axis=-1)
+
+
+def bit_counts(hashes, offsets=None):
+    # Signature of a video: how many of its frames have each of the 64 bits
+    # set (MSB first), as uint16[64]. With offsets, one row per video of the
+    # flat array, read a slice of videos at a time.
+    if offsets is None:
+        return bit_counts(hashes, np.array([0, len(hashes)]))[0]
+    flat = to_hash_array(hashes)
+    out = np.zeros((len(offsets) - 1, 64), dtype=np.uint16)
+    start = 0
+    while start < len(out):
+        # about SIGNATURE_FRAMES frames (64 bytes each unpacked) per slice
+        stop = max(
+            np.searchsorted(offsets, offsets[start] + SIGNATURE_FRAMES), start + 1
+        )
+        stop = min(stop, len(out))
+        lo, hi = offsets[start], offsets[stop]
+        bits = np.unpackbits(
+            flat[lo:hi].astype(">u8").view(np.uint8).reshape(-1, 8), axis=1
+        )
+        lengths = np.diff(offsets[start : stop + 1])
+        nonempty = lengths > 0
+        sums = np.add.reduceat(
+            bits, (offsets[start:stop] - lo)[nonempty], axis=0, dtype=np.uint32
+        )
+        out[start:stop][nonempty] = np.minimum(sums, MAX_SIGNATURE_FRAMES)
+        start = stop
+    return out
+
+
+def bit_count_bound(counts_a, len_a, counts_b, len_b):
+    # Lower bound on sliding_window_score from the signatures alone, for one
+    # pair or rows of pairs. Every aligned frame pair that differs in bit j adds
+    # one to the total, so the total over a window is at least the difference
+    # of the two sides' counts of bit j. The window of the longer video holds
+    # between c - (long - short) and min(c, short) of its c frames with bit j,
+    # whatever the offset. Same divisor as the score, so bound <= score exactly.
+    ca = np.atleast_2d(counts_a).astype(np.int64)
+    cb = np.atleast_2d(counts_b).astype(np.int64)
+    la = np.atleast_1d(len_a).astype(np.int64)
+    lb = np.atleast_1d(len_b).astype(np.int64)
+    swap = (la > lb)[:, None]
+    short, long_ = np.where(swap, cb, ca), np.where(swap, ca, cb)
+    ls, ll = np.minimum(la, lb)[:, None], np.maximum(la, lb)[:, None]
+    lo, hi = np.maximum(long_ - (ll - ls), 0), np.minimum(long_, ls)
+    gap = (np.maximum(lo - short, 0) + np.maximum(short - hi, 0)).sum(axis=1)
+    # saturated counts prove nothing
+    gap[(la > MAX_SIGNATURE_FRAMES) | (lb > MAX_SIGNATURE_FRAMES)] = 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(ls[:, 0] > 0, gap / ls[:, 0], np.inf)
@@ -0,0 +1,241 @@
+import os, struct, tempfile, threading, time
+import numpy as np
+
+from hamming import bit_counts
+from hash_store import HashStore, hashed_fingerprints, load_hashes
+
+# Flat, read-only export of every stored pHash sequence. Processes open it with
+# np.memmap, so the scorer pool, adhoc and the API workers share one page-cached
+# copy instead of each loading the hash table. Little-endian sections, in order:
+#   header   MAGIC, VERSION, id width, videos (n), frames, generation
+#   offsets  int64[n + 1]     video i owns frames[offsets[i]:offsets[i + 1]]
+#   sizes    int64[n]         size_bytes and mtime of the file when it was
+#   mtimes   float64[n]       hashed; with the frame count, the fingerprint
+#   frames   uint64[frames]
+#   signatures uint16[n, 64]  per-bit frame counts (hamming.bit_counts)
+#   ids      S<width>[n]      video ids, sorted
+# A refresh writes a new file and os.replace()s it, so open maps stay valid.
+CORPUS_PATH = os.environ.get("HASH_CORPUS_PATH")  # default: next to the DB
+MAGIC = b"VDHASHES"
+VERSION = 2
+HEADER = struct.Struct("<8sIIQQQ")
+HEADER_BYTES = 64  # keeps every numeric section 8-byte aligned
+
+
+def corpus_path(db_path):
+    return CORPUS_PATH or db_path + ".hashes.bin"
+
+
+class HashCorpus(HashStore):
+    def __init__(
+        self, path, inode, generation, vids, offsets, flat, sizes, mtimes, signatures
+    ):
+        super().__init__(vids, offsets, flat)
+        self.path = path
+        self.inode = inode
+        self.generation = generation
+        self.sizes = sizes
+        self.mtimes = mtimes
+        self.signatures = signatures
+
+    def fingerprint(self, i):
+        # same shape as hashed_fingerprints()
+        return (
+            int(self.sizes[i]),
+            float(self.mtimes[i]),
+            int(self.offsets[i + 1] - self.offsets[i]),
+        )
+
+
+def _inode(st):
+    return st.st_dev, st.st_ino
+
+
+def open_corpus(path):
+    # ValueError if the file is not a complete corpus of this VERSION
+    with open(path, "rb") as f:
+        inode = _inode(os.fstat(f.fileno()))
+        mm = np.memmap(f, dtype=np.uint8, mode="r")
+    if mm.size < HEADER_BYTES:
+        raise ValueError(f"{path}: truncated hash corpus")
+    magic, version, width, n, frames, generation = HEADER.unpack(
+        bytes(mm[: HEADER.size])
+    )
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path}: not a version {VERSION} hash corpus")
+
+    pos = HEADER_BYTES
+
+    def section(dtype, count):
+        nonlocal pos
+        dtype = np.dtype(dtype)
+        end = pos + dtype.itemsize * count
+        if end > mm.size:
+            raise ValueError(f"{path}: truncated hash corpus")
+        out = mm[pos:end].view(dtype)
+        pos = end
+        return out
+
+    offsets = section("<i8", n + 1)
+    sizes = section("<i8", n)
+    mtimes = section("<f8", n)
+    flat = section("<u8", frames).view(np.uint64)
+    signatures = section("<u2", n * 64).reshape(n, 64)
+    ids = section(f"S{width}", n)
+    vids = [vid.decode() for vid in ids.tolist()]
+    return HashCorpus(
+        path, inode, generation, vids, offsets, flat, sizes, mtimes, signatures
+    )
+
+
+def write_corpus(path, vids, counts, fingerprints, chunks, signatures):
+    # vids sorted; counts[i] frames, fingerprints[i] and signatures[i] for
+    # vids[i]; chunks: uint64 arrays that concatenate to the frames in vids order
+    n = len(vids)
+    ids = np.array([vid.encode() for vid in vids], dtype="S")
+    width = max(ids.dtype.itemsize, 1)
+    offsets = np.zeros(n + 1, dtype="<i8")
+    np.cumsum(counts, out=offsets[1:])
+    sizes = np.array([-1 if fp[0] is None else fp[0] for fp in fingerprints], "<i8")
+    mtimes = np.array([-1.0 if fp[1] is None else fp[1] for fp in fingerprints], "<f8")
+    header = HEADER.pack(MAGIC, VERSION, width, n, int(offsets[-1]), time.time_ns())
+
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=name + ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(header.ljust(HEADER_BYTES, b"\0"))
+            for arr in (offsets, sizes, mtimes):
+                f.write(arr.tobytes())
+            written = 0
+            for chunk in chunks:
+                f.write(np.ascontiguousarray(chunk, dtype="<u8").tobytes())
+                written += len(chunk)
+            if written != offsets[-1]:
+                raise ValueError(f"{written} frames written, {offsets[-1]} expected")
+            f.write(np.ascontiguousarray(signatures, dtype="<u2").tobytes())
+            f.write(ids.astype(f"S{width}").tobytes())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def refresh_corpus(cur, path, changed=()):
+    # Bring the corpus file in line with the stored hashes and return it opened.
+    # Videos whose fingerprint still matches are copied over from the old file
+    # in contiguous runs; only new and changed ones (plus `changed`, e.g. the
+    # videos a hash run just stored) are read from the database.
+    t0 = time.perf_counter()
+    current = hashed_fingerprints(cur)
+    try:
+        old = open_corpus(path)
+    except (FileNotFoundError, ValueError):
+        old = None
+    changed = set(changed)
+    keep = {}
+    if old is not None:
+        for i, vid in enumerate(old.vids):
+            fp = current.get(vid)
+            if fp is not None and vid not in changed and old.fingerprint(i) == fp:
+                keep[vid] = i
+        if len(keep) == len(old) == len(current):
+            return old
+
+    missing = [vid for vid in current if vid not in keep]
+    # a first build reads the whole table in one pass
+    new = load_hashes(cur, missing if keep else None)
+    vids = sorted(vid for vid in current if vid in keep or vid in new)
+
+    # [start, end) runs of old positions, or the array of a video read just now
+    segments, counts = [], []
+    for vid in vids:
+        i = keep.get(vid)
+        if i is None:
+            segments.append(new[vid])
+            counts.append(len(segments[-1]))
+            continue
+        if segments and isinstance(segments[-1], list) and segments[-1][1] == i:
+            segments[-1][1] = i + 1
+        else:
+            segments.append([i, i + 1])
+        counts.append(int(old.offsets[i + 1] - old.offsets[i]))
+    chunks = (
+        old.flat[old.offsets[s[0]] : old.offsets[s[1]]] if isinstance(s, list) else s
+        for s in segments
+    )
+    signatures = np.concatenate(
+        [
+            old.signatures[s[0] : s[1]] if isinstance(s, list) else bit_counts(s)[None]
+            for s in segments
+        ]
+        or [np.zeros((0, 64), np.uint16)]
+    )
+    write_corpus(path, vids, counts, [current[vid] for vid in vids], chunks, signatures)
+    corpus = open_corpus(path)
+    print(
+        f"corpus: {len(corpus)} videos ({len(keep)} kept, {len(vids) - len(keep)} "
+        f"read) written in {time.perf_counter() - t0:.2f}s "
+        f"({os.path.getsize(path) / 2**20:.1f} MiB)"
+    )
+    return corpus
+
+
+def pin_corpus(corpus, path):
+    # a name under which later openers (pool workers) see exactly the file
+    # `corpus` mapped, even if a refresh replaces it meanwhile: a hard link
+    # when the original is still in place, a copy otherwise
+    try:
+        os.link(corpus.path, path)
+        if _inode(os.stat(path)) == corpus.inode:
+            return
+        os.remove(path)
+    except OSError:
+        pass
+    counts = np.diff(corpus.offsets)
+    fingerprints = [corpus.fingerprint(i) for i in range(len(corpus))]
+    write_corpus(
+        path, corpus.vids, counts, fingerprints, [corpus.flat], corpus.signatures
+    )
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared_corpus(db_path):
+    # the corpus of db_path, opened once per process and reopened after a
+    # refresh replaced the file; None when there is no usable one
+    path = corpus_path(db_path)
+    try:
+        inode = _inode(os.stat(path))
+    except FileNotFoundError:
+        return None
+    with _shared_lock:
+        corpus = _shared.get(path)
+        if corpus is None or corpus.inode != inode:
+            try:
+                corpus = _shared[path] = open_corpus(path)
+            except (FileNotFoundError, ValueError):
+                return None
+        return corpus
+
+
+def corpus_hashes(cur, db_path, vids):
+    # {video_id: (hashes, signature)} for the hashed videos among `vids`: from
+    # the shared corpus where its copy is current, from the database (signature
+    # computed here) for videos hashed or changed since the last refresh
+    corpus = shared_corpus(db_path)
+    current = hashed_fingerprints(cur, vids)
+    out, missing = {}, []
+    for vid, fp in current.items():
+        i = corpus.positions.get(vid) if corpus is not None else None
+        if i is not None and corpus.fingerprint(i) == fp:
+            out[vid] = (corpus[vid], corpus.signatures[i])
+        else:
+            missing.append(vid)
+    if missing:
+        for vid, h in load_hashes(cur, missing).items():
+            out[vid] = (h, bit_counts(h))
+    return out
@@ -0,0 +1,359 @@
+import os, threading, uuid
+import numpy as np
+from itertools import combinations
+
+from hamming import popcount64, to_hash_array
+from hash_store import hash_table, load_hashes
+
+# Multi-index hashing: every 64-bit frame pHash is split into BANDS substrings of
+# BAND_BITS bits and each band gets its own lookup table. If two hashes are within
+# distance d, at least one band is within d // BANDS (pigeonhole), so probing every
+# band value within that radius finds all of them without a linear scan.
+BANDS = 4
+BAND_BITS = 16
+BAND_MASK = (1 << BAND_BITS) - 1
+
+INDEX_PATH = os.environ.get("HASH_INDEX_PATH")  # default: next to the DB
+INDEX_MAX_DIST = int(os.environ.get("INDEX_MAX_DIST", 8))  # per-frame hamming
+INDEX_MIN_FRAMES = int(os.environ.get("INDEX_MIN_FRAMES", 4))
+# new and removed frames the index takes before it is compacted: this share
+# of the base, or DELTA_MIN_FRAMES for a small base
+INDEX_DELTA_SHARE = float(os.environ.get("INDEX_DELTA_SHARE", 0.1))
+DELTA_MIN_FRAMES = 1 << 16
+
+
+def index_path(db_path):
+    return INDEX_PATH or db_path + ".mih.npz"
+
+
+def delta_path(path):
+    return path + ".delta"
+
+
+def band_values(hashes, band):
+    return ((hashes >> np.uint64(band * BAND_BITS)) & np.uint64(BAND_MASK)).astype(
+        np.uint16
+    )
+
+
+def band_tables(frame_hash):
+    # per band: entries sorted by band value, plus CSR starts for all 2^16 keys
+    postings = np.empty((BANDS, frame_hash.size), dtype=np.int32)
+    starts = np.empty((BANDS, (1 << BAND_BITS) + 1), dtype=np.int64)
+    for band in range(BANDS):
+        keys = band_values(frame_hash, band)
+        order = np.argsort(keys, kind="stable")
+        postings[band] = order
+        starts[band] = np.searchsorted(keys[order], np.arange((1 << BAND_BITS) + 1))
+    return postings, starts
+
+
+_probe_masks = {}
+
+
+def probe_masks(radius):
+    # all BAND_BITS-bit values with popcount <= radius
+    if radius not in _probe_masks:
+        masks = [0]
+        for r in range(1, radius + 1):
+            for bits in combinations(range(BAND_BITS), r):
+                masks.append(sum(1 << b for b in bits))
+        _probe_masks[radius] = np.array(masks, dtype=np.uint16)
+    return _probe_masks[radius]
+
+
+def file_stamp(path):
+    # what the index files looked like when this process last read or wrote them
+    stamp = []
+    for p in (path, delta_path(path)):
+        try:
+            st = os.stat(p)
+            stamp.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+class MultiIndex:
+    # Frames sit in two segments with their own band tables: the base, sorted
+    # when the index is built or compacted, and a small delta that new videos
+    # are appended to. A removed video stays in its segment, hidden from
+    # queries, until the next compaction. So an add or remove re-sorts only the
+    # delta, and a save rewrites the base only after a compaction.
+    # Slots: video i of self.vids owns the next self.lengths[i] frames, base
+    # slots first; `dead` holds the slots of removed videos.
+    def __init__(self, vids=None, video_of=None, frame_hash=None):
+        self.vids = list(vids or [])
+        self.video_of = np.empty(0, dtype=np.int32) if video_of is None else video_of
+        self.frame_hash = (
+            np.empty(0, dtype=np.uint64) if frame_hash is None else frame_hash
+        )
+        self.lock = threading.RLock()
+        self._new_base()
+
+    def _new_base(self):
+        self.postings, self.starts = band_tables(self.frame_hash)
+        self.base_slots = len(self.vids)
+        self.lengths = np.bincount(self.video_of, minlength=len(self.vids)).tolist()
+        self.positions = {vid: i for i, vid in enumerate(self.vids)}
+        self.dead, self.dead_frames = set(), 0
+        self.delta_of = np.empty(0, dtype=np.int32)
+        self.delta_hash = np.empty(0, dtype=np.uint64)
+        self._new_delta()
+        # a saved delta only applies on top of the base it was made for
+        self.token = uuid.uuid4().hex
+        self.saved_base = None  # path the base was last written to
+        self.stamp = None
+
+    def _new_delta(self):
+        self.delta_postings, self.delta_starts = band_tables(self.delta_hash)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, vid):
+        return vid in self.positions
+
+    def frames_by_video(self):
+        # entries are grouped by slot, and the delta's slots follow the base's
+        with self.lock:
+            frames = np.concatenate([self.frame_hash, self.delta_hash])
+            vids, lengths, dead = list(self.vids), list(self.lengths), set(self.dead)
+        start = 0
+        for slot, (vid, n) in enumerate(zip(vids, lengths)):
+            if slot not in dead:
+                yield vid, frames[start : start + n]
+            start += n
+
+    def add(self, items):
+        with self.lock:
+            video_of, frame_hash = [self.delta_of], [self.delta_hash]
+            for vid, hashes in items:
+                hashes = to_hash_array(hashes)
+                if vid in self.positions or not hashes.size:
+                    continue
+                slot = len(self.vids)
+                video_of.append(np.full(hashes.size, slot, dtype=np.int32))
+                frame_hash.append(hashes)
+                self.vids.append(vid)
+                self.lengths.append(hashes.size)
+                self.positions[vid] = slot
+            if len(video_of) == 1:
+                return
+            self.delta_of = np.concatenate(video_of)
+            self.delta_hash = np.concatenate(frame_hash)
+            if not self._compact_if_due():
+                self._new_delta()
+
+    def remove(self, vids):
+        with self.lock:
+            removed = False
+            for vid in vids:
+                slot = self.positions.pop(vid, None)
+                if slot is not None:
+                    self.dead.add(slot)
+                    self.dead_frames += self.lengths[slot]
+                    removed = True
+            if removed:
+                self._compact_if_due()
+
+    def _compact_if_due(self):
+        pending = self.delta_hash.size + self.dead_frames
+        if pending <= max(DELTA_MIN_FRAMES, INDEX_DELTA_SHARE * self.frame_hash.size):
+            return False
+        self.compact()
+        return True
+
+    def compact(self):
+        # fold the delta into the base and drop removed videos' frames
+        with self.lock:
+            keep_video = np.ones(len(self.vids), dtype=bool)
+            keep_video[list(self.dead)] = False
+            remap = np.cumsum(keep_video, dtype=np.int32) - 1
+            video_of = np.concatenate([self.video_of, self.delta_of])
+            keep = keep_video[video_of]
+            self.vids = [v for v, k in zip(self.vids, keep_video) if k]
+            self.video_of = remap[video_of[keep]]
+            self.frame_hash = np.concatenate([self.frame_hash, self.delta_hash])[keep]
+            self._new_base()
+
+    def _probe(self, postings, starts, video_of, frame_hash, q, masks, max_dist):
+        # (slot, query frame) of every frame of one segment within max_dist of
+        # a query frame, as slot * q.size + frame
+        entries, frames = [], []
+        for band in range(BANDS):
+            keys = (band_values(q, band)[:, None] ^ masks[None, :]).astype(np.int64)
+            lo, hi = starts[band][keys], starts[band][keys + 1]
+            counts = (hi - lo).ravel()
+            total = int(counts.sum())
+            if not total:
+                continue
+            # expand every [lo, hi) range into positions of the postings list
+            run_start = np.repeat(lo.ravel() - np.cumsum(counts) + counts, counts)
+            entries.append(postings[band][run_start + np.arange(total)])
+            frames.append(np.repeat(np.arange(q.size).repeat(masks.size), counts))
+        if not entries:
+            return np.empty(0, dtype=np.int64)
+        entries, frames = np.concatenate(entries), np.concatenate(frames)
+        close = popcount64(frame_hash[entries] ^ q[frames]) <= max_dist
+        return video_of[entries[close]].astype(np.int64) * q.size + frames[close]
+
+    def query(self, hashes, max_dist=None, min_frames=None):
+        # videos with at least min_frames of `hashes` within max_dist of one of
+        # their frames, as {video_id: matched frame count}
+        max_dist = INDEX_MAX_DIST if max_dist is None else max_dist
+        min_frames = INDEX_MIN_FRAMES if min_frames is None else min_frames
+        q = to_hash_array(hashes)
+        if not q.size:
+            return {}
+        min_frames = max(1, min(min_frames, q.size))
+        masks = probe_masks(max_dist // BANDS)
+
+        with self.lock:
+            segments = [
+                (self.postings, self.starts, self.video_of, self.frame_hash),
+                (
+                    self.delta_postings,
+                    self.delta_starts,
+                    self.delta_of,
+                    self.delta_hash,
+                ),
+            ]
+            hits = [self._probe(*seg, q, masks, max_dist) for seg in segments]
+            hits = np.unique(np.concatenate(hits))
+            videos, matched = np.unique(hits // q.size, return_counts=True)
+            return {
+                self.vids[v]: int(n)
+                for v, n in zip(videos, matched)
+                if n >= min_frames and v not in self.dead
+            }
+
+    def save(self, path):
+        # the base only when it changed since it was last written here; the
+        # delta (new videos and removed slots) every time
+        with self.lock:
+            if self.saved_base != path:
+                write_npz(
+                    path,
+                    token=np.array(self.token),
+                    vids=np.array(self.vids[: self.base_slots], dtype=str),
+                    video_of=self.video_of,
+                    frame_hash=self.frame_hash,
+                    postings=self.postings,
+                    starts=self.starts,
+                )
+                self.saved_base = path
+            write_npz(
+                delta_path(path),
+                token=np.array(self.token),
+                vids=np.array(self.vids[self.base_slots :], dtype=str),
+                video_of=self.delta_of,
+                frame_hash=self.delta_hash,
+                dead=np.array(sorted(self.dead), dtype=np.int64),
+            )
+            self.stamp = file_stamp(path)
+
+    @classmethod
+    def load(cls, path):
+        index = cls.__new__(cls)
+        index.lock = threading.RLock()
+        index.stamp = file_stamp(path)
+        with np.load(path) as data:
+            index.vids = data["vids"].tolist()
+            index.video_of = data["video_of"]
+            index.frame_hash = data["frame_hash"]
+            index.postings = data["postings"]
+            index.starts = data["starts"]
+            # bases saved before deltas existed have no token; they get one,
+            # and are written again, on the next save
+            index.token = str(data["token"]) if "token" in data else None
+        index.saved_base = path if index.token is not None else None
+        index.base_slots = len(index.vids)
+        index.lengths = np.bincount(index.video_of, minlength=len(index.vids)).tolist()
+        index.positions = {vid: i for i, vid in enumerate(index.vids)}
+        index.dead, index.dead_frames = set(), 0
+        index.delta_of = np.empty(0, dtype=np.int32)
+        index.delta_hash = np.empty(0, dtype=np.uint64)
+        delta = delta_path(path)
+        if index.token is not None and os.path.exists(delta):
+            with np.load(delta) as data:
+                # a delta written for an older base is left out; load_index
+                # brings the index back in line with the database
+                if str(data["token"]) == index.token:
+                    index.vids += data["vids"].tolist()
+                    index.delta_of = data["video_of"]
+                    index.delta_hash = data["frame_hash"]
+                    index.lengths += np.bincount(
+                        index.delta_of, minlength=len(index.vids)
+                    )[index.base_slots :].tolist()
+                    index.dead = set(data["dead"].tolist())
+                    index.dead_frames = sum(index.lengths[i] for i in index.dead)
+                    index.positions = {
+                        vid: i
+                        for i, vid in enumerate(index.vids)
+                        if i not in index.dead
+                    }
+        index.token = index.token or uuid.uuid4().hex
+        index._new_delta()
+        return index
+
+
+def write_npz(path, **arrays):
+    # through a per-process temporary file, so a reader never sees half a file
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+
+_open = {}  # path -> this process's MultiIndex of that file
+_open_lock = threading.Lock()
+
+
+def open_index(path):
+    # the index at path, shared by the threads of this process and only read
+    # again from disk when another process has written it since
+    with _open_lock:
+        index = _open.get(path)
+        if index is not None:
+            with index.lock:
+                if index.stamp == file_stamp(path):
+                    return index
+        if os.path.exists(path):
+            index = MultiIndex.load(path)
+        else:
+            index = MultiIndex()
+            index.stamp = file_stamp(path)
+        _open[path] = index
+        return index
+
+
+def load_index(cur, path, hashes=None):
+    # Open the persisted index and bring it in line with the stored hashes. `hashes`
+    # (a HashStore of the whole table) avoids re-reading rows the caller has.
+    # Callers that change the index further hold index.lock while they do.
+    index = open_index(path)
+    with index.lock:
+        cur.execute(f"SELECT DISTINCT video_id FROM {hash_table()}")
+        current = {r[0] for r in cur.fetchall()}
+        stale = [vid for vid in index.positions if vid not in current]
+        if hashes is not None:
+            # re-hashed videos keep their id, so compare content when it is at hand
+            stale += [
+                vid
+                for vid, frames in index.frames_by_video()
+                if vid in hashes
+                and not np.array_equal(frames, to_hash_array(hashes[vid]))
+            ]
+        missing = [vid for vid in current if vid not in index or vid in stale]
+        if not stale and not missing:
+            return index
+
+        if hashes is None:
+            hashes = load_hashes(cur, missing)
+        items = [(vid, hashes[vid]) for vid in missing]
+
+        index.remove(stale)
+        index.add(items)
+        index.save(path)
+    return index
@@ -0,0 +1,261 @@
+import os, time
+import numpy as np
+
+FETCH_BATCH = 100_000
+IN_BATCH = 500  # video ids per IN (...) list, well under SQLite's variable limit
+
+# rows: one video_hashes row per (video, frame), the original layout
+# blob: one video_hash_blobs row per video, frames packed as little-endian uint64
+HASH_STORAGE = os.environ.get("HASH_STORAGE", "rows")
+HASH_TABLES = {"rows": "video_hashes", "blob": "video_hash_blobs"}
+BLOB_FORMAT = 1  # packed "<u8" in frame order; bump if the packing changes
+CONVERT_BATCH = 10_000  # videos per executemany while converting layouts
+
+# SQLite INTEGER is signed 64-bit, so pHashes with the top bit set are stored as
+# their two's-complement value and read back through an int64 -> uint64 view.
+_TOP_BIT = 1 << 63
+
+
+def to_db_int(h):
+    return h - (1 << 64) if h >= _TOP_BIT else h
+
+
+def from_db_ints(values):
+    return np.asarray(values, dtype=np.int64).view(np.uint64)
+
+
+class HashStore:
+    # Columnar pHash store: one contiguous uint64 array, video i owning
+    # flat[offsets[i]:offsets[i + 1]] in frame_index order.
+    def __init__(self, vids, offsets, flat):
+        self.vids = vids
+        self.offsets = offsets
+        self.flat = flat
+        self.positions = {vid: i for i, vid in enumerate(vids)}
+
+    def __len__(self):
+        return len(self.vids)
+
+    def __contains__(self, vid):
+        return vid in self.positions
+
+    def __getitem__(self, vid):
+        i = self.positions[vid]
+        return self.flat[self.offsets[i] : self.offsets[i + 1]]
+
+    def items(self):
+        for i, vid in enumerate(self.vids):
+            yield vid, self.flat[self.offsets[i] : self.offsets[i + 1]]
+
+
+def hash_table():
+    return HASH_TABLES[HASH_STORAGE]
+
+
+def frame_count_query():
+    # SELECT of (video_id, n) for every hashed video in the active layout
+    if HASH_STORAGE == "blob":
+        return "SELECT video_id, n_frames AS n FROM video_hash_blobs"
+    return "SELECT video_id, COUNT(*) AS n FROM video_hashes GROUP BY video_id"
+
+
+def hashed_fingerprints(cur, vids=None):
+    # {video_id: (size_bytes, mtime, n_frames)} for every hashed video, or just
+    # for `vids`; a video whose fingerprint moved has different hashes
+    query = f"""
+        SELECT v.video_id, v.size_bytes, v.mtime, h.n
+        FROM ({frame_count_query()}) h
+        JOIN videos v ON v.video_id = h.video_id
+    """
+    if vids is None:
+        cur.execute(query)
+        return {vid: tuple(rest) for vid, *rest in cur.fetchall()}
+    out = {}
+    wanted = sorted(set(vids))
+    for i in range(0, len(wanted), IN_BATCH):
+        batch = wanted[i : i + IN_BATCH]
+        cur.execute(
+            f"{query} WHERE h.video_id IN ({','.join('?' * len(batch))})", batch
+        )
+        out.update((vid, tuple(rest)) for vid, *rest in cur.fetchall())
+    return out
+
+
+def unpack_blob(blob):
+    # zero-copy, read-only view of the blob's bytes
+    return np.frombuffer(blob, dtype="<u8").view(np.uint64)
+
+
+def pack_hashes(hashes):
+    # hashes: [(frame_index, phash)] -> blob in frame_index order
+    return (
+        np.array([int(ph) for _, ph in sorted(hashes)], dtype=np.uint64)
+        .astype("<u8")
+        .tobytes()
+    )
+
+
+def _scan(cur, vids, chunks, counts):
+    last = vids[-1] if vids else None
+    while True:
+        rows = cur.fetchmany(FETCH_BATCH)
+        if not rows:
+            break
+        ids, phashes = zip(*rows)
+        chunks.append(from_db_ints(phashes))
+        for vid in ids:
+            if vid != last:
+                vids.append(vid)
+                counts.append(0)
+                last = vid
+            counts[-1] += 1
+
+
+def _scan_blobs(cur, vids, chunks, counts):
+    while True:
+        rows = cur.fetchmany(FETCH_BATCH)
+        if not rows:
+            break
+        ids, blobs = zip(*rows)
+        vids.extend(ids)
+        counts.extend(len(b) // 8 for b in blobs)
+        # one copy per fetch: the blobs are joined and viewed, not parsed
+        chunks.append(unpack_blob(b"".join(blobs)))
+
+
+def load_hashes(cur, vids=None):
+    # Whole table (or just `vids`) in primary-key order, so SQLite streams the
+    # rows straight off the primary key index without sorting.
+    if HASH_STORAGE == "blob":
+        select, order, scan = "SELECT video_id, hashes", "video_id", _scan_blobs
+    else:
+        select, order, scan = "SELECT video_id, phash", "video_id, frame_index", _scan
+    out_vids, chunks, counts = [], [], []
+    if vids is None:
+        cur.execute(f"{select} FROM {hash_table()} ORDER BY {order}")
+        scan(cur, out_vids, chunks, counts)
+    else:
+        wanted = sorted(set(vids))
+        for i in range(0, len(wanted), IN_BATCH):
+            batch = wanted[i : i + IN_BATCH]
+            cur.execute(
+                f"""
+                {select} FROM {hash_table()}
+                WHERE video_id IN ({",".join("?" * len(batch))})
+                ORDER BY {order}
+            """,
+                batch,
+            )
+            scan(cur, out_vids, chunks, counts)
+
+    offsets = np.zeros(len(out_vids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    flat = np.concatenate(chunks) if chunks else np.empty(0, dtype=np.uint64)
+    return HashStore(out_vids, offsets, flat)
+
+
+def load_video_hashes(cur, vid):
+    if HASH_STORAGE == "blob":
+        cur.execute("SELECT hashes FROM video_hash_blobs WHERE video_id = ?", (vid,))
+        row = cur.fetchone()
+        return unpack_blob(row[0]) if row else np.empty(0, dtype=np.uint64)
+    cur.execute(
+        """
+        SELECT phash FROM video_hashes
+        WHERE video_id = ? ORDER BY frame_index
+    """,
+        (vid,),
+    )
+    return from_db_ints([r[0] for r in cur.fetchall()])
+
+
+def store_hashes(cur, vid, hashes):
+    # hashes: [(frame_index, phash)] as produced by hash_video
+    if HASH_STORAGE == "blob":
+        cur.execute(
+            """
+            INSERT OR REPLACE INTO video_hash_blobs(video_id, format, n_frames, hashes)
+            VALUES (?, ?, ?, ?)
+        """,
+            (vid, BLOB_FORMAT, len(hashes), pack_hashes(hashes)),
+        )
+        return
+    cur.executemany(
+        """
+        INSERT OR REPLACE INTO video_hashes(video_id, frame_index, phash)
+        VALUES (?, ?, ?)
+    """,
+        [(vid, idx, to_db_int(int(ph))) for idx, ph in hashes],
+    )
+
+
+def convert_hash_storage(conn, storage=None):
+    # Move hashes left in the other layout into `storage` (default: the active
+    # one), e.g. after HASH_STORAGE was switched. One transaction; returns the
+    # number of videos moved.
+    storage = storage or HASH_STORAGE
+    source = HASH_TABLES["rows" if storage == "blob" else "blob"]
+    if conn.execute(f"SELECT 1 FROM {source} LIMIT 1").fetchone() is None:
+        return 0
+
+    t0 = time.perf_counter()
+    conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    read = conn.cursor()
+    moved = 0
+    try:
+        if storage == "blob":
+            read.execute("""
+                SELECT video_id, phash FROM video_hashes
+                ORDER BY video_id, frame_index
+            """)
+            vids, chunks, counts = [], [], []
+            _scan(read, vids, chunks, counts)
+            flat = np.concatenate(chunks) if chunks else np.empty(0, np.uint64)
+            offsets = np.zeros(len(vids) + 1, dtype=np.int64)
+            np.cumsum(counts, out=offsets[1:])
+            rows = [
+                (
+                    vid,
+                    BLOB_FORMAT,
+                    int(offsets[i + 1] - offsets[i]),
+                    flat[offsets[i] : offsets[i + 1]].astype("<u8").tobytes(),
+                )
+                for i, vid in enumerate(vids)
+            ]
+            for i in range(0, len(rows), CONVERT_BATCH):
+                conn.executemany(
+                    """
+                    INSERT OR REPLACE INTO video_hash_blobs
+                    (video_id, format, n_frames, hashes)
+                    VALUES (?, ?, ?, ?)
+                """,
+                    rows[i : i + CONVERT_BATCH],
+                )
+            moved = len(rows)
+            conn.execute("DELETE FROM video_hashes")
+        else:
+            read.execute("SELECT video_id, hashes FROM video_hash_blobs")
+            while batch := read.fetchmany(CONVERT_BATCH):
+                conn.executemany(
+                    """
+                    INSERT OR REPLACE INTO video_hashes(video_id, frame_index, phash)
+                    VALUES (?, ?, ?)
+                """,
+                    [
+                        (vid, idx, to_db_int(int(ph)))
+                        for vid, blob in batch
+                        for idx, ph in enumerate(unpack_blob(blob))
+                    ],
+                )
+                moved += len(batch)
+            conn.execute("DELETE FROM video_hash_blobs")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    print(
+        f"hashes: moved {moved} videos from {source} to {HASH_TABLES[storage]} "
+        f"in {time.perf_counter() - t0:.1f}s"
+    )
+    return moved
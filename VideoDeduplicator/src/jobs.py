@@ -0,0 +1,129 @@
+import os, socket, time
+
+# Durable per-video work items in pipeline_jobs, one row per (video, stage).
+# Workers claim batches of pending rows, so a stage killed half way resumes
+# with what it had not finished, and several worker processes can share a
+# stage. A 'running' row whose claim is older than LEASE seconds belonged to a
+# worker that died and is handed out again.
+LEASE = float(os.environ.get("JOB_LEASE", 600))
+MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))  # claims before giving up
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def enqueue(cur, stage, vids):
+    # new rows start pending; finished rows go back to pending because the
+    # caller found more work for them. Failed and in-flight rows are left alone.
+    now = time.time()
+    cur.executemany(
+        """
+        INSERT INTO pipeline_jobs(video_id, stage, status, attempts, enqueued_at)
+        VALUES (?, ?, 'pending', 0, ?)
+        ON CONFLICT(video_id, stage) DO UPDATE
+        SET status = 'pending', attempts = 0, error = NULL,
+            enqueued_at = excluded.enqueued_at
+        WHERE status = 'done'
+    """,
+        [(vid, stage, now) for vid in vids],
+    )
+
+
+def unfinished(cur, stage):
+    # videos with work left: failed rows out of attempts are given up on, and
+    # would otherwise keep a stage with nothing to claim from ever being idle
+    cur.execute(
+        """
+        SELECT video_id FROM pipeline_jobs
+        WHERE stage = ? AND status != 'done'
+          AND NOT (status = 'failed' AND attempts >= ?)
+    """,
+        (stage, MAX_ATTEMPTS),
+    )
+    return {r[0] for r in cur.fetchall()}
+
+
+def claim(conn, stage, limit, worker=None):
+    # BEGIN IMMEDIATE takes the write lock up front, so two workers can't
+    # read the same pending rows before either marks them running
+    now = time.time()
+    conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    rows = conn.execute(
+        """
+        UPDATE pipeline_jobs
+        SET status = 'running', worker = ?, claimed_at = ?, attempts = attempts + 1
+        WHERE rowid IN (
+            SELECT rowid FROM pipeline_jobs
+            WHERE stage = ?
+              AND (status = 'pending'
+                   OR (status = 'failed' AND attempts < ?)
+                   OR (status = 'running' AND claimed_at < ?))
+            LIMIT ?
+        )
+        RETURNING video_id
+    """,
+        (worker or worker_id(), now, stage, MAX_ATTEMPTS, now - LEASE, limit),
+    ).fetchall()
+    conn.commit()
+    return [r[0] for r in rows]
+
+
+def finish(cur, stage, results):
+    # results: [(video_id, error or None, elapsed seconds or None)]
+    cur.executemany(
+        """
+        UPDATE pipeline_jobs
+        SET status = CASE WHEN ? IS NULL THEN 'done' ELSE 'failed' END,
+            error = ?, elapsed = ?, finished_at = ?
+        WHERE video_id = ? AND stage = ?
+    """,
+        [(err, err, elapsed, time.time(), vid, stage) for vid, err, elapsed in results],
+    )
+
+
+def release(cur, stage, vids):
+    # hand claimed rows back, e.g. work this worker can't see yet. They count
+    # as enqueued now: jobs claimed before this may not have seen them either.
+    cur.executemany(
+        """
+        UPDATE pipeline_jobs
+        SET status = 'pending', attempts = attempts - 1, enqueued_at = ?
+        WHERE video_id = ? AND stage = ? AND status = 'running'
+    """,
+        [(time.time(), vid, stage) for vid in vids],
+    )
+
+
+def enqueue_times(cur, stage, vids):
+    # {video_id: enqueued_at}
+    vids, out = list(vids), {}
+    for i in range(0, len(vids), 500):
+        chunk = vids[i : i + 500]
+        cur.execute(
+            f"""
+            SELECT video_id, enqueued_at FROM pipeline_jobs
+            WHERE stage = ? AND video_id IN ({",".join("?" * len(chunk))})
+        """,
+            [stage, *chunk],
+        )
+        out.update(cur.fetchall())
+    return out
+
+
+def open_or_claimed_since(cur, stage, since):
+    # videos whose job is not done, or was claimed at or after `since`
+    cur.execute(
+        """
+        SELECT video_id FROM pipeline_jobs
+        WHERE stage = ? AND (status != 'done' OR claimed_at >= ?)
+    """,
+        (stage, since),
+    )
+    return [r[0] for r in cur.fetchall()]
+
+
+def complete(cur, stage, vids):
+    # work done outside a claim (the streaming runner) closes matching rows
+    finish(cur, stage, [(vid, None, None) for vid in vids])
@@ -1,11 +1,14 @@
 import os, argparse
 from scan_folders import main as scan_main
+from prehash import main as prehash_main
 from extract_metadata import main as meta_main
 from compute_hashes import main as hash_main
 from similarity import main as sim_main
 from cluster import main as cluster_main
 from canonical import main as canon_main
 from report_clusters import main as report_main
+from stream import main as stream_main
+from db import prepare
 
 DB_PATH = os.environ.get("DB_PATH", "/data/videos.db")
 ROOTS = os.environ.get("VIDEO_ROOTS", "/videos").split(":")
@@ -13,6 +16,7 @@ ROOTS = os.environ.get("VIDEO_ROOTS", "/videos").split(":")
 
 def run_all():
     scan_main(DB_PATH, ROOTS)
+    prehash_main(DB_PATH)
     meta_main(DB_PATH)
     hash_main(DB_PATH)
     sim_main(DB_PATH)
@@ -24,11 +28,27 @@ if __name__ == "__main__":
     p = argparse.ArgumentParser()
     p.add_argument(
         "command",
-        choices=["scan", "meta", "hash", "sim", "cluster", "canon", "report", "all"],
+        choices=[
+            "scan",
+            "prehash",
+            "meta",
+            "hash",
+            "sim",
+            "cluster",
+            "canon",
+            "report",
+            "all",
+            "stream",
+            "migrate",
+        ],
     )
     args = p.parse_args()
+    # migrations and the hash layout conversion run here, before any stage
+    prepare(DB_PATH)
     if args.command == "scan":
         scan_main(DB_PATH, ROOTS)
+    elif args.command == "prehash":
+        prehash_main(DB_PATH)
     elif args.command == "meta":
         meta_main(DB_PATH)
     elif args.command == "hash":
@@ -43,3 +63,7 @@ if __name__ == "__main__":
         report_main(DB_PATH)
     elif args.command == "all":
         run_all()
+    elif args.command == "stream":
+        stream_main(DB_PATH, ROOTS)
+    elif args.command == "migrate":
+        pass  # prepare() above did it
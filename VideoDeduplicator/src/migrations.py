@@ -0,0 +1,263 @@
+# Schema changes on top of schema.sql, applied in order. PRAGMA user_version
+# holds the last version applied, so each migration runs once per database.
+# Statements must be safe to re-run (IF NOT EXISTS): two processes starting at
+# once may both see the old version.
+MIGRATIONS = [
+    (
+        1,
+        "similarity state",
+        """
+        -- videos already scored by the similarity stage, with the file and
+        -- hash count they were scored at (for incremental runs)
+        CREATE TABLE IF NOT EXISTS similarity_state (
+            video_id   TEXT PRIMARY KEY,
+            size_bytes INTEGER,
+            mtime      REAL,
+            n_hashes   INTEGER,
+            scored_at  REAL,
+            FOREIGN KEY(video_id) REFERENCES videos(video_id)
+        );
+        """,
+    ),
+    (
+        2,
+        "hashing timings",
+        """
+        -- per-file hashing cost, to compare frame samplers
+        CREATE TABLE IF NOT EXISTS hash_timings (
+            video_id       TEXT PRIMARY KEY,
+            sampler        TEXT,
+            gop            REAL,
+            frames         INTEGER,
+            wall_time      REAL,
+            frames_per_sec REAL,
+            FOREIGN KEY(video_id) REFERENCES videos(video_id)
+        );
+        """,
+    ),
+    (
+        3,
+        "metadata probe records",
+        """
+        -- file size/mtime at the last ffprobe, so unchanged files are not
+        -- probed again
+        CREATE TABLE IF NOT EXISTS metadata_probes (
+            video_id   TEXT PRIMARY KEY,
+            size_bytes INTEGER,
+            mtime      REAL,
+            probed_at  REAL,
+            FOREIGN KEY(video_id) REFERENCES videos(video_id)
+        );
+        """,
+    ),
+    (
+        4,
+        "pipeline jobs",
+        """
+        -- per-video, per-stage work items (meta, hash, sim) for resumable runs
+        CREATE TABLE IF NOT EXISTS pipeline_jobs (
+            video_id    TEXT,
+            stage       TEXT,
+            status      TEXT,     -- pending | running | done | failed
+            attempts    INTEGER,
+            worker      TEXT,
+            claimed_at  REAL,
+            finished_at REAL,
+            elapsed     REAL,
+            error       TEXT,
+            -- when the job last became pending; similarity compares it with
+            -- the claims of other videos' jobs to tell which side scores a pair
+            enqueued_at REAL,
+            PRIMARY KEY (video_id, stage),
+            FOREIGN KEY(video_id) REFERENCES videos(video_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_pipeline_jobs_stage_status
+            ON pipeline_jobs(stage, status);
+        """,
+    ),
+    (
+        5,
+        "secondary and covering indexes",
+        """
+        -- cluster of a video (adhoc, API joins from videos)
+        CREATE INDEX IF NOT EXISTS idx_duplicate_clusters_video
+            ON duplicate_clusters(video_id, cluster_id);
+        -- proposals: is_duplicate = 1, joined and ordered on canonical_of
+        CREATE INDEX IF NOT EXISTS idx_duplicate_flags_duplicate
+            ON duplicate_flags(is_duplicate, canonical_of, video_id);
+        CREATE INDEX IF NOT EXISTS idx_duplicate_flags_canonical
+            ON duplicate_flags(canonical_of);
+        -- the primary key only serves video_id_a; deletes on either side
+        -- (scan invalidation, incremental sim) need the other one too
+        CREATE INDEX IF NOT EXISTS idx_video_similarity_b
+            ON video_similarity(video_id_b, video_id_a);
+        CREATE INDEX IF NOT EXISTS idx_canonical_videos_video
+            ON canonical_videos(canonical_video_id);
+        """,
+    ),
+    (
+        6,
+        "per-video hash blobs",
+        """
+        -- HASH_STORAGE=blob layout: the whole pHash sequence of a video as
+        -- n_frames packed little-endian uint64 values; format versions it
+        CREATE TABLE IF NOT EXISTS video_hash_blobs (
+            video_id TEXT PRIMARY KEY,
+            format   INTEGER,
+            n_frames INTEGER,
+            hashes   BLOB,
+            FOREIGN KEY(video_id) REFERENCES videos(video_id)
+        );
+        """,
+    ),
+    (
+        7,
+        "incremental clustering state",
+        """
+        -- cluster.py's disjoint-set forest over every clustered video;
+        -- cluster_id is only set on roots
+        CREATE TABLE IF NOT EXISTS cluster_nodes (
+            video_id   TEXT PRIMARY KEY,
+            parent     TEXT NOT NULL,
+            rank       INTEGER NOT NULL,
+            cluster_id INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS cluster_state (
+            id              INTEGER PRIMARY KEY CHECK (id = 1),
+            threshold       REAL,
+            next_cluster_id INTEGER
+        );
+        -- every write to video_similarity, until the next cluster run reads
+        -- it; avg_hamming is NULL for a deleted pair. REPLACE only logs the
+        -- new row (recursive_triggers is off), which cluster.py allows for.
+        CREATE TABLE IF NOT EXISTS similarity_changes (
+            seq         INTEGER PRIMARY KEY,
+            video_id_a  TEXT,
+            video_id_b  TEXT,
+            avg_hamming REAL
+        );
+        CREATE TRIGGER IF NOT EXISTS video_similarity_insert
+        AFTER INSERT ON video_similarity
+        BEGIN
+            INSERT INTO similarity_changes(video_id_a, video_id_b, avg_hamming)
+            VALUES (NEW.video_id_a, NEW.video_id_b, NEW.avg_hamming);
+        END;
+        CREATE TRIGGER IF NOT EXISTS video_similarity_delete
+        AFTER DELETE ON video_similarity
+        BEGIN
+            INSERT INTO similarity_changes(video_id_a, video_id_b, avg_hamming)
+            VALUES (OLD.video_id_a, OLD.video_id_b, NULL);
+        END;
+        CREATE TRIGGER IF NOT EXISTS video_similarity_update
+        AFTER UPDATE ON video_similarity
+        BEGIN
+            INSERT INTO similarity_changes(video_id_a, video_id_b, avg_hamming)
+            VALUES (OLD.video_id_a, OLD.video_id_b, NULL);
+            INSERT INTO similarity_changes(video_id_a, video_id_b, avg_hamming)
+            VALUES (NEW.video_id_a, NEW.video_id_b, NEW.avg_hamming);
+        END;
+        """,
+    ),
+    (
+        8,
+        "dirty clusters for canonical selection",
+        """
+        -- clusters whose canonical has to be picked again: the ones cluster.py
+        -- changed, and those of videos whose metadata changed
+        CREATE TABLE IF NOT EXISTS canonical_dirty (
+            cluster_id INTEGER PRIMARY KEY
+        );
+        CREATE TRIGGER IF NOT EXISTS video_metadata_insert
+        AFTER INSERT ON video_metadata
+        BEGIN
+            INSERT OR IGNORE INTO canonical_dirty(cluster_id)
+            SELECT cluster_id FROM duplicate_clusters WHERE video_id = NEW.video_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS video_metadata_update
+        AFTER UPDATE ON video_metadata
+        BEGIN
+            INSERT OR IGNORE INTO canonical_dirty(cluster_id)
+            SELECT cluster_id FROM duplicate_clusters WHERE video_id = NEW.video_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS video_metadata_delete
+        AFTER DELETE ON video_metadata
+        BEGIN
+            INSERT OR IGNORE INTO canonical_dirty(cluster_id)
+            SELECT cluster_id FROM duplicate_clusters WHERE video_id = OLD.video_id;
+        END;
+        -- every cluster once, so the first run after upgrading covers them all
+        INSERT OR IGNORE INTO canonical_dirty(cluster_id)
+        SELECT DISTINCT cluster_id FROM duplicate_clusters;
+        """,
+    ),
+    (
+        9,
+        "content hashes for exact copies",
+        """
+        -- prehash.py: quick hash (crc32 of size, head, middle and tail) of the
+        -- file at size_bytes/mtime, the full blake2b hex digest once another
+        -- file shares the quick hash, and the source if the file is a copy
+        CREATE TABLE IF NOT EXISTS content_hashes (
+            video_id   TEXT PRIMARY KEY,
+            size_bytes INTEGER,
+            mtime      REAL,
+            quick      INTEGER,
+            full       TEXT,
+            copy_of    TEXT,
+            FOREIGN KEY(video_id) REFERENCES videos(video_id),
+            FOREIGN KEY(copy_of) REFERENCES videos(video_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_content_hashes_quick
+            ON content_hashes(size_bytes, quick);
+        CREATE INDEX IF NOT EXISTS idx_content_hashes_copy_of
+            ON content_hashes(copy_of);
+        """,
+    ),
+    (
+        10,
+        "hash sampling mode and timestamps",
+        """
+        -- how a video's hashes were sampled (compute_hashes HASH_MODE, with
+        -- HASH_INTERVAL seconds in interval mode) and decoded (HASH_BACKEND),
+        -- and the stream time of each hashed frame, packed little-endian
+        -- float64 seconds
+        CREATE TABLE IF NOT EXISTS hash_samples (
+            video_id TEXT PRIMARY KEY,
+            mode     TEXT,
+            interval REAL,
+            backend  TEXT,
+            times    BLOB,
+            FOREIGN KEY(video_id) REFERENCES videos(video_id)
+        );
+        """,
+    ),
+]
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, upto=None):
+    # -> [(version, name)] applied; each one commits with its user_version bump
+    applied = []
+    for version, name, sql in MIGRATIONS:
+        if version <= schema_version(conn) or (upto is not None and version > upto):
+            continue
+        conn.commit()
+        try:
+            conn.executescript(
+                f"BEGIN IMMEDIATE; {sql}; PRAGMA user_version = {version}; COMMIT;"
+            )
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        applied.append((version, name))
+        print(f"db: migrated to schema version {version} ({name})")
+    if applied:
+        # without statistics for the new indexes the planner can pick a worse
+        # join order than before (e.g. scanning videos for the cluster list)
+        conn.execute("ANALYZE")
+        conn.commit()
+    return applied
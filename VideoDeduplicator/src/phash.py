@@ -0,0 +1,82 @@
+import math
+import numpy as np
+import scipy.fftpack
+from functools import lru_cache
+
+HASH_SIZE = 8
+IMG_SIZE = HASH_SIZE * 4  # 32x32 input, as imagehash.phash uses
+PRECISION_BITS = 22  # PIL's fixed-point resampling coefficients (8-bit images)
+
+
+def lanczos(x):
+    # PIL's truncated sinc, with the C library's sin like PIL's own
+    def sinc(x):
+        return 1.0 if x == 0.0 else math.sin(x * math.pi) / (x * math.pi)
+
+    return sinc(x) * sinc(x / 3) if -3.0 <= x < 3.0 else 0.0
+
+
+@lru_cache(maxsize=None)
+def lanczos_weights(in_size, out_size):
+    # PIL's LANCZOS resize of one axis as an (in_size, out_size) matrix of its
+    # integer coefficients (precompute_coeffs + normalize_coeffs_8bpc). They
+    # are kept as float64: pixel * coefficient sums stay below 2**53, so a
+    # float matrix product adds them up exactly, in whatever order.
+    scale = in_size / out_size
+    filterscale = max(scale, 1.0)
+    support = 3.0 * filterscale
+    weights = np.zeros((in_size, out_size))
+    for xx in range(out_size):
+        center = (xx + 0.5) * scale
+        xmin = max(int(center - support + 0.5), 0)
+        xmax = min(int(center + support + 0.5), in_size)
+        k = [lanczos((x - center + 0.5) / filterscale) for x in range(xmin, xmax)]
+        total = sum(k)
+        for x, w in zip(range(xmin, xmax), k):
+            w = w / total if total != 0.0 else w
+            weights[x, xx] = math.trunc(
+                w * (1 << PRECISION_BITS) + math.copysign(0.5, w)
+            )
+    return weights
+
+
+def clip8(sums):
+    # PIL's rounding and clipping of the fixed-point sums back to uint8
+    return np.clip(
+        np.floor((sums + (1 << (PRECISION_BITS - 1))) / (1 << PRECISION_BITS)), 0, 255
+    ).astype(np.uint8)
+
+
+def gray32(frame):
+    # BGR frame -> 32x32 uint8 luma, the exact pixels imagehash.phash feeds its
+    # DCT: PIL's convert("L") (ITU-R 601-2, 16-bit fixed point), then PIL's
+    # LANCZOS downscale (horizontal pass, then vertical), both in NumPy on the
+    # frame buffer with no PIL image in between.
+    bgr = frame.astype(np.uint32)
+    luma = (
+        bgr[..., 2] * 19595 + bgr[..., 1] * 38470 + bgr[..., 0] * 7471 + 0x8000
+    ) >> 16
+    height, width = luma.shape
+    if width != IMG_SIZE:
+        luma = clip8(luma.astype(np.float64) @ lanczos_weights(width, IMG_SIZE))
+    if height != IMG_SIZE:
+        luma = clip8(lanczos_weights(height, IMG_SIZE).T @ luma.astype(np.float64))
+    return luma.astype(np.uint8)
+
+
+def phash_pixels(pixels):
+    # pixels: (frames, 32, 32) uint8 grayscale -> one uint64 pHash per frame,
+    # with imagehash's bit order (first low-frequency coefficient is the MSB).
+    # scipy's DCT is the one imagehash uses; a matrix-multiply or cv2.dct rounds
+    # differently and flips bits on flat frames, where coefficients sit at ~0.
+    pixels = np.asarray(pixels).reshape(-1, IMG_SIZE, IMG_SIZE)
+    dct = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=1), axis=2)
+    low = dct[:, :HASH_SIZE, :HASH_SIZE].reshape(len(pixels), -1)
+    bits = low > np.median(low, axis=1)[:, None]
+    return np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64)
+
+
+def phash_frames(frames):
+    if not frames:
+        return np.empty(0, dtype=np.uint64)
+    return phash_pixels(np.stack([gray32(f) for f in frames]))
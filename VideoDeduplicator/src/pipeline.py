@@ -1,14 +1,20 @@
 from scan_folders import main as scan_main
+from prehash import main as prehash_main
 from extract_metadata import main as meta_main
 from compute_hashes import main as hash_main
 from similarity import main as sim_main
 from cluster import main as cluster_main
 from canonical import main as canon_main
+from stream import main as stream_main
+from db import prepare
 
 
 def run_stage(db_path, roots, stage: str):
+    prepare(db_path)
     if stage == "scan":
         scan_main(db_path, roots)
+    elif stage == "prehash":
+        prehash_main(db_path)
     elif stage == "meta":
         meta_main(db_path)
     elif stage == "hash":
@@ -19,8 +25,11 @@ def run_stage(db_path, roots, stage: str):
         cluster_main(db_path)
     elif stage == "canon":
         canon_main(db_path)
+    elif stage == "stream":
+        stream_main(db_path, roots)
     elif stage == "all":
         scan_main(db_path, roots)
+        prehash_main(db_path)
         meta_main(db_path)
         hash_main(db_path)
         sim_main(db_path)
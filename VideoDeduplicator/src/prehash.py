@@ -0,0 +1,338 @@
+import hashlib, os, time, zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
+
+from db import reader, writer
+from extract_metadata import record_probe
+from hash_store import hash_table, hashed_fingerprints, load_hashes, store_hashes
+from jobs import complete
+from similarity import record_scored
+
+# Byte-identical files (the same video synced into several folders) are found
+# before ffprobe and decoding: a quick hash of the size and the first, middle
+# and last CHUNK_KIB of each file, confirmed by a full-file hash for files that
+# share one. One file of each identical group (the source) goes through the
+# pipeline; the others are copies that take over its metadata, hashes and
+# pairs, and are paired with it at distance 0.
+CHUNK_KIB = int(os.environ.get("PREHASH_KIB", 64))
+WORKERS = int(os.environ.get("PREHASH_WORKERS", 8))  # I/O-bound, like ffprobe
+READ_BLOCK = 1 << 20
+
+
+def quick_hash(path, size):
+    # crc32 of the size and three CHUNK_KIB slices; small files are read whole
+    chunk = CHUNK_KIB * 1024
+    crc = zlib.crc32(size.to_bytes(8, "little"))
+    with open(path, "rb") as f:
+        if size <= 3 * chunk:
+            return zlib.crc32(f.read(), crc)
+        for pos in (0, (size - chunk) // 2, size - chunk):
+            f.seek(pos)
+            crc = zlib.crc32(f.read(chunk), crc)
+    return crc
+
+
+def full_hash(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while block := f.read(READ_BLOCK):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _quick_job(row):
+    vid, path, size, mtime = row
+    try:
+        return row, quick_hash(path, size)
+    except OSError as e:
+        print(f"prehash: can't read {path}: {e!r}")
+        return row, None
+
+
+def _full_job(row):
+    vid, path = row
+    try:
+        return vid, full_hash(path)
+    except OSError as e:
+        print(f"prehash: can't read {path}: {e!r}")
+        return vid, None
+
+
+def stale_files(cur):
+    # never hashed, or size/mtime moved since; empty files are never copies
+    cur.execute("""
+        SELECT v.video_id, v.path, v.size_bytes, v.mtime
+        FROM videos v
+        LEFT JOIN content_hashes c ON v.video_id = c.video_id
+        WHERE v.size_bytes > 0
+          AND (c.video_id IS NULL
+               OR c.size_bytes IS NOT v.size_bytes
+               OR c.mtime IS NOT v.mtime)
+    """)
+    return cur.fetchall()
+
+
+def candidate_groups(cur):
+    # files sharing size and quick hash; the source of a group is the first:
+    # a video already through the pipeline (metadata and hashes), the current
+    # source if it still is one, then the lowest id
+    cur.execute(f"""
+        SELECT c.video_id, v.path, c.size_bytes, c.quick, c.full, c.copy_of,
+               EXISTS (SELECT 1 FROM video_metadata m WHERE m.video_id = c.video_id)
+               AND EXISTS (SELECT 1 FROM {hash_table()} h WHERE h.video_id = c.video_id)
+        FROM content_hashes c
+        JOIN videos v ON v.video_id = c.video_id
+        JOIN (
+            SELECT size_bytes, quick FROM content_hashes
+            WHERE quick IS NOT NULL
+            GROUP BY size_bytes, quick HAVING COUNT(*) > 1
+        ) g ON g.size_bytes = c.size_bytes AND g.quick = c.quick
+        WHERE c.size_bytes IS v.size_bytes AND c.mtime IS v.mtime
+    """)
+    groups = defaultdict(list)
+    for vid, path, size, quick, full, copy_of, done in cur.fetchall():
+        groups[size, quick].append([vid, path, full, done, copy_of])
+    for members in groups.values():
+        members.sort(key=lambda m: (not m[3], m[4] is not None, m[0]))
+    return list(groups.values())
+
+
+def link_copies(cur, members):
+    # members: [video_id, path, full hash, processed, copy_of] of one group,
+    # source first; returns the copies
+    source, copies = members[0][0], [m[0] for m in members[1:]]
+    cur.execute(
+        "UPDATE content_hashes SET copy_of = NULL WHERE video_id = ?", (source,)
+    )
+    cur.executemany(
+        "UPDATE content_hashes SET copy_of = ? WHERE video_id = ?",
+        [(source, vid) for vid in copies],
+    )
+    # OR IGNORE: a pair that is already stored is already 0
+    cur.executemany(
+        """
+        INSERT OR IGNORE INTO video_similarity(video_id_a, video_id_b, avg_hamming)
+        VALUES (?, ?, 0.0)
+    """,
+        combinations(sorted(m[0] for m in members), 2),
+    )
+    return copies
+
+
+def copy_exact(cur):
+    # Fill in what copies are missing from their source: metadata, hashes and,
+    # once the source is scored against its current content, its pairs.
+    # -> {"meta": [...], "hashes": [...], "pairs": [...]} video ids copied
+    cur.execute("""
+        SELECT c.video_id, c.copy_of, v.size_bytes, v.mtime
+        FROM content_hashes c
+        JOIN videos v ON v.video_id = c.video_id
+        JOIN video_metadata s ON s.video_id = c.copy_of
+        LEFT JOIN video_metadata m ON m.video_id = c.video_id
+        LEFT JOIN metadata_probes p ON p.video_id = c.video_id
+        WHERE c.copy_of IS NOT NULL
+          AND (m.video_id IS NULL
+               OR p.size_bytes IS NOT v.size_bytes
+               OR p.mtime IS NOT v.mtime)
+    """)
+    need_meta = cur.fetchall()
+    cur.executemany(
+        """
+        INSERT OR REPLACE INTO video_metadata
+        (video_id, duration, frame_count, width, height, codec, bitrate, container, fps)
+        SELECT ?, duration, frame_count, width, height, codec, bitrate, container, fps
+        FROM video_metadata WHERE video_id = ?
+    """,
+        [(vid, source) for vid, source, _, _ in need_meta],
+    )
+    for vid, _, size, mtime in need_meta:
+        record_probe(cur, vid, size, mtime)
+    complete(cur, "meta", [vid for vid, *_ in need_meta])
+
+    table = hash_table()
+    cur.execute(f"""
+        SELECT c.video_id, c.copy_of FROM content_hashes c
+        WHERE c.copy_of IS NOT NULL
+          AND EXISTS (SELECT 1 FROM {table} h WHERE h.video_id = c.copy_of)
+          AND NOT EXISTS (SELECT 1 FROM {table} h WHERE h.video_id = c.video_id)
+    """)
+    need_hashes = cur.fetchall()
+    store = load_hashes(cur, {source for _, source in need_hashes})
+    for vid, source in need_hashes:
+        store_hashes(cur, vid, list(enumerate(store[source])))
+    cur.executemany(
+        """
+        INSERT OR REPLACE INTO hash_samples(video_id, mode, interval, backend, times)
+        SELECT ?, mode, interval, backend, times FROM hash_samples WHERE video_id = ?
+    """,
+        need_hashes,
+    )
+    complete(cur, "hash", [vid for vid, _ in need_hashes])
+
+    cur.execute("""
+        SELECT c.video_id, c.copy_of FROM content_hashes c
+        JOIN videos v ON v.video_id = c.video_id
+        JOIN similarity_state s ON s.video_id = c.copy_of
+        LEFT JOIN similarity_state cs ON cs.video_id = c.video_id
+        WHERE c.copy_of IS NOT NULL
+          AND (cs.video_id IS NULL
+               OR cs.size_bytes IS NOT v.size_bytes
+               OR cs.mtime IS NOT v.mtime)
+    """)
+    need_pairs = cur.fetchall()
+    current = hashed_fingerprints(cur, {vid for pair in need_pairs for vid in pair})
+    scored = {}
+    for vid, source in need_pairs:
+        # the source's pairs are only the copy's if they were scored from the
+        # content both files have now
+        state = cur.execute(
+            """
+            SELECT size_bytes, mtime, n_hashes FROM similarity_state
+            WHERE video_id = ?
+        """,
+            (source,),
+        ).fetchone()
+        if vid not in current or state != current.get(source):
+            continue
+        cur.execute(
+            """
+            SELECT video_id_a, video_id_b, avg_hamming FROM video_similarity
+            WHERE video_id_a = ? OR video_id_b = ?
+        """,
+            (source, source),
+        )
+        rows = []
+        for a, b, score in cur.fetchall():
+            other = b if a == source else a
+            if other != vid:
+                rows.append((min(vid, other), max(vid, other), score))
+        cur.executemany(
+            """
+            INSERT OR REPLACE INTO video_similarity(video_id_a, video_id_b, avg_hamming)
+            VALUES (?, ?, ?)
+        """,
+            rows,
+        )
+        scored[vid] = current[vid]
+    record_scored(cur, scored)
+    complete(cur, "sim", list(scored))
+    return {
+        "meta": [vid for vid, *_ in need_meta],
+        "hashes": [vid for vid, _ in need_hashes],
+        "pairs": list(scored),
+    }
+
+
+def find_copy(db_path, vid, path, size, mtime):
+    # One file (adhoc) against the library, before it is probed: if it is a
+    # copy of a video already through the pipeline it is linked to it and
+    # filled in. -> what copy_exact filled in, as in copy_exact
+    copied = {"meta": [], "hashes": [], "pairs": []}
+    try:
+        quick = quick_hash(path, size) if size else None
+    except OSError:
+        return copied
+    with writer(db_path) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT OR REPLACE INTO content_hashes
+            (video_id, size_bytes, mtime, quick, full, copy_of)
+            VALUES (?, ?, ?, ?, NULL, NULL)
+        """,
+            (vid, size, mtime, quick),
+        )
+        cur.execute(
+            """
+            SELECT c.video_id, v.path, c.full FROM content_hashes c
+            JOIN videos v ON v.video_id = c.video_id
+            JOIN video_metadata m ON m.video_id = c.video_id
+            WHERE c.size_bytes = ? AND c.quick = ? AND c.video_id != ?
+              AND c.copy_of IS NULL
+              AND c.size_bytes IS v.size_bytes AND c.mtime IS v.mtime
+            ORDER BY c.video_id
+        """,
+            (size, quick, vid),
+        )
+        candidates = cur.fetchall()
+    if quick is None or not candidates:
+        return copied
+
+    # read in full without the write lock
+    full = dict([_full_job((vid, path))])
+    source = None
+    for other, other_path, other_full in candidates:
+        if full[vid] is None:
+            break
+        if other_full is None:
+            other_full = full[other] = _full_job((other, other_path))[1]
+        if other_full == full[vid]:
+            source = other
+            break
+    with writer(db_path) as conn:
+        cur = conn.cursor()
+        cur.executemany(
+            "UPDATE content_hashes SET full = ? WHERE video_id = ?",
+            [(h, v) for v, h in full.items() if h is not None],
+        )
+        if source is not None:
+            link_copies(cur, [[source], [vid]])
+            copied = copy_exact(cur)
+    return copied
+
+
+def main(db_path):
+    t0 = time.time()
+    with reader(db_path) as conn:
+        rows = stale_files(conn.cursor())
+    with ThreadPoolExecutor(WORKERS) as pool:
+        hashed = list(pool.map(_quick_job, rows))
+    with writer(db_path) as conn:
+        conn.executemany(
+            """
+            INSERT OR REPLACE INTO content_hashes
+            (video_id, size_bytes, mtime, quick, full, copy_of)
+            VALUES (?, ?, ?, ?, NULL, NULL)
+        """,
+            # unreadable files get no row, so the next run tries them again
+            [
+                (vid, size, mtime, quick)
+                for (vid, _, size, mtime), quick in hashed
+                if quick is not None
+            ],
+        )
+
+    with reader(db_path) as conn:
+        groups = candidate_groups(conn.cursor())
+    # only files that share size and quick hash are read in full
+    unconfirmed = [(m[0], m[1]) for g in groups for m in g if m[2] is None]
+    with ThreadPoolExecutor(WORKERS) as pool:
+        full = dict(pool.map(_full_job, unconfirmed))
+
+    n_copies, n_groups = 0, 0
+    with writer(db_path) as conn:
+        cur = conn.cursor()
+        cur.executemany(
+            "UPDATE content_hashes SET full = ? WHERE video_id = ?",
+            [(h, vid) for vid, h in full.items() if h is not None],
+        )
+        for members in groups:
+            identical = defaultdict(list)
+            for m in members:
+                m[2] = m[2] or full.get(m[0])
+                if m[2] is not None:
+                    identical[m[2]].append(m)
+            for same in identical.values():
+                if len(same) > 1:
+                    n_copies += len(link_copies(cur, same))
+                    n_groups += 1
+        copied = copy_exact(cur)
+
+    print(
+        f"prehash: {len(rows)} files hashed, {len(unconfirmed)} read in full, "
+        f"in {time.time() - t0:.1f}s; {n_copies} exact copies in {n_groups} groups "
+        f"({len(copied['meta'])} metadata, {len(copied['hashes'])} hashes, "
+        f"{len(copied['pairs'])} pairs copied)"
+    )
+    return n_copies
@@ -1,29 +1,160 @@
-import os, uuid, time, sqlite3
+import os, uuid, time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from db import writer
 
 VIDEO_EXTS = {".mp4", ".mkv", ".avi", ".mov", ".webm", ".flv"}
+WORKERS = int(os.environ.get("SCAN_WORKERS", 16))
+
+# rows derived from a file's content, dropped when the file changes
+CONTENT_TABLES = [
+    "video_hashes",
+    "video_hash_blobs",
+    "hash_timings",
+    "hash_samples",
+    "pipeline_jobs",
+    "content_hashes",
+]
+# every per-video row, dropped when the file is gone
+VIDEO_TABLES = [
+    "video_hashes",
+    "video_hash_blobs",
+    "hash_timings",
+    "hash_samples",
+    "video_metadata",
+    "metadata_probes",
+    "similarity_state",
+    "duplicate_clusters",
+    "duplicate_flags",
+    "pipeline_jobs",
+    "content_hashes",
+]
+
+
+def scan_dir(path):
+    # -> ([(path, size, mtime)] of videos, [subdirectories]), or (None, []) if
+    # the directory can't be read. Like os.walk, symlinked directories are not
+    # followed but symlinked files are listed.
+    files, subdirs = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in VIDEO_EXTS:
+                        st = entry.stat()
+                        files.append((entry.path, st.st_size, st.st_mtime))
+                except OSError:
+                    continue
+    except OSError:
+        return None, []
+    return files, subdirs
+
+
+def walk_videos(roots, workers=None):
+    # Directories are listed concurrently: every finished directory queues its
+    # subdirectories, so deep and wide trees both keep the pool busy.
+    found, unreadable = {}, []
+    with ThreadPoolExecutor(workers or WORKERS) as pool:
+        pending = {pool.submit(scan_dir, root): root for root in roots}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                path = pending.pop(fut)
+                files, subdirs = fut.result()
+                if files is None:
+                    unreadable.append(path)
+                    continue
+                for file_path, size, mtime in files:
+                    found[file_path] = (size, mtime)
+                for sub in subdirs:
+                    pending[pool.submit(scan_dir, sub)] = sub
+    return found, unreadable
+
+
+def is_under(path, dirs):
+    return any(path.startswith(d.rstrip(os.sep) + os.sep) for d in dirs)
 
 
-def iter_videos(roots):
-    for root in roots:
-        for dirpath, _, files in os.walk(root):
-            for f in files:
-                if os.path.splitext(f)[1].lower() in VIDEO_EXTS:
-                    yield os.path.join(dirpath, f)
+def invalidate_videos(cur, vids):
+    # the file changed: drop its hashes and pairs so later stages redo them
+    # (meta and incremental sim also see the new size/mtime on their own)
+    rows = [(vid,) for vid in vids]
+    for table in CONTENT_TABLES:
+        cur.executemany(f"DELETE FROM {table} WHERE video_id = ?", rows)
+    cur.executemany(
+        "DELETE FROM video_similarity WHERE video_id_a = ? OR video_id_b = ?",
+        [(vid, vid) for vid in vids],
+    )
+    # its copies are files of their own again until prehash matches them up
+    cur.executemany("UPDATE content_hashes SET copy_of = NULL WHERE copy_of = ?", rows)
+
+
+def purge_videos(cur, vids):
+    rows = [(vid,) for vid in vids]
+    for table in VIDEO_TABLES:
+        cur.executemany(f"DELETE FROM {table} WHERE video_id = ?", rows)
+    cur.executemany(
+        "DELETE FROM video_similarity WHERE video_id_a = ? OR video_id_b = ?",
+        [(vid, vid) for vid in vids],
+    )
+    cur.executemany("DELETE FROM duplicate_flags WHERE canonical_of = ?", rows)
+    cur.executemany("UPDATE content_hashes SET copy_of = NULL WHERE copy_of = ?", rows)
+    cur.executemany("DELETE FROM canonical_videos WHERE canonical_video_id = ?", rows)
+    cur.executemany("DELETE FROM videos WHERE video_id = ?", rows)
 
 
 def main(db_path, roots):
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
-    now = time.time()
-    for path in iter_videos(roots):
-        st = os.stat(path)
-        vid = uuid.uuid5(uuid.NAMESPACE_URL, path).hex
-        cur.execute(
+    t0 = time.time()
+    found, unreadable = walk_videos(roots)
+    walked = time.time() - t0
+
+    with writer(db_path) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT video_id, path, size_bytes, mtime FROM videos")
+        known = {path: (vid, size, mtime) for vid, path, size, mtime in cur.fetchall()}
+
+        now = time.time()
+        added, modified = [], []
+        for path, (size, mtime) in found.items():
+            if path not in known:
+                vid = uuid.uuid5(uuid.NAMESPACE_URL, path).hex
+                added.append((vid, path, size, mtime, now))
+            elif known[path][1:] != (size, mtime):
+                modified.append((size, mtime, known[path][0]))
+
+        # only trust "missing" for roots we could list; an unmounted share or an
+        # unreadable directory must not purge its videos
+        readable = [r for r in roots if r not in unreadable]
+        removed = [
+            vid
+            for path, (vid, _, _) in known.items()
+            if path not in found
+            and is_under(path, readable)
+            and not is_under(path, unreadable)
+        ]
+
+        cur.executemany(
             """
             INSERT OR IGNORE INTO videos(video_id, path, size_bytes, mtime, discovered_at)
             VALUES (?, ?, ?, ?, ?)
         """,
-            (vid, path, st.st_size, st.st_mtime, now),
+            added,
         )
-    conn.commit()
-    conn.close()
+        cur.executemany(
+            "UPDATE videos SET size_bytes = ?, mtime = ? WHERE video_id = ?", modified
+        )
+        invalidate_videos(cur, [vid for _, _, vid in modified])
+        purge_videos(cur, removed)
+
+    print(
+        f"scan: {len(found)} videos listed in {walked:.1f}s; "
+        f"{len(added)} added, {len(modified)} modified, {len(removed)} removed"
+    )
+    return {
+        "added": [vid for vid, *_ in added],
+        "modified": [vid for *_, vid in modified],
+        "removed": removed,
+    }
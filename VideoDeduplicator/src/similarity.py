@@ -1,16 +1,80 @@
-import sqlite3
-from itertools import combinations
+import math, os, tempfile
+from itertools import islice
+import numpy as np
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from multiprocessing import Pool, cpu_count
+from numpy.lib.stride_tricks import sliding_window_view
 
-DURATION_TOL = 60.0  # seconds. Previously 2 sec
-FRAMECOUNT_TOL = 0.05  # ±5%
+from db import reader, writer
+from hamming import NATIVE_POPCOUNT, bit_count_bound, popcount64, to_hash_array
+from hash_index import MultiIndex, index_path, load_index
+from hash_corpus import corpus_path, open_corpus, pin_corpus, refresh_corpus
+from hash_store import hashed_fingerprints
+from jobs import (
+    claim,
+    enqueue,
+    enqueue_times,
+    finish,
+    open_or_claimed_since,
+    release,
+    unfinished,
+)
+
+# With HASH_MODE=interval a trimmed copy lines up with its original on time, so
+# DURATION_TOL is the largest trim to look for, and frame counts (which differ
+# with the frame rate) can be left out with SIM_FRAMECOUNT_TOL=0.
+DURATION_TOL = float(os.environ.get("SIM_DURATION_TOL", 60.0))  # seconds
+FRAMECOUNT_TOL = float(os.environ.get("SIM_FRAMECOUNT_TOL", 0.05))  # ±5%, 0: off
 HAMMING_THRESHOLD = 16.0  # max avg hamming to store similarity
+SIM_ENGINE = os.environ.get("SIM_ENGINE", "numpy")  # numpy | python | verify
+SIM_USE_INDEX = os.environ.get("SIM_USE_INDEX", "0") == "1"
+# only new or changed videos are scored; untouched pairs keep their rows
+SIM_INCREMENTAL = os.environ.get("SIM_INCREMENTAL", "0") == "1"
+# reject pairs whose per-bit frame counts alone put them over the threshold
+# before aligning any frames (hamming.bit_count_bound never exceeds the score).
+# Pays off on videos with few, long scenes, where bits stay put for many
+# frames; on busy footage every bit is set about half the time, nothing is
+# rejected and the check costs a few us per pair.
+SIM_SIGNATURE = os.environ.get("SIM_SIGNATURE", "1") == "1"
+SIGNATURE_BATCH = 4096  # candidate pairs bounded per vectorized call
+SIM_WORKERS = int(os.environ.get("SIM_WORKERS", cpu_count()))
+SHARDS_PER_WORKER = 4  # smaller shards even out skewed blocking buckets
+SIM_BATCH = int(os.environ.get("SIM_BATCH", 2000))  # videos claimed per commit
+# window_search: offsets scored per block; share of the frames summed before
+# offsets over the limit are dropped (unrelated videos differ in about 32 bits
+# a frame, so most cross a 16-bit average about half way); window work
+# (offsets x frames) below which a block is summed in one go, as the second
+# pass costs more than it saves there (much later with numpy's own popcount)
+OFFSET_BLOCK = 64
+FRAME_SPLIT = 0.55
+BOUND_MIN_WORK = 12_000 if NATIVE_POPCOUNT else 256
 
 
 def hamming64(a: int, b: int) -> int:
     return (a ^ b).bit_count()
 
 
-def sliding_window_score(hashes_a, hashes_b):
+def total_limit(cutoff, la):
+    # largest window total whose average over la frames is still <= cutoff,
+    # computed so it agrees with the float division the scores come from
+    if cutoff is None or cutoff == float("inf"):
+        return None
+    limit = math.floor(cutoff * la)
+    while (limit + 1) / la <= cutoff:
+        limit += 1
+    while limit >= 0 and limit / la > cutoff:
+        limit -= 1
+    return limit
+
+
+# Every engine is score(a, b, cutoff=None): the lowest average hamming over
+# all alignments of the shorter sequence inside the longer one. With a cutoff
+# the exact score is only promised when it is <= cutoff; anything worse comes
+# back as inf, which lets the engines give up on an alignment early.
+
+
+def sliding_window_score(hashes_a, hashes_b, cutoff=None):
     if not hashes_a or not hashes_b:
         return float("inf")
 
@@ -18,17 +82,112 @@ def sliding_window_score(hashes_a, hashes_b):
         hashes_a, hashes_b = hashes_b, hashes_a
 
     la, lb = len(hashes_a), len(hashes_b)
-    best = float("inf")
+    limit = total_limit(cutoff, la)
+    best = None
 
     for offset in range(lb - la + 1):
+        # an offset is abandoned once its running total can't beat the best
+        # one so far or get under the cutoff
+        bound = limit if best is None else best - 1
         total = 0
         for i in range(la):
             total += hamming64(hashes_a[i], hashes_b[i + offset])
-        avg = total / la
-        if avg < best:
-            best = avg
+            if bound is not None and total > bound:
+                break
+        else:
+            best = total
+            if best == 0:
+                break  # a perfect match can't be beaten
+
+    return float("inf") if best is None else best / la
+
+
+def window_search(a, b, limit=None):
+    # (lowest window total, or None if every one is over limit; popcounts
+    # done) for uint64 arrays with a.size <= b.size. Offsets go OFFSET_BLOCK
+    # at a time, the limit tightening to just below each block's best; within
+    # a block the first FRAME_SPLIT of the frames are summed for every offset
+    # and the rest only for the offsets still under the limit.
+    la = a.size
+    # one row per offset: windows[offset, i] == b[i + offset]
+    windows = sliding_window_view(b, la)
+    if windows.size <= BOUND_MIN_WORK or (
+        limit is None and len(windows) <= OFFSET_BLOCK
+    ):
+        # summed in one go, the common case in count mode: blocks this small
+        # would not be split, so the limit could not save a popcount
+        best = int(popcount64(windows ^ a).sum(axis=1, dtype=np.int64).min())
+        return (None if limit is not None and best > limit else best), windows.size
+    best, done = None, 0
+    for first in range(0, len(windows), OFFSET_BLOCK):
+        block = windows[first : first + OFFSET_BLOCK]
+        split = la
+        if limit is not None and block.size > BOUND_MIN_WORK:
+            split = max(int(la * FRAME_SPLIT), 1)
+        totals = popcount64(block[:, :split] ^ a[:split]).sum(axis=1, dtype=np.int64)
+        done += totals.size * split
+        if split < la:
+            rows = np.flatnonzero(totals <= limit)
+            rest = popcount64(block[rows, split:] ^ a[split:])
+            totals = totals[rows] + rest.sum(axis=1, dtype=np.int64)
+            done += rest.size
+        low = int(totals.min()) if totals.size else None
+        if low is not None and (limit is None or low <= limit):
+            best = low
+            if best == 0:
+                break  # a perfect match can't be beaten
+            limit = best - 1
+    return best, done
+
+
+def sliding_window_score_np(hashes_a, hashes_b, cutoff=None):
+    a, b = to_hash_array(hashes_a), to_hash_array(hashes_b)
+    if not a.size or not b.size:
+        return float("inf")
+
+    if a.size > b.size:
+        a, b = b, a
+
+    la = a.size
+    if (b.size - la + 1) * la <= BOUND_MIN_WORK:
+        # window_search sums this in one go whatever the limit, so the cutoff
+        # is checked on the score instead, which total_limit agrees with
+        score = window_search(a, b)[0] / la
+        return score if cutoff is None or score <= cutoff else float("inf")
+    best, _ = window_search(a, b, total_limit(cutoff, la))
+    # best / la is the same float the python loop ends up with
+    return float("inf") if best is None else best / la
+
 
-    return best
+def sliding_window_score_verify(hashes_a, hashes_b, cutoff=None):
+    expected = sliding_window_score(
+        list(map(int, hashes_a)), list(map(int, hashes_b)), cutoff
+    )
+    got = sliding_window_score_np(hashes_a, hashes_b, cutoff)
+    if got != expected:
+        raise AssertionError(f"numpy engine scored {got}, python engine {expected}")
+    return got
+
+
+ENGINES = {
+    "python": sliding_window_score,
+    "numpy": sliding_window_score_np,
+    "verify": sliding_window_score_verify,
+}
+
+
+def get_scorer(engine=None):
+    engine = engine or SIM_ENGINE
+    if engine not in ENGINES:
+        raise ValueError(f"unknown similarity engine: {engine}")
+    return ENGINES[engine]
+
+
+def as_scorer_input(scorer, hashes):
+    # the reference engine works on python ints, the others on uint64 arrays
+    if scorer is sliding_window_score:
+        return [int(h) for h in hashes]
+    return hashes
 
 
 def resolution_class(h):
@@ -47,7 +206,7 @@ def passes_blocking(meta_a, meta_b):
         return False
 
     fa, fb = meta_a["frame_count"], meta_b["frame_count"]
-    if fa and fb:
+    if FRAMECOUNT_TOL and fa and fb:
         if abs(fa - fb) > FRAMECOUNT_TOL * max(fa, fb):
             return False
 
@@ -57,46 +216,326 @@ def passes_blocking(meta_a, meta_b):
     return True
 
 
-def main(db_path):
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
+def build_blocking_index(metadata, vids):
+    # resolution_class -> (durations, positions in vids), sorted by duration
+    buckets = defaultdict(list)
+    for pos, vid in enumerate(vids):
+        meta = metadata.get(vid)
+        if meta is None:
+            continue
+        buckets[resolution_class(meta["height"])].append((meta["duration"], pos))
+    index = {}
+    for cls, bucket in buckets.items():
+        bucket.sort()
+        index[cls] = ([d for d, _ in bucket], [p for _, p in bucket])
+    return index
+
+
+def blocking_add(index, key, meta):
+    # insert into a build_blocking_index-style index, keeping durations sorted
+    durations, keys = index.setdefault(resolution_class(meta["height"]), ([], []))
+    i = bisect_right(durations, meta["duration"])
+    durations.insert(i, meta["duration"])
+    keys.insert(i, key)
+
+
+def blocking_window(index, meta):
+    # keys whose duration is within DURATION_TOL in the same resolution class
+    bucket = index.get(resolution_class(meta["height"]))
+    if not bucket:
+        return []
+    durations, keys = bucket
+    lo = bisect_left(durations, meta["duration"] - DURATION_TOL - 1e-6)
+    hi = bisect_right(durations, meta["duration"] + DURATION_TOL + 1e-6)
+    return keys[lo:hi]
+
+
+def candidate_pairs(index, metadata, vids, only=None, shard=None):
+    # all blocked pairs, or with `only` just the pairs touching those videos;
+    # shard=(k, n) keeps the pairs whose outer video position is k modulo n
+    for durations, positions in index.values():
+        for i, (dur, pos_a) in enumerate(zip(durations, positions)):
+            if shard is not None and pos_a % shard[1] != shard[0]:
+                continue
+            if only is None:
+                lo = i + 1
+            elif vids[pos_a] in only:
+                lo = bisect_left(durations, dur - DURATION_TOL - 1e-6)
+            else:
+                continue
+            # durations[lo:hi] covers everything within DURATION_TOL (plus a hair
+            # for float rounding); passes_blocking makes the exact call
+            hi = bisect_right(durations, dur + DURATION_TOL + 1e-6, lo=i + 1)
+            for j in range(lo, hi):
+                pos_b = positions[j]
+                if j == i or (j < i and vids[pos_b] in only):
+                    continue  # self, or emitted while visiting the other side
+                a, b = vids[min(pos_a, pos_b)], vids[max(pos_a, pos_b)]
+                if passes_blocking(metadata[a], metadata[b]):
+                    yield a, b
+
 
-    cur.execute("""
-        SELECT video_id, duration, frame_count, height
-        FROM video_metadata
-    """)
-    metadata = {
-        vid: {"duration": dur, "frame_count": fc, "height": h}
-        for vid, dur, fc, h in cur.fetchall()
-    }
+def index_candidate_pairs(index, hashes, metadata, vids, only=None, shard=None):
+    # pairs where either side has enough near frames in the other, per the index
+    positions = {vid: i for i, vid in enumerate(vids)}
+    seen = set()
+    for pos_a, a in enumerate(vids):
+        if shard is not None and pos_a % shard[1] != shard[0]:
+            continue
+        if only is not None and a not in only:
+            continue
+        for b in index.query(hashes[a]):
+            if b == a or b not in positions:
+                continue
+            pair = (a, b) if positions[a] < positions[b] else (b, a)
+            if pair in seen:
+                continue
+            seen.add(pair)
+            if (
+                a in metadata
+                and b in metadata
+                and passes_blocking(metadata[a], metadata[b])
+            ):
+                yield pair
+
+
+def changed_videos(cur, vids):
+    # hashed videos that are new since the last similarity run, or whose file or
+    # hash rows changed since then, as {video_id: (size_bytes, mtime, n_hashes)}
+    cur.execute("SELECT video_id, size_bytes, mtime, n_hashes FROM similarity_state")
+    state = {vid: tuple(rest) for vid, *rest in cur.fetchall()}
+    current = hashed_fingerprints(cur)
+    return {
+        vid: current[vid]
+        for vid in vids
+        if vid in current and state.get(vid) != current[vid]
+    }, state
+
+
+def record_scored(cur, fingerprints):
+    cur.executemany(
+        """
+        INSERT OR REPLACE INTO similarity_state
+        (video_id, size_bytes, mtime, n_hashes, scored_at)
+        VALUES (?, ?, ?, ?, strftime('%s','now'))
+    """,
+        [(vid, *fp) for vid, fp in fingerprints.items()],
+    )
+
+
+_shard = {}
+
+
+def init_shard_worker(corpus_file, metadata, engine, index_file):
+    # hashes are memory-mapped from the corpus file, so every worker shares the
+    # page cache instead of receiving its own pickled copy
+    corpus = open_corpus(corpus_file)
+    scorer = get_scorer(engine)
+    hashes = {vid: as_scorer_input(scorer, h) for vid, h in corpus.items()}
+    vids = corpus.vids
+    _shard.update(
+        scorer=scorer,
+        hashes=hashes,
+        vids=vids,
+        positions=corpus.positions,
+        signatures=corpus.signatures,
+        lengths=np.diff(corpus.offsets),
+        metadata=metadata,
+        use_index=index_file is not None,
+        index=(
+            MultiIndex.load(index_file)
+            if index_file is not None
+            else build_blocking_index(metadata, vids)
+        ),
+    )
+
+
+def covering_jobs(cur, only, vids, positions):
+    # Which other videos' sim jobs score their pairs with each video of the
+    # batch `only`. A job leaves a pair with a video whose job is open when it
+    # is claimed to whichever of the two has the larger id. So for a batch
+    # video enqueued at t, that holds for every job still open and every done
+    # one claimed at or after t; a job claimed before t scored the pair against
+    # the video's old hashes, or not at all, and doesn't count.
+    # -> ({video_id: k}, [packed flags by position, one per distinct t])
+    since, covered = {}, []
+    by_time = defaultdict(list)
+    for vid, t in enqueue_times(cur, "sim", only).items():
+        by_time[t].append(vid)
+    for t, batch_vids in by_time.items():
+        flags = np.zeros(len(vids), dtype=bool)
+        for vid in open_or_claimed_since(cur, "sim", t):
+            if vid in positions:
+                flags[positions[vid]] = True
+        for vid in batch_vids:
+            since[vid] = len(covered)
+        covered.append(np.packbits(flags))
+    return since, covered
+
+
+def score_shard(task):
+    # task: (shard, only, since, covered), see covering_jobs. A pair between a
+    # video in `only` and one outside it is scored here unless the other
+    # video's job covers it and has the larger id, so every pair is scored by
+    # exactly one job, whatever order the batches run in.
+    shard, only, since, covered = task
+    st = _shard
+    if st["use_index"]:
+        pairs = index_candidate_pairs(
+            st["index"], st["hashes"], st["metadata"], st["vids"], only, shard
+        )
+    else:
+        pairs = candidate_pairs(st["index"], st["metadata"], st["vids"], only, shard)
 
-    cur.execute("SELECT DISTINCT video_id FROM video_hashes")
-    vids = [r[0] for r in cur.fetchall()]
+    covered = [
+        np.unpackbits(flags, count=len(st["vids"])).astype(bool) for flags in covered
+    ]
 
-    hashes = {}
-    for vid in vids:
-        cur.execute(
+    def owned(pair):
+        a, b = pair
+        if (a in only) != (b in only):
+            mine, other = (a, b) if a in only else (b, a)
+            if mine < other:
+                return not covered[since[mine]][st["positions"][other]]
+        return True
+
+    pairs = filter(owned, pairs)
+    rows, n_pairs, n_rejected = [], 0, 0
+    while batch := list(islice(pairs, SIGNATURE_BATCH)):
+        n_pairs += len(batch)
+        if SIM_SIGNATURE:
+            pa = np.array([st["positions"][a] for a, _ in batch])
+            pb = np.array([st["positions"][b] for _, b in batch])
+            bound = bit_count_bound(
+                st["signatures"][pa],
+                st["lengths"][pa],
+                st["signatures"][pb],
+                st["lengths"][pb],
+            )
+            keep = bound <= HAMMING_THRESHOLD
+            n_rejected += len(batch) - int(keep.sum())
+            batch = [pair for pair, k in zip(batch, keep) if k]
+        for a, b in batch:
+            score = st["scorer"](st["hashes"][a], st["hashes"][b], HAMMING_THRESHOLD)
+            if score <= HAMMING_THRESHOLD:
+                rows.append((a, b, score))
+    return rows, n_pairs, n_rejected
+
+
+def write_results(cur, results):
+    # single writer: the parent inserts every shard's rows
+    n_pairs = n_rejected = 0
+    for rows, n, rejected in results:
+        n_pairs += n
+        n_rejected += rejected
+        cur.executemany(
             """
-            SELECT frame_index, phash FROM video_hashes
-            WHERE video_id = ? ORDER BY frame_index
+            INSERT OR REPLACE INTO video_similarity(video_id_a, video_id_b, avg_hamming)
+            VALUES (?, ?, ?)
         """,
-            (vid,),
+            rows,
         )
-        hashes[vid] = [row[1] for row in cur.fetchall()]
+    return n_pairs, n_rejected
 
-    for a, b in combinations(vids, 2):
-        if not passes_blocking(metadata[a], metadata[b]):
-            continue
 
-        score = sliding_window_score(hashes[a], hashes[b])
-        if score <= HAMMING_THRESHOLD:
-            cur.execute(
-                """
-                INSERT OR REPLACE INTO video_similarity(video_id_a, video_id_b, avg_hamming)
-                VALUES (?, ?, ?)
-            """,
-                (a, b, score),
+def main(db_path, engine=None, use_index=None, incremental=None, workers=None):
+    get_scorer(engine)
+    workers = SIM_WORKERS if workers is None else workers
+    use_index = SIM_USE_INDEX if use_index is None else use_index
+    incremental = SIM_INCREMENTAL if incremental is None else incremental
+    with reader(db_path) as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT video_id, duration, frame_count, height
+            FROM video_metadata
+        """)
+        metadata = {
+            vid: {"duration": dur, "frame_count": fc, "height": h}
+            for vid, dur, fc, h in cur.fetchall()
+        }
+
+        store = refresh_corpus(cur, corpus_path(db_path))
+        vids = store.vids
+        changed, state = changed_videos(cur, vids)
+        open_jobs = unfinished(cur, "sim")
+
+        if use_index:
+            # sync and save once here; the workers open the saved file
+            load_index(cur, index_path(db_path), store)
+
+    with writer(db_path) as conn:
+        cur = conn.cursor()
+        if incremental:
+            enqueue(cur, "sim", changed)
+            # pairs scored against the old content of a changed video are stale
+            cur.executemany(
+                "DELETE FROM video_similarity WHERE video_id_a = ? OR video_id_b = ?",
+                [(vid, vid) for vid in changed if vid in state],
             )
+            print(f"sim: incremental run, {len(changed)} new or changed videos")
+        elif open_jobs:
+            print(f"sim: resuming, {len(open_jobs)} videos left from an earlier run")
+        else:
+            enqueue(cur, "sim", vids)
+
+    n_shards = workers * SHARDS_PER_WORKER if workers > 1 else 1
+    n_pairs = n_rejected = 0
+    positions = store.positions
+
+    # next to the corpus, so pinning it is a hard link rather than a copy
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(store.path) or ".") as tmp:
+        corpus_file = os.path.join(tmp, "hashes.bin")
+        pin_corpus(store, corpus_file)
+        initargs = (
+            corpus_file,
+            metadata,
+            engine,
+            index_path(db_path) if use_index else None,
+        )
+        pool = Pool(workers, init_shard_worker, initargs) if workers > 1 else None
+        if pool is None:
+            init_shard_worker(*initargs)
+        skipped = []
+        try:
+            # one claimed batch at a time, committed with its similarity rows
+            # and similarity_state, so an interrupted run loses one batch
+            while True:
+                with writer(db_path) as conn:
+                    batch = claim(conn, "sim", SIM_BATCH)
+                    # hashed after this process loaded the store; handed back
+                    # once the run is over so this loop doesn't claim them again
+                    skipped += [vid for vid in batch if vid not in positions]
+                    only = {vid for vid in batch if vid in positions}
+                    since, covered = covering_jobs(conn.cursor(), only, vids, positions)
+                if not batch:
+                    break
+                tasks = [((k, n_shards), only, since, covered) for k in range(n_shards)]
+                results = list(
+                    pool.imap_unordered(score_shard, tasks)
+                    if pool is not None
+                    else map(score_shard, tasks)
+                )
+
+                with writer(db_path) as conn:
+                    cur = conn.cursor()
+                    n, rejected = write_results(cur, results)
+                    n_pairs += n
+                    n_rejected += rejected
+                    record_scored(
+                        cur, {vid: changed[vid] for vid in only if vid in changed}
+                    )
+                    finish(cur, "sim", [(vid, None, None) for vid in only])
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            _shard.clear()
+            with writer(db_path) as conn:
+                release(conn.cursor(), "sim", skipped)
 
-    conn.commit()
-    conn.close()
+    baseline = len(vids) * (len(vids) - 1) // 2
+    print(
+        f"sim: {n_pairs} candidate pairs out of {baseline} all-pairs "
+        f"({100.0 * n_pairs / baseline if baseline else 0.0:.2f}%), "
+        f"{n_rejected} rejected by signature"
+    )
@@ -0,0 +1,333 @@
+import os, queue, threading, time
+import numpy as np
+from multiprocessing import Pool
+
+from scan_folders import main as scan_main
+from prehash import copy_exact, main as prehash_main
+from extract_metadata import (
+    WORKERS as META_WORKERS,
+    pending_probes,
+    probe_job,
+    record_probe,
+    store_metadata,
+)
+from compute_hashes import (
+    WORKERS as HASH_WORKERS,
+    hash_video,
+    pending_hash_jobs,
+    store_samples,
+    store_timing,
+)
+from db import reader, writer
+from hamming import bit_count_bound, bit_counts, to_hash_array
+from hash_corpus import corpus_path, refresh_corpus
+from hash_store import store_hashes
+from jobs import complete
+from similarity import (
+    HAMMING_THRESHOLD,
+    SIM_SIGNATURE,
+    as_scorer_input,
+    blocking_add,
+    blocking_window,
+    changed_videos,
+    get_scorer,
+    passes_blocking,
+    record_scored,
+)
+from cluster import main as cluster_main
+from canonical import main as canon_main
+
+# Streaming run: after the scan, every pending video flows
+#   probe threads -> hash processes -> scorer -> writer
+# through bounded queues, so a full queue stalls the stage feeding it instead
+# of buffering the whole library. Clusters are refreshed while work is in flight.
+QUEUE_SIZE = int(os.environ.get("STREAM_QUEUE", 256))
+COMMIT_EVERY = float(os.environ.get("STREAM_COMMIT_EVERY", 5))  # seconds
+CLUSTER_EVERY = float(os.environ.get("STREAM_CLUSTER_EVERY", 120))  # seconds
+
+_DONE = object()
+
+
+def run_stage_threads(fn, inbox, outbox, workers, stop):
+    # `workers` threads move items from inbox through fn to outbox (None drops
+    # the item); outbox gets _DONE once inbox is drained and every thread is
+    # idle. Once `stop` is set items are taken and dropped, so the stages
+    # upstream don't stay blocked on a full queue.
+    def work():
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                inbox.put(_DONE)  # wake the sibling threads too
+                return
+            if stop.is_set():
+                continue
+            try:
+                out = fn(item)
+            except Exception as e:
+                print(f"stream: {fn.__name__} failed for {item['path']}: {e!r}")
+                continue
+            if out is not None:
+                outbox.put(out)
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(workers)]
+    for t in threads:
+        t.start()
+
+    def close():
+        for t in threads:
+            t.join()
+        outbox.put(_DONE)
+
+    threading.Thread(target=close, daemon=True).start()
+
+
+def pending_work(cur, store):
+    # one item per video with anything left to do, keyed by video id
+    cur.execute("SELECT video_id, path, size_bytes, mtime FROM videos")
+    videos = {vid: (path, size, mtime) for vid, path, size, mtime in cur.fetchall()}
+    items = {}
+
+    def item(vid):
+        if vid not in items:
+            path, size, mtime = videos[vid]
+            items[vid] = {
+                "vid": vid,
+                "path": path,
+                "size": size,
+                "mtime": mtime,
+                "probe": False,
+                "hash": False,
+                "hashes": None,
+            }
+        return items[vid]
+
+    # hashed but never scored (e.g. an interrupted run) go first: they need
+    # no decoding, so their pairs show up right away
+    changed, state = changed_videos(cur, store.vids)
+    for vid in changed:
+        item(vid)["hashes"] = store[vid]
+    for vid, *_ in pending_probes(cur):
+        item(vid)["probe"] = True
+    for vid, _ in pending_hash_jobs(cur):
+        item(vid)["hash"] = True
+    return list(items.values()), state
+
+
+def apply_op(cur, op, state):
+    # -> True if similarity rows were written
+    kind, vid, *rest = op
+    if kind == "meta":
+        fields, size, mtime = rest
+        store_metadata(cur, vid, fields)
+        record_probe(cur, vid, size, mtime)
+        complete(cur, "meta", [vid])
+    elif kind == "hashes":
+        frame_hashes, timing = rest
+        store_hashes(cur, vid, frame_hashes)
+        store_timing(cur, vid, timing)
+        store_samples(cur, vid, timing)
+        complete(cur, "hash", [vid])
+    elif kind == "pairs":
+        rows, fingerprint = rest
+        if vid in state:
+            # pairs scored against the old content are stale
+            cur.execute(
+                "DELETE FROM video_similarity WHERE video_id_a = ? OR video_id_b = ?",
+                (vid, vid),
+            )
+        cur.executemany(
+            """
+            INSERT OR REPLACE INTO video_similarity(video_id_a, video_id_b, avg_hamming)
+            VALUES (?, ?, ?)
+        """,
+            rows,
+        )
+        record_scored(cur, {vid: fingerprint})
+        complete(cur, "sim", [vid])
+        return bool(rows)
+    return False
+
+
+def main(db_path, roots, engine=None):
+    scorer = get_scorer(engine)
+    scan_main(db_path, roots)
+    # exact copies skip probing, hashing and scoring; they are filled in from
+    # their source once it is done
+    prehash_main(db_path)
+
+    # pending_probes backfills probe records, so this goes through the writer
+    with writer(db_path) as conn:
+        cur = conn.cursor()
+        store = refresh_corpus(cur, corpus_path(db_path))
+        items, state = pending_work(cur, store)
+        cur.execute(
+            "SELECT video_id, duration, frame_count, height FROM video_metadata"
+        )
+        metadata = {
+            vid: {"duration": dur, "frame_count": fc, "height": h}
+            for vid, dur, fc, h in cur.fetchall()
+        }
+    pending = {it["vid"] for it in items if it["hash"] or it["hashes"] is not None}
+    print(f"stream: {len(items)} videos queued, {len(pending)} to score")
+
+    # videos already scored are the corpus every new video is matched against
+    hashes, signatures, index = {}, {}, {}
+    for i, (vid, h) in enumerate(store.items()):
+        if vid in pending or vid not in metadata:
+            continue
+        hashes[vid] = as_scorer_input(scorer, h)
+        signatures[vid] = (store.signatures[i], len(h))
+        blocking_add(index, vid, metadata[vid])
+    del store
+
+    to_probe = queue.Queue(QUEUE_SIZE)
+    to_hash = queue.Queue(QUEUE_SIZE)
+    to_score = queue.Queue(QUEUE_SIZE)
+    to_write = queue.Queue(QUEUE_SIZE)
+    stats = {"probed": 0, "hashed": 0, "scored": 0, "pairs": 0}
+    stats_lock = threading.Lock()
+    stop, failures = threading.Event(), []
+
+    def count(key, n=1):
+        with stats_lock:
+            stats[key] += n
+
+    def probe_stage(it):
+        if it["probe"]:
+            _, fields = probe_job((it["vid"], it["path"], it["size"], it["mtime"]))
+            # a failed probe still gets hashed, it just can't be scored yet
+            if fields is not None:
+                to_write.put(("meta", it["vid"], fields, it["size"], it["mtime"]))
+                duration, frame_count, _, height = fields[:4]
+                metadata[it["vid"]] = {
+                    "duration": duration,
+                    "frame_count": frame_count,
+                    "height": height,
+                }
+                count("probed")
+        return it if it["hash"] or it["hashes"] is not None else None
+
+    def hash_stage(it):
+        if it["hash"]:
+            # one thread per pool process: a busy pool blocks the thread, and a
+            # blocked thread stops taking from to_hash
+            vid, frame_hashes, timing = pool.apply(
+                hash_video, ((it["vid"], it["path"]),)
+            )
+            if not frame_hashes:
+                return None
+            to_write.put(("hashes", vid, frame_hashes, timing))
+            it["hashes"] = to_hash_array([h for _, h in frame_hashes])
+            count("hashed")
+        return it
+
+    def score_stage(it):
+        # every new video is scored against what came before it, then joins
+        # the corpus, so each pair is scored exactly once
+        vid = it["vid"]
+        meta = metadata.get(vid)
+        if meta is None:
+            return None
+        mine = as_scorer_input(scorer, it["hashes"])
+        signature = (bit_counts(it["hashes"]), len(it["hashes"]))
+        others = [
+            other
+            for other in blocking_window(index, meta)
+            if passes_blocking(meta, metadata[other])
+        ]
+        if SIM_SIGNATURE and others:
+            bound = bit_count_bound(
+                signature[0],
+                signature[1],
+                np.array([signatures[other][0] for other in others]),
+                np.array([signatures[other][1] for other in others]),
+            )
+            others = [
+                other for other, b in zip(others, bound) if b <= HAMMING_THRESHOLD
+            ]
+        rows = []
+        for other in others:
+            score = scorer(mine, hashes[other], HAMMING_THRESHOLD)
+            if score <= HAMMING_THRESHOLD:
+                rows.append((vid, other, score))
+        hashes[vid] = mine
+        signatures[vid] = signature
+        blocking_add(index, vid, meta)
+        to_write.put(("pairs", vid, rows, (it["size"], it["mtime"], len(mine))))
+        count("scored")
+        count("pairs", len(rows))
+        return None
+
+    def write_loop():
+        # the only thread writing to the database: ops are gathered for
+        # COMMIT_EVERY seconds and applied under one write lock and commit
+        last_cluster = time.time()
+        dirty, done = False, False
+        try:
+            while not done:
+                ops, deadline = [], time.time() + COMMIT_EVERY
+                while (left := deadline - time.time()) > 0:
+                    try:
+                        op = to_write.get(timeout=left)
+                    except queue.Empty:
+                        break
+                    if op is _DONE:
+                        done = True
+                        break
+                    ops.append(op)
+                if ops:
+                    with writer(db_path) as conn:
+                        cur = conn.cursor()
+                        for op in ops:
+                            dirty = apply_op(cur, op, state) or dirty
+                # upstream stages just back up while clusters are rebuilt
+                if dirty and not done and time.time() - last_cluster >= CLUSTER_EVERY:
+                    refresh_clusters(db_path, stats)
+                    last_cluster, dirty = time.time(), False
+        except BaseException as e:
+            # a failed write (database error, full disk) ends the run: the
+            # stages stop, and to_write is emptied until the scorer is done so
+            # none of them stays blocked on it; main raises the error
+            print(f"stream: writer failed: {e!r}")
+            failures.append(e)
+            stop.set()
+            while not done:
+                done = to_write.get() is _DONE
+
+    t0 = time.time()
+    with Pool(HASH_WORKERS) as pool:
+        write_thread = threading.Thread(target=write_loop, daemon=True)
+        write_thread.start()
+        run_stage_threads(probe_stage, to_probe, to_hash, META_WORKERS, stop)
+        run_stage_threads(hash_stage, to_hash, to_score, HASH_WORKERS, stop)
+        # the scorer is the last stage to finish, so its _DONE ends the writer
+        run_stage_threads(score_stage, to_score, to_write, 1, stop)
+        for it in items:
+            if stop.is_set():
+                break
+            to_probe.put(it)
+        to_probe.put(_DONE)
+        write_thread.join()
+        if failures:
+            raise failures[0]
+
+    with writer(db_path) as conn:
+        copy_exact(conn.cursor())
+    refresh_clusters(db_path, stats)
+    with reader(db_path) as conn:
+        refresh_corpus(conn.cursor(), corpus_path(db_path))
+    print(
+        f"stream: done in {time.time() - t0:.1f}s; {stats['probed']} probed, "
+        f"{stats['hashed']} hashed, {stats['scored']} scored, "
+        f"{stats['pairs']} similar pairs"
+    )
+
+
+def refresh_clusters(db_path, stats):
+    t0 = time.time()
+    cluster_main(db_path)
+    canon_main(db_path)
+    print(
+        f"stream: clusters refreshed in {time.time() - t0:.1f}s "
+        f"({stats['scored']} videos scored so far)"
+    )
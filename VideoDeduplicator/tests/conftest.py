@@ -0,0 +1,22 @@
+import os, sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+# the modules under src/ import each other by their bare names
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    # an empty database: schema.sql, then the migrations on first open
+    from db import connect
+    from migrations import migrate
+
+    path = str(tmp_path / "videos.db")
+    conn = connect(path)
+    with open(os.path.join(ROOT, "schema.sql")) as f:
+        conn.executescript(f.read())
+    migrate(conn)
+    conn.close()
+    return path
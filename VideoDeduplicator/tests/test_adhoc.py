@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+import adhoc
+from db import writer
+from extract_metadata import store_metadata
+from hash_store import store_hashes
+from similarity import sliding_window_score_np
+
+# duration, frame_count, width, height, codec, bitrate, container, fps
+FIELDS = (60.0, 1500, 1280, 720, "h264", 1000000, "mp4", 25.0)
+FRAMES = 32
+
+
+@pytest.fixture
+def library(db_path, tmp_path, monkeypatch):
+    # a copy of the ad-hoc video's frames and an all-black video, with the same
+    # metadata so both pass blocking; ffprobe and decoding are stubbed
+    rng = np.random.default_rng(0)
+    frames = [int(h) for h in rng.integers(0, 2**63, FRAMES, dtype=np.uint64)]
+    library = {"copy": frames, "black": [0] * FRAMES}
+    with writer(db_path) as conn:
+        cur = conn.cursor()
+        for vid, hashes in library.items():
+            cur.execute(
+                "INSERT INTO videos(video_id, path, size_bytes, mtime)"
+                " VALUES (?, ?, ?, ?)",
+                (vid, f"/videos/{vid}.mp4", 1, 0.0),
+            )
+            store_metadata(cur, vid, FIELDS)
+            store_hashes(cur, vid, list(enumerate(hashes)))
+
+    scored = []
+
+    def scorer(a, b, cutoff):
+        scored.append(b.tolist())
+        return sliding_window_score_np(a, b, cutoff)
+
+    monkeypatch.setattr(adhoc, "get_scorer", lambda engine=None: scorer)
+    monkeypatch.setattr(adhoc, "probe", lambda path: None)
+    monkeypatch.setattr(adhoc, "parse_probe", lambda meta: FIELDS)
+    monkeypatch.setattr(
+        adhoc, "hash_video", lambda job: (job[0], list(enumerate(frames)), None)
+    )
+    path = tmp_path / "new.mp4"
+    path.write_bytes(b"new video")
+    return str(path), library, scored
+
+
+def similar_to(db_path, vid):
+    with writer(db_path) as conn:
+        return conn.execute(
+            "SELECT video_id_b, avg_hamming FROM video_similarity WHERE video_id_a = ?",
+            (vid,),
+        ).fetchall()
+
+
+def test_signature_bound_skips_candidates_before_scoring(db_path, library):
+    path, hashes, scored = library
+    result = adhoc.process_single_video(db_path, path)
+    # the black video's bound is far over the threshold, so it is never scored
+    assert scored == [hashes["copy"]]
+    assert similar_to(db_path, result["video_id"]) == [("copy", 0.0)]
+
+
+def test_signature_bound_only_saves_work(db_path, library, monkeypatch):
+    path, hashes, scored = library
+    monkeypatch.setattr(adhoc, "SIM_SIGNATURE", False)
+    result = adhoc.process_single_video(db_path, path)
+    assert sorted(scored) == sorted(hashes.values())
+    assert similar_to(db_path, result["video_id"]) == [("copy", 0.0)]
@@ -0,0 +1,154 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("httpx")
+from fastapi.testclient import TestClient
+
+import adhoc
+import api_app
+from adhoc import AdhocJobs
+from db import writer
+
+
+@pytest.fixture
+def client(db_path, monkeypatch):
+    # two clusters of two videos; only the first has a path under /a/
+    with writer(db_path) as conn:
+        conn.executemany(
+            "INSERT INTO videos VALUES (?, ?, 1, 0, 0)",
+            [
+                ("v1", "/a/1.mp4"),
+                ("v2", "/b/2.mp4"),
+                ("v3", "/b/3.mp4"),
+                ("v4", "/b/4.mp4"),
+            ],
+        )
+        conn.executemany(
+            "INSERT INTO duplicate_clusters VALUES (?, ?)",
+            [(1, "v1"), (1, "v2"), (2, "v3"), (2, "v4")],
+        )
+        conn.executemany(
+            "INSERT INTO canonical_videos VALUES (?, ?)", [(1, "v1"), (2, "v3")]
+        )
+    monkeypatch.setattr(api_app, "DB_PATH", db_path)
+    # a pool of this test's own, made on first use
+    monkeypatch.setattr(api_app, "_adhoc_jobs", None)
+    return TestClient(api_app.app)
+
+
+def test_list_clusters(client):
+    rows = client.get("/clusters").json()
+    assert [(r["cluster_id"], r["count"]) for r in rows] == [(1, 2), (2, 2)]
+    assert client.get("/clusters?min_size=3").json() == []
+
+
+def test_list_clusters_by_path(client):
+    # count and min_size apply to the members whose path matches
+    response = client.get("/clusters?q=/a/&min_size=1")
+    assert response.status_code == 200
+    assert [(r["cluster_id"], r["count"]) for r in response.json()] == [(1, 1)]
+    rows = client.get("/clusters?q=/b/").json()
+    assert [(r["cluster_id"], r["count"]) for r in rows] == [(2, 2)]
+
+
+@pytest.fixture
+def processed(monkeypatch):
+    # stands in for process_single_video: records its calls, and holds each
+    # one until `release` is set; a path ending in .bad fails
+    calls, release = [], threading.Event()
+
+    def fake(db_path, path):
+        calls.append((db_path, path))
+        release.wait(10)
+        if path.endswith(".bad"):
+            raise ValueError("not a video")
+        return {"video_id": "x", "cluster_id": None}
+
+    monkeypatch.setattr(adhoc, "process_single_video", fake)
+    return calls, release
+
+
+def wait_for(client, job_id):
+    for _ in range(500):
+        job = client.get(f"/adhoc/{job_id}").json()
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} never finished")
+
+
+def video_file(tmp_path, name):
+    path = tmp_path / name
+    path.write_bytes(b"")
+    return str(path)
+
+
+def test_adhoc_pool_is_made_for_the_current_database(client, db_path):
+    assert api_app._adhoc_jobs is None
+    assert api_app.get_adhoc_jobs().db_path == db_path
+    assert api_app.get_adhoc_jobs() is api_app.get_adhoc_jobs()
+
+
+def test_adhoc_job_runs_and_reports(client, processed, tmp_path, db_path):
+    calls, release = processed
+    path = video_file(tmp_path, "a.mp4")
+    job = client.post("/adhoc", json={"path": path}).json()
+    assert job["status"] in ("queued", "running") and not job["coalesced"]
+    release.set()
+    done = wait_for(client, job["job_id"])
+    assert done["status"] == "done" and done["error"] is None
+    assert done["result"] == {"video_id": "x", "cluster_id": None}
+    assert calls == [(db_path, path)]
+
+
+def test_adhoc_coalesces_a_path_while_its_job_is_active(client, processed, tmp_path):
+    calls, release = processed
+    path = video_file(tmp_path, "a.mp4")
+    first = client.post("/adhoc", json={"path": path}).json()
+    again = client.post("/adhoc", json={"path": path}).json()
+    assert again["coalesced"] and again["job_id"] == first["job_id"]
+    release.set()
+    wait_for(client, first["job_id"])
+    # once it is done, the same path is a new job
+    later = client.post("/adhoc", json={"path": path}).json()
+    assert not later["coalesced"] and later["job_id"] != first["job_id"]
+    wait_for(client, later["job_id"])
+    assert len(calls) == 2
+
+
+def test_adhoc_reports_failures(client, processed, tmp_path):
+    _, release = processed
+    release.set()
+    job = client.post("/adhoc", json={"path": video_file(tmp_path, "a.bad")}).json()
+    failed = wait_for(client, job["job_id"])
+    assert failed["status"] == "failed"
+    assert failed["error"] == "ValueError: not a video"
+    assert failed["result"] is None
+
+
+def test_adhoc_rejects_missing_paths_and_unknown_jobs(client, tmp_path):
+    response = client.post("/adhoc", json={"path": str(tmp_path / "missing.mp4")})
+    assert response.json() == {"error": "path does not exist"}
+    assert client.get("/adhoc/nope").json() == {"error": "job not found"}
+
+
+def test_adhoc_forgets_the_oldest_finished_jobs(
+    client, processed, tmp_path, db_path, monkeypatch
+):
+    _, release = processed
+    release.set()
+    monkeypatch.setattr(api_app, "_adhoc_jobs", AdhocJobs(db_path, keep=2))
+    ids = []
+    for name in ("a.mp4", "b.mp4", "c.mp4", "d.mp4"):
+        job = client.post("/adhoc", json={"path": video_file(tmp_path, name)})
+        ids.append(job.json()["job_id"])
+        wait_for(client, ids[-1])
+    # trimmed when d was submitted: a and b had finished, c and d are kept
+    assert [client.get(f"/adhoc/{i}").json().get("status") for i in ids] == [
+        None,
+        None,
+        "done",
+        "done",
+    ]
@@ -0,0 +1,143 @@
+import random
+from collections import defaultdict
+
+import pytest
+
+import canonical
+import cluster
+from db import reader, writer
+from scan_folders import purge_videos
+
+THRESHOLD = 12.0
+VIDEOS = [f"v{i:02d}" for i in range(30)]
+
+
+def components(pairs):
+    # clusters from scratch: connected components of the pairs within threshold
+    graph = defaultdict(set)
+    for (a, b), score in pairs.items():
+        if score <= THRESHOLD:
+            graph[a].add(b)
+            graph[b].add(a)
+    seen, out = set(), set()
+    for start in graph:
+        if start in seen:
+            continue
+        stack, comp = [start], set()
+        while stack:
+            vid = stack.pop()
+            if vid not in comp:
+                comp.add(vid)
+                stack.extend(graph[vid] - comp)
+        seen |= comp
+        out.add(frozenset(comp))
+    return out
+
+
+def best_of(members, meta):
+    # canonical.score, ties to the lowest video id
+    return max(sorted(members), key=lambda vid: canonical.score(meta[vid]))
+
+
+def stored(db_path):
+    with reader(db_path) as conn:
+        clusters = defaultdict(set)
+        for cid, vid in conn.execute(
+            "SELECT cluster_id, video_id FROM duplicate_clusters"
+        ):
+            clusters[cid].add(vid)
+        canon = dict(conn.execute("SELECT * FROM canonical_videos"))
+        flags = {
+            vid: (dup, of)
+            for vid, dup, of in conn.execute("SELECT * FROM duplicate_flags")
+        }
+        # the forest left for the next run must hold the same clusters
+        forest = cluster.DisjointSet(conn.cursor())
+        roots = defaultdict(set)
+        for (vid,) in conn.execute("SELECT video_id FROM cluster_nodes"):
+            roots[forest.find(vid)].add(vid)
+    return clusters, canon, flags, {frozenset(vids) for vids in roots.values()}
+
+
+def add_video(cur, rng, vid, meta):
+    meta[vid] = {
+        "width": 1920,
+        "height": rng.choice([720, 1080]),
+        "bitrate": rng.choice([1, 2, 3]) * 10**6,
+        "codec": rng.choice(["h264", "hevc"]),
+        "container": "mp4",
+    }
+    m = meta[vid]
+    cur.execute("INSERT INTO videos VALUES (?, ?, 1, 0, 0)", (vid, f"/{vid}.mp4"))
+    cur.execute(
+        "INSERT INTO video_metadata VALUES (?, 60, 1800, ?, ?, ?, ?, ?, 30)",
+        (vid, m["width"], m["height"], m["codec"], m["bitrate"], m["container"]),
+    )
+
+
+def random_round(rng, cur, pairs, meta):
+    # pairs added, rescored and deleted, metadata changed, and now and then a
+    # video purged (its file is gone) or one of those back
+    if rng.random() < 0.3 and len(meta) > 10:
+        vid = rng.choice(sorted(meta))
+        purge_videos(cur, [vid])
+        del meta[vid]
+        for pair in [pair for pair in pairs if vid in pair]:
+            del pairs[pair]
+    if rng.random() < 0.3 and len(meta) < len(VIDEOS):
+        add_video(cur, rng, rng.choice(sorted(set(VIDEOS) - meta.keys())), meta)
+    for _ in range(rng.randint(1, 8)):
+        a, b = sorted(rng.sample(sorted(meta), 2))
+        op = rng.random()
+        if (a, b) in pairs and op < 0.4:
+            cur.execute(
+                "DELETE FROM video_similarity WHERE video_id_a = ? AND video_id_b = ?",
+                (a, b),
+            )
+            del pairs[a, b]
+        elif (a, b) in pairs:
+            pairs[a, b] = rng.choice([3.0, 11.5, 12.0, 13.0])
+            cur.execute(
+                "UPDATE video_similarity SET avg_hamming = ? "
+                "WHERE video_id_a = ? AND video_id_b = ?",
+                (pairs[a, b], a, b),
+            )
+        else:
+            pairs[a, b] = rng.choice([2.0, 8.0, 12.0, 14.0])
+            cur.execute(
+                "INSERT INTO video_similarity VALUES (?, ?, ?)", (a, b, pairs[a, b])
+            )
+    for vid in rng.sample(sorted(meta), rng.randint(0, 3)):
+        meta[vid]["bitrate"] = rng.choice([1, 2, 3]) * 10**6
+        cur.execute(
+            "UPDATE video_metadata SET bitrate = ? WHERE video_id = ?",
+            (meta[vid]["bitrate"], vid),
+        )
+
+
+@pytest.mark.parametrize("seed", range(6))
+def test_incremental_runs_match_a_full_recompute(db_path, seed):
+    rng = random.Random(seed)
+    meta = {}
+    with writer(db_path) as conn:
+        for vid in VIDEOS:
+            add_video(conn.cursor(), rng, vid, meta)
+
+    pairs = {}
+    for _ in range(40):
+        with writer(db_path) as conn:
+            random_round(rng, conn.cursor(), pairs, meta)
+        cluster.main(db_path, THRESHOLD)
+        canonical.main(db_path)
+
+        clusters, canon, flags, forest = stored(db_path)
+        expected = components(pairs)
+        assert {frozenset(vids) for vids in clusters.values()} == expected
+        assert forest == expected
+        assert canon.keys() == clusters.keys()
+        want_flags = {}
+        for cid, members in clusters.items():
+            best = best_of(members, meta)
+            assert canon[cid] == best
+            want_flags.update({vid: (int(vid != best), best) for vid in members})
+        assert flags == want_flags
@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+from db import connect, get_database, prepare, reader
+from migrations import MIGRATIONS, schema_version
+from pipeline import run_stage
+
+SCHEMA = os.path.join(os.path.dirname(__file__), "..", "schema.sql")
+
+
+@pytest.fixture
+def unmigrated(tmp_path):
+    # schema.sql only, as an older version of the pipeline left it
+    path = str(tmp_path / "old.db")
+    conn = connect(path)
+    with open(SCHEMA) as f:
+        conn.executescript(f.read())
+    conn.close()
+    return path
+
+
+def test_readers_only_connect(unmigrated):
+    with reader(unmigrated) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM videos").fetchone() == (0,)
+        assert schema_version(conn) == 0
+    assert get_database(unmigrated)._writer is None
+
+
+def test_prepare_migrates(unmigrated):
+    prepare(unmigrated)
+    with reader(unmigrated) as conn:
+        assert schema_version(conn) == MIGRATIONS[-1][0]
+
+
+def test_stages_prepare_the_database(unmigrated):
+    # cluster needs cluster_state, which only a migration creates
+    run_stage(unmigrated, [], "cluster")
+    with reader(unmigrated) as conn:
+        assert schema_version(conn) == MIGRATIONS[-1][0]
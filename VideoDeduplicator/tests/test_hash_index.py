@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+import hash_index
+from hamming import popcount64
+from hash_index import MultiIndex, open_index
+
+
+def brute_force(videos, q, max_dist, min_frames):
+    # every query frame against every frame of every video
+    min_frames = max(1, min(min_frames, len(q)))
+    out = {}
+    for vid, frames in videos.items():
+        dist = popcount64(q[:, None] ^ frames[None, :])
+        matched = int((dist <= max_dist).any(axis=1).sum())
+        if matched >= min_frames:
+            out[vid] = matched
+    return out
+
+
+def library(rng, n, frames=24):
+    # videos that are noisy copies of a few originals, so queries have hits
+    originals = rng.integers(0, 2**64, size=(max(n // 4, 1), frames), dtype=np.uint64)
+    videos = {}
+    for i in range(n):
+        noise = np.zeros(frames, dtype=np.uint64)
+        for _ in range(int(rng.integers(0, 12))):
+            noise ^= np.uint64(1) << rng.integers(0, 64, frames).astype(np.uint64)
+        videos[f"v{i}"] = originals[i % len(originals)] ^ noise
+    return videos
+
+
+def check(index, videos, rng, queries=20):
+    for vid in rng.choice(sorted(videos), queries):
+        q = videos[vid] ^ (np.uint64(1) << rng.integers(0, 64, 24).astype(np.uint64))
+        for max_dist, min_frames in [(8, 4), (5, 1), (12, 10)]:
+            assert index.query(q, max_dist, min_frames) == brute_force(
+                videos, q, max_dist, min_frames
+            )
+
+
+def test_query_matches_brute_force():
+    rng = np.random.default_rng(1)
+    videos = library(rng, 200)
+    index = MultiIndex()
+    index.add(videos.items())
+    check(index, videos, rng)
+
+
+@pytest.mark.parametrize("delta_min", [10**9, 0])
+def test_add_remove_and_reload(tmp_path, monkeypatch, delta_min):
+    # with delta_min=0 every change compacts, otherwise nothing does
+    monkeypatch.setattr(hash_index, "DELTA_MIN_FRAMES", delta_min)
+    monkeypatch.setattr(hash_index, "INDEX_DELTA_SHARE", 0.0 if not delta_min else 1e9)
+    rng = np.random.default_rng(2)
+    videos = library(rng, 300)
+    names = sorted(videos)
+    index = MultiIndex()
+    index.add((v, videos[v]) for v in names[:150])
+    live = {v: videos[v] for v in names[:150]}
+    path = str(tmp_path / "index.npz")
+    for step in range(5):
+        gone = list(rng.choice(sorted(live), 10, replace=False))
+        index.remove(gone)
+        for v in gone:
+            del live[v]
+        new = names[150 + 30 * step : 180 + 30 * step]
+        index.add((v, videos[v]) for v in new)
+        live.update((v, videos[v]) for v in new)
+        # a video removed and added again comes back with its new frames
+        again = gone[0]
+        live[again] = videos[again] ^ np.uint64(0xFF)
+        index.add([(again, live[again])])
+        index.save(path)
+
+        assert len(index) == len(live)
+        assert {v: f.tolist() for v, f in index.frames_by_video()} == {
+            v: f.tolist() for v, f in live.items()
+        }
+        check(index, live, rng, queries=5)
+        check(MultiIndex.load(path), live, rng, queries=5)
+
+
+def test_open_index_is_shared_until_the_file_changes(tmp_path):
+    rng = np.random.default_rng(3)
+    videos = library(rng, 20)
+    path = str(tmp_path / "index.npz")
+    index = open_index(path)
+    index.add(videos.items())
+    index.save(path)
+    assert open_index(path) is index
+
+    # another process writing the file makes the next open read it again
+    other = MultiIndex.load(path)
+    other.remove(["v0"])
+    other.save(path)
+    reopened = open_index(path)
+    assert reopened is not index
+    assert "v0" not in reopened and len(reopened) == len(videos) - 1
@@ -0,0 +1,47 @@
+import pytest
+
+import compute_hashes
+from db import writer
+from jobs import MAX_ATTEMPTS, claim, enqueue, finish, unfinished
+
+
+@pytest.fixture
+def failing(db_path):
+    # one unhashed video whose hash job has failed `attempts` times so far
+    def fail(attempts):
+        with writer(db_path) as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO videos VALUES ('v1', '/v1.mp4', 1, 0.0, 0.0)"
+            )
+            enqueue(conn.cursor(), "hash", ["v1"])
+        for _ in range(attempts):
+            with writer(db_path) as conn:
+                assert claim(conn, "hash", 10) == ["v1"]
+                finish(conn.cursor(), "hash", [("v1", "no frames decoded", None)])
+
+    return fail
+
+
+def open_hash_jobs(db_path):
+    with writer(db_path) as conn:
+        return unfinished(conn.cursor(), "hash")
+
+
+def test_failed_jobs_stay_unfinished_while_attempts_are_left(db_path, failing):
+    failing(MAX_ATTEMPTS - 1)
+    assert open_hash_jobs(db_path) == {"v1"}
+
+
+def test_jobs_out_of_attempts_are_not_unfinished(db_path, failing):
+    failing(MAX_ATTEMPTS)
+    assert open_hash_jobs(db_path) == set()
+
+
+def test_hash_stage_is_idle_with_only_exhausted_jobs(db_path, failing, monkeypatch):
+    failing(MAX_ATTEMPTS)
+
+    def no_pool(workers):
+        raise AssertionError("started a pool with nothing to claim")
+
+    monkeypatch.setattr(compute_hashes, "Pool", no_pool)
+    compute_hashes.main(db_path)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from phash import IMG_SIZE, gray32, phash_frames
+
+imagehash = pytest.importorskip("imagehash")
+Image = pytest.importorskip("PIL.Image")
+
+
+def frames():
+    # BGR frames: noise at common and odd resolutions, flat frames (where
+    # the DCT coefficients sit at ~0), gradients and blocky images
+    rng = np.random.default_rng(0)
+    out = [
+        rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        for h, w in [(32, 32), (360, 640), (480, 854), (720, 1280), (1080, 1920)]
+    ]
+    out += [rng.integers(0, 256, (33, 97, 3), dtype=np.uint8)]
+    out += [np.full((240, 320, 3), v, dtype=np.uint8) for v in (0, 16, 128, 255)]
+    ramp = np.linspace(0, 255, 320, dtype=np.uint8)
+    out.append(np.dstack([np.tile(ramp, (240, 1))] * 3))
+    out.append(
+        np.dstack(
+            [
+                np.tile(ramp[::-1], (240, 1)),
+                np.tile(ramp, (240, 1)),
+                np.full((240, 320), 77, dtype=np.uint8),
+            ]
+        )
+    )
+    for _ in range(200):
+        h, w = rng.integers(8, 400, 2)
+        base = rng.integers(0, 256, (h // 4 + 1, w // 4 + 1, 3), dtype=np.uint8)
+        out.append(np.kron(base, np.ones((4, 4, 1), dtype=np.uint8))[:h, :w])
+    return out
+
+
+def pil_gray32(frame):
+    img = Image.fromarray(frame[..., ::-1].copy()).convert("L")
+    return np.asarray(img.resize((IMG_SIZE, IMG_SIZE), Image.LANCZOS))
+
+
+def test_gray32_matches_pil():
+    for frame in frames():
+        assert np.array_equal(gray32(frame), pil_gray32(frame)), frame.shape
+
+
+def test_phash_matches_imagehash():
+    # rows already in video_hashes came from imagehash.phash, so the batched
+    # kernel has to agree with it bit for bit
+    batch = frames()
+    expected = [
+        int(str(imagehash.phash(Image.fromarray(f[..., ::-1].copy()))), 16)
+        for f in batch
+    ]
+    assert [int(h) for h in phash_frames(batch)] == expected
@@ -0,0 +1,123 @@
+from collections import Counter
+
+import numpy as np
+import pytest
+
+import similarity
+from db import writer
+from hash_store import store_hashes
+from jobs import enqueue
+
+
+def add_videos(db_path, n, frames=8, seed=0):
+    # n videos that all block together and all score under the threshold;
+    # each one's first frame hash doubles as its id in the counting scorer
+    rng = np.random.default_rng(seed)
+    base = rng.integers(0, 2**63, frames, dtype=np.uint64)
+    ids = {}
+    with writer(db_path) as conn:
+        cur = conn.cursor()
+        for i in range(n):
+            vid = f"v{i:03d}"
+            hashes = base.copy()
+            hashes[0] = np.uint64(i)
+            ids[i] = vid
+            cur.execute(
+                "INSERT INTO videos VALUES (?, ?, ?, ?, ?)",
+                (vid, f"/{vid}.mp4", 1000, 0.0, 0.0),
+            )
+            cur.execute(
+                "INSERT INTO video_metadata"
+                " VALUES (?, 60, 1800, 1280, 720, 'h264', 1, 'mp4', 30)",
+                (vid,),
+            )
+            store_hashes(cur, vid, list(enumerate(hashes.tolist())))
+    return ids
+
+
+@pytest.fixture
+def scored(monkeypatch):
+    # every pair the sim stage scores, counted by its two video numbers
+    counts = Counter()
+
+    def counting(a, b, cutoff=None):
+        counts[frozenset((int(a[0]), int(b[0])))] += 1
+        return similarity.sliding_window_score_np(a, b, cutoff)
+
+    monkeypatch.setitem(similarity.ENGINES, "counting", counting)
+    monkeypatch.setattr(similarity, "SIM_BATCH", 3)
+    return counts
+
+
+def run_sim(db_path, **kwargs):
+    similarity.main(db_path, engine="counting", workers=1, **kwargs)
+
+
+def all_pairs(numbers):
+    numbers = sorted(numbers)
+    return {frozenset((a, b)) for k, a in enumerate(numbers) for b in numbers[k + 1 :]}
+
+
+ORDERS = {
+    "by_id": lambda ids: ids,
+    "reversed": lambda ids: ids[::-1],
+    "shuffled": lambda ids: [ids[k] for k in (7, 2, 9, 0, 5, 10, 3, 8, 1, 6, 4)],
+}
+
+
+@pytest.fixture(params=ORDERS)
+def queued(request, db_path):
+    # sim jobs queued ahead of the run (as stream does), claimed in this order
+    ids = add_videos(db_path, 11)
+    with writer(db_path) as conn:
+        enqueue(
+            conn.cursor(), "sim", ORDERS[request.param]([ids[i] for i in range(11)])
+        )
+    return ids
+
+
+def test_full_run_scores_every_pair_once(db_path, scored):
+    add_videos(db_path, 11)
+    run_sim(db_path)
+    assert set(scored) == all_pairs(range(11))
+    assert set(scored.values()) == {1}
+
+
+def test_queued_jobs_score_every_pair_once(db_path, scored, queued):
+    run_sim(db_path)
+    assert set(scored) == all_pairs(range(11))
+    assert set(scored.values()) == {1}
+
+
+def test_resumed_run_scores_every_pair_once(db_path, scored, queued, monkeypatch):
+    claim, calls = similarity.claim, []
+
+    def dies_on_third_claim(conn, stage, limit):
+        calls.append(stage)
+        if len(calls) == 3:
+            raise KeyboardInterrupt
+        return claim(conn, stage, limit)
+
+    monkeypatch.setattr(similarity, "claim", dies_on_third_claim)
+    with pytest.raises(KeyboardInterrupt):
+        run_sim(db_path)
+    monkeypatch.setattr(similarity, "claim", claim)
+    run_sim(db_path)
+    assert set(scored) == all_pairs(range(11))
+    assert set(scored.values()) == {1}
+
+
+def test_incremental_run_scores_pairs_of_changed_videos_once(db_path, scored):
+    ids = add_videos(db_path, 11)
+    run_sim(db_path)
+    scored.clear()
+    changed = [1, 4, 5, 9]
+    with writer(db_path) as conn:
+        conn.executemany(
+            "UPDATE videos SET size_bytes = 2000 WHERE video_id = ?",
+            [(ids[i],) for i in changed],
+        )
+    run_sim(db_path, incremental=True)
+    expected = {p for p in all_pairs(range(11)) if p & set(changed)}
+    assert set(scored) == expected
+    assert set(scored.values()) == {1}
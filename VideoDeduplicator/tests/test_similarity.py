@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+import similarity
+from hamming import bit_count_bound, bit_counts, popcount64
+from similarity import sliding_window_score, sliding_window_score_np
+
+# (shorter, longer) lengths: count mode, more offsets than one block, blocks
+# big enough to be split, and many big blocks
+SHAPES = [(32, 32), (32, 34), (20, 200), (600, 640), (300, 500)]
+CUTOFFS = [None, 0, 4.5, 12, 40]
+
+
+def exhaustive(a, b):
+    # every frame at every offset, no cutoff, no early exit
+    if len(a) > len(b):
+        a, b = b, a
+    totals = [
+        int(popcount64(a ^ b[k : k + len(a)]).sum()) for k in range(len(b) - len(a) + 1)
+    ]
+    return min(totals) / len(a)
+
+
+def pairs(rng, la, lb):
+    # an unrelated pair, a noisy copy at a random offset, and an exact copy
+    b = rng.integers(0, 2**64, lb, dtype=np.uint64)
+    start = int(rng.integers(0, lb - la + 1))
+    noise = np.zeros(la, dtype=np.uint64)
+    for _ in range(4):
+        noise |= np.uint64(1) << rng.integers(0, 64, la).astype(np.uint64)
+    yield rng.integers(0, 2**64, la, dtype=np.uint64), b
+    yield b[start : start + la] ^ noise, b
+    yield b[start : start + la].copy(), b
+
+
+def expected(score, cutoff):
+    return score if cutoff is None or score <= cutoff else float("inf")
+
+
+@pytest.mark.parametrize("la, lb", SHAPES)
+@pytest.mark.parametrize("min_work", [0, 256, 12_000, 10**9])
+def test_engines_match_exhaustive(la, lb, min_work, monkeypatch):
+    # min_work moves the one-go / split boundary over every shape
+    monkeypatch.setattr(similarity, "BOUND_MIN_WORK", min_work)
+    rng = np.random.default_rng(la * lb)
+    for a, b in pairs(rng, la, lb):
+        score = exhaustive(a, b)
+        # a cutoff right on the score still gets the score back
+        for cutoff in CUTOFFS + [score]:
+            want = expected(score, cutoff)
+            assert sliding_window_score_np(a, b, cutoff) == want
+            assert sliding_window_score_np(b, a, cutoff) == want
+            if la <= 300:
+                a_list, b_list = list(map(int, a)), list(map(int, b))
+                assert sliding_window_score(a_list, b_list, cutoff) == want
+
+
+def test_empty_sequences():
+    for engine in (sliding_window_score, sliding_window_score_np):
+        assert engine([], [1, 2], 12) == float("inf")
+        assert engine([1, 2], [], None) == float("inf")
+
+
+@pytest.mark.parametrize("la, lb", SHAPES)
+def test_bit_count_bound_is_a_lower_bound(la, lb):
+    rng = np.random.default_rng(la + lb)
+    for a, b in pairs(rng, la, lb):
+        bound = bit_count_bound(bit_counts(a), la, bit_counts(b), lb)
+        assert bound[0] <= exhaustive(a, b)
+        swapped = bit_count_bound(bit_counts(b), lb, bit_counts(a), la)
+        assert swapped[0] == bound[0]
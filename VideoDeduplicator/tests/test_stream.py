@@ -0,0 +1,69 @@
+import sqlite3
+import threading
+
+import numpy as np
+import pytest
+
+import stream
+from db import reader, writer
+from hash_store import store_hashes
+
+
+@pytest.fixture
+def hashed_library(db_path, monkeypatch):
+    # 40 videos hashed and probed but never scored, so the stream goes
+    # straight to scoring; no files, scan and prehash are skipped
+    rng = np.random.default_rng(0)
+    with writer(db_path) as conn:
+        cur = conn.cursor()
+        for i in range(40):
+            vid = f"v{i:02d}"
+            cur.execute(
+                "INSERT INTO videos VALUES (?, ?, 1000, 0, 0)", (vid, f"/{vid}.mp4")
+            )
+            cur.execute(
+                "INSERT INTO video_metadata "
+                "VALUES (?, 60, 1800, 1280, 720, 'h264', 1, 'mp4', 30)",
+                (vid,),
+            )
+            frames = rng.integers(0, 2**63, 8, dtype=np.uint64).tolist()
+            store_hashes(cur, vid, list(enumerate(frames)))
+    monkeypatch.setattr(stream, "scan_main", lambda db_path, roots: None)
+    monkeypatch.setattr(stream, "prehash_main", lambda db_path: None)
+    # queues of one item fill at once, so a dead writer would block everything
+    monkeypatch.setattr(stream, "QUEUE_SIZE", 1)
+    monkeypatch.setattr(stream, "COMMIT_EVERY", 0.01)
+    monkeypatch.setattr(stream, "HASH_WORKERS", 1)
+    return db_path
+
+
+def run(db_path):
+    # stream.main in a thread, so a hang fails the test instead of the run
+    outcome = {}
+
+    def target():
+        try:
+            stream.main(db_path, [])
+        except BaseException as e:
+            outcome["error"] = e
+
+    t = threading.Thread(target=target, daemon=True)
+    t.start()
+    t.join(timeout=60)
+    assert not t.is_alive(), "stream hung"
+    return outcome.get("error")
+
+
+def test_stream_scores_everything(hashed_library):
+    assert run(hashed_library) is None
+    with reader(hashed_library) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM similarity_state").fetchone() == (40,)
+
+
+def test_stream_fails_when_a_write_fails(hashed_library, monkeypatch):
+    def full_disk(cur, op, state):
+        raise sqlite3.OperationalError("database or disk is full")
+
+    monkeypatch.setattr(stream, "apply_op", full_disk)
+    error = run(hashed_library)
+    assert isinstance(error, sqlite3.OperationalError)